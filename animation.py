@@ -0,0 +1,161 @@
+#!/usr/bin/python
+
+import copy
+
+import numpy as np
+
+from bvh import ObjectBVH, LayeredBVH
+from geometry import vector_length
+from scene import Screen
+
+# frames rendered at the same time, while the last tiles of one frame are traced the workers
+# already start on the next.
+FRAMES_IN_FLIGHT = 2
+
+
+# values, numbers or vectors, given at some frames and interpolated linearly in between. before
+# the first and after the last key the values of those keys are kept.
+class Keyframes:
+	def __init__(self, keys):
+		keys = sorted(keys, key=lambda k: k[0])
+		self.frames = np.array([frame for frame, value in keys], dtype=float)
+		self.values = np.array([value for frame, value in keys], dtype=float)
+
+	def at(self, frame):
+		values = self.values.reshape(len(self.values), -1)
+		value = np.array([np.interp(frame, self.frames, values[:, i]) for i in range(values.shape[1])])
+		return value.reshape(self.values.shape[1:])
+
+
+# a camera flying along eye keyframes while looking at target keyframes.
+class CameraPath:
+	def __init__(self, eye, target, up=(0, 1, 0)):
+		self.eye = eye
+		self.target = target
+		self.up = up
+
+	# eye and screen at the frame, the screen is set up like the given one, distance in front
+	# of the eye.
+	def at(self, frame, screen, distance):
+		eye = self.eye.at(frame)
+		return eye, Screen.lookAt(eye, self.target.at(frame), screen.resolutionX, screen.resolutionY, screen.pixelSizeInWorldCoords, distance, self.up)
+
+
+# a camera circling turns times around center at the given radius and height over the frames,
+# looking at the center. there is a key for every frame, so the path is a circle.
+def turntable(center, radius, frames, height=0.0, turns=1.0):
+	center = np.asarray(center, dtype=float)
+	angles = 2 * np.pi * turns * np.arange(frames) / float(frames)
+	eyes = [center + [radius * np.sin(a), height, -radius * np.cos(a)] for a in angles]
+	return CameraPath(Keyframes(zip(range(frames), eyes)), Keyframes([(0, center)]))
+
+
+# a scene over a number of frames: an optional camera path and tracks, which move objects of
+# the scene geometry by keyframed offsets, {index: Keyframes}. objects without a track, and
+# their acceleration structures, are shared by all frames; without tracks even the scene BVH.
+# the BVH over the objects without a track is built once, a frame only builds one over its
+# moved objects and traces through both.
+class Animation:
+	def __init__(self, scene, frames, camera=None, tracks=None):
+		self.scene = scene
+		self.frames = frames
+		self.camera = camera
+		self.tracks = tracks or {}
+		self.distance = vector_length(scene.screen.origin - scene.eye)
+		self.fixedIndices = [i for i in range(len(scene.geometry)) if i not in self.tracks]
+		self.bvh = ObjectBVH([scene.geometry[i] for i in self.fixedIndices]) if self.tracks else None
+
+	def frameScene(self, frame):
+		scene = copy.copy(self.scene)
+		if self.camera is not None:
+			scene.eye, scene.screen = self.camera.at(frame, self.scene.screen, self.distance)
+		if self.tracks:
+			scene.geometry = list(self.scene.geometry)
+			for index, track in self.tracks.items():
+				scene.geometry[index] = self.scene.geometry[index].translated(track.at(frame))
+			scene.bvh = LayeredBVH(scene.geometry, self.bvh, self.fixedIndices)
+		return scene
+
+
+# renders all frames of an animation with one pool of render processes, which keep running
+# from the first frame to the last. every frame is saved as fileName_0000.png and so on as
+# soon as it is done. stats, statsFile and output are those of the FileRenderer, the statistics
+# are those of all frames together.
+class AnimationRenderer:
+	def __init__(self, animation, tracer, processes=None, tileSize=None, tileOrder="spiral", stats=False, statsFile=None, output=None):
+		from imagefile import ImageOutput
+
+		from processes import TILE_SIZE
+
+		self.animation = animation
+		self.tracer = tracer
+		self.processes = processes
+		self.tileSize = tileSize or TILE_SIZE
+		self.tileOrder = tileOrder if tileOrder != "cost" else "spiral"
+		self.width = animation.scene.screen.resolutionX
+		self.height = animation.scene.screen.resolutionY
+		self.stats = stats or statsFile is not None
+		self.statsFile = statsFile
+		self.output = output or ImageOutput()
+
+	def render(self, fileName):
+		import sys, time, Queue
+
+		from framebuffer import Framebuffer
+		from processes import RenderPool, makeTiles
+		from stats import RenderStatistics
+
+		startTime = time.time()
+		frames = self.animation.frames
+		tiles = makeTiles(self.width, self.height, self.tileSize, self.tileOrder)
+		framebuffers = [Framebuffer(self.width, self.height) for i in range(min(FRAMES_IN_FLIGHT, frames))]
+		statistics = RenderStatistics(self.width, self.height, self.tracer, frames) if self.stats else None
+		pool = RenderPool(self.tracer, self.animation.scene, framebuffers, self.processes, animation=self.animation, statistics=statistics)
+
+		print "Starting %d Processes for %d frames of %d tiles..." % (len(pool.workers), frames, len(tiles))
+		pool.start([], close=False)
+		for frame in range(len(framebuffers)):
+			pool.submit(tiles, frame=frame)
+
+		# pixels still missing per frame in flight.
+		missing = dict((frame, self.width * self.height) for frame in range(len(framebuffers)))
+		done, rays, total = 0, 0, frames * self.width * self.height
+		try:
+			while missing:
+				try:
+					(x0, y0, x1, y1), tileRays, record, frame = pool.dataQueue.get(timeout=1)
+				except Queue.Empty:
+					continue
+
+				rays += tileRays
+				done += (x1 - x0) * (y1 - y0)
+				missing[frame] -= (x1 - x0) * (y1 - y0)
+				if not missing[frame]:
+					del missing[frame]
+					framebuffer = framebuffers[frame % len(framebuffers)]
+					self.output.save(framebuffer.image(), "%s_%04d" % (fileName, frame))
+					framebuffer.clear()
+					if frame + len(framebuffers) < frames:
+						missing[frame + len(framebuffers)] = self.width * self.height
+						pool.submit(tiles, frame=frame + len(framebuffers))
+
+				passedTime = time.time() - startTime
+				progress = done / float(total)
+				estimatedTime = passedTime / progress - passedTime
+				sys.stdout.write("Frame %d of %d, Progress: %2.2f%%\tRemaining time: %02dm %02ds          \r" % (
+					(min(missing) + 1 if missing else frames, frames, progress * 100) + divmod(estimatedTime, 60)))
+				sys.stdout.flush()
+		except KeyboardInterrupt:
+			pool.terminate()
+			raise
+
+		pool.close()
+		pool.join()
+		print
+		print pool.utilization()
+		print "Rays cast: %d, %.1f per pixel" % (rays, rays / float(total))
+		if statistics is not None:
+			print statistics.summary()
+			if self.statsFile is not None:
+				statistics.dump(self.statsFile)
+		print "Finished %d frames in %02dm %02ds, %.2fs per frame" % ((frames,) + divmod(time.time() - startTime, 60) + ((time.time() - startTime) / frames,))
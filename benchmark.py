@@ -0,0 +1,299 @@
+#!/usr/bin/python
+
+import hashlib
+import json
+import os
+import platform
+import sys
+import time
+
+import numpy as np
+
+from geometry import Ray, Plane, Sphere, Triangle, Cube, normalize_many
+
+# bump when the benchmarks change in a way that makes older results incomparable.
+BENCHMARK_VERSION = 1
+
+# a time counts as a regression when it is this much slower than the baseline.
+TOLERANCE = 0.15
+
+# largest difference of an 8 bit color channel to the baseline image that still counts as equal,
+# other machines may round the last bit differently.
+IMAGE_TOLERANCE = 1
+
+
+# the triangle intersection as it was before edges, normal and denominators were cached:
+# a temporary plane per ray, followed by a barycentric inside test. kept as the baseline.
+class LegacyTriangle:
+	def __init__(self, v0, v1, v2):
+		self.v0 = np.array(v0, dtype=float)
+		self.v1 = np.array(v1, dtype=float)
+		self.v2 = np.array(v2, dtype=float)
+
+	def intersect(self, ray):
+		U = self.v1 - self.v0
+		V = self.v2 - self.v0
+		distance = Plane(self.v0, np.cross(U, V)).intersect(ray)[0]
+		if distance == np.inf:
+			return [np.inf]
+
+		w = ray.origin + ray.direction * distance - self.v0
+		uu, uv, vv = np.dot(U, U), np.dot(U, V), np.dot(V, V)
+		wu, wv = np.dot(w, U), np.dot(w, V)
+		D = uv*uv - uu*vv
+		s = (uv*wv - vv*wu) / D
+		t = (uv*wu - uu*wv) / D
+		if s < 0.0 or s > 1.0 or t < 0.0 or (s+t) > 1.0:
+			return [np.inf]
+		return [distance]
+
+
+# the cube as 12 legacy triangles.
+class LegacyCube:
+	def __init__(self, center, length):
+		c, r = np.array(center, dtype=float), length / 2.0
+		v = [c + r * np.array(s) for s in [(-1, 1, -1), (1, 1, -1), (1, 1, 1), (-1, 1, 1), (-1, -1, -1), (1, -1, -1), (1, -1, 1), (-1, -1, 1)]]
+		faces = [(0, 1, 2), (0, 2, 3), (0, 1, 5), (0, 5, 4), (3, 0, 4), (3, 4, 7), (1, 2, 6), (1, 6, 5), (2, 3, 7), (2, 7, 6), (4, 5, 6), (4, 6, 7)]
+		self.triangles = [LegacyTriangle(v[a], v[b], v[c]) for a, b, c in faces]
+
+	def intersect(self, ray):
+		return [min(t.intersect(ray)[0] for t in self.triangles)]
+
+
+def randomRays(n, seed=0):
+	random = np.random.RandomState(seed)
+	origins = random.uniform(-3, 3, (n, 3))
+	directions = normalize_many(random.normal(size=(n, 3)))
+	return origins, directions
+
+
+# microseconds per ray for the scalar intersect over all rays.
+def scalarTime(obj, rays):
+	start = time.time()
+	for ray in rays:
+		obj.intersect(ray)
+	return (time.time() - start) / len(rays) * 1e6
+
+
+def packetTime(obj, origins, directions):
+	start = time.time()
+	obj.intersect_many(origins, directions)
+	return (time.time() - start) / len(origins) * 1e6
+
+
+def primitives(n=5000):
+	origins, directions = randomRays(n)
+	rays = [Ray(o, d) for o, d in zip(origins, directions)]
+
+	cases = [
+		("Triangle", LegacyTriangle([0, 0, 0], [2, 0, 0], [0, 2, 1]), Triangle([0, 0, 0], [2, 0, 0], [0, 2, 1])),
+		("Cube", LegacyCube([0, 0, 0], 2), Cube([0, 0, 0], 2)),
+	]
+
+	print "%-10s %12s %12s %8s %12s" % ("primitive", "legacy us", "scalar us", "speedup", "packet us")
+	for name, legacy, current in cases:
+		before = scalarTime(legacy, rays)
+		after = scalarTime(current, rays)
+		packet = packetTime(current, origins, directions)
+		print "%-10s %12.2f %12.2f %7.1fx %12.3f" % (name, before, after, before / after, packet)
+
+
+# the primitives of geometry.py, timed by primitiveTimes.
+def benchmarkPrimitives():
+	return [
+		("Plane", Plane([0, -1, 0], [0, 1, 0])),
+		("Sphere", Sphere([0, 0, 0], 1.5)),
+		("Triangle", Triangle([0, 0, 0], [2, 0, 0], [0, 2, 1])),
+		("Cube", Cube([0, 0, 0], 2)),
+	]
+
+
+# seconds per million rays of the scalar and the packet intersection of every primitive,
+# the best of repeat runs.
+def primitiveTimes(n=5000, repeat=3):
+	origins, directions = randomRays(n)
+	rays = [Ray(o, d) for o, d in zip(origins, directions)]
+
+	times = {}
+	for name, obj in benchmarkPrimitives():
+		times["primitive/%s/scalar" % name] = min(scalarTime(obj, rays) for i in range(repeat))
+		times["primitive/%s/packet" % name] = min(packetTime(obj, origins, directions) for i in range(repeat))
+	return times
+
+
+# renders the scene in this process, tile by tile with the seeds of the render processes, so
+# the image is the one FileRenderer makes. returns the 8 bit image.
+def renderImage(tracer, scene):
+	from processes import makeTiles
+
+	width, height = scene.screen.resolutionX, scene.screen.resolutionY
+	image = np.zeros((height, width, 3), dtype=np.float32)
+	for x0, y0, x1, y1 in makeTiles(width, height, order="rows"):
+		tracer.seed(0, x0, y0)
+		ys, xs = np.mgrid[y0:y1, x0:x1]
+		origins, directions = scene.screen.primaryRays(scene.eye, xs.ravel(), ys.ravel())
+		image[y0:y1, x0:x1] = tracer.trace_batch(origins, directions, scene.bvh, scene.lights).reshape(y1 - y0, x1 - x0, 3)
+	return np.clip(image, 0, 255).astype(np.uint8)
+
+
+# seconds every tracer takes for the reference scene of ray.py at every resolution, rendered
+# in this process, and the images, {name: image}, to check them against the baseline.
+def tracerTimes(tracers, resolutions, repeat=1):
+	from ray import referenceScene, makeTracer
+
+	times, images = {}, {}
+	for name in tracers:
+		for size in resolutions:
+			scene = referenceScene(size, size)
+			key = "%s/%dx%d" % (name, size, size)
+			best = np.inf
+			for i in range(repeat):
+				tracer = makeTracer(name, scene)
+				start = time.time()
+				images["tracer/" + key] = renderImage(tracer, scene)
+				best = min(best, time.time() - start)
+			times["tracer/" + key] = best
+	return times, images
+
+
+# seconds from the first tile to the last with every number of render processes, processes
+# started beforehand. the image has to be the same for all of them.
+def scalingTimes(tracer, size, processCounts):
+	from framebuffer import Framebuffer
+	from processes import RenderPool, makeTiles
+	from ray import referenceScene, makeTracer
+
+	scene = referenceScene(size, size)
+	times, images = {}, {}
+	for count in processCounts:
+		framebuffer = Framebuffer(size, size)
+		pool = RenderPool(makeTracer(tracer, scene), scene, framebuffer, count)
+		pool.start(makeTiles(size, size))
+		pool.join()
+		key = "%s/%dx%d/%d" % (tracer, size, size, count)
+		times["scaling/" + key] = pool.wallTime
+		images["scaling/" + key] = framebuffer.toBytes().copy()
+	return times, images
+
+
+def environment():
+	import multiprocessing
+	return {"python": platform.python_version(), "numpy": np.__version__, "platform": platform.platform(), "cpus": multiprocessing.cpu_count()}
+
+
+def imageHash(image):
+	return hashlib.sha1(np.ascontiguousarray(image).tobytes()).hexdigest()
+
+
+def imageName(key):
+	return key.replace("/", "_") + ".png"
+
+
+# a baseline is a directory with baseline.json, the results of a run, and the images of the run.
+def saveBaseline(directory, results, images):
+	from PIL import Image
+
+	if not os.path.isdir(directory):
+		os.makedirs(directory)
+	with open(os.path.join(directory, "baseline.json"), "w") as f:
+		json.dump(results, f, indent=1, sort_keys=True)
+	for key, image in images.items():
+		Image.fromarray(image, "RGB").save(os.path.join(directory, imageName(key)), format="png")
+
+
+# prints the times next to those of the baseline and checks the images against its images.
+# returns the number of failures: times slower than the baseline by more than tolerance and
+# images that differ from it.
+def compareBaseline(directory, results, images, tolerance=TOLERANCE):
+	from PIL import Image
+
+	with open(os.path.join(directory, "baseline.json")) as f:
+		baseline = json.load(f)
+	if baseline.get("version") != BENCHMARK_VERSION:
+		print "The baseline is of benchmark version %s, not %d." % (baseline.get("version"), BENCHMARK_VERSION)
+		return 1
+
+	failures = 0
+	print "%-36s %12s %12s %8s" % ("benchmark", "baseline", "now", "ratio")
+	for key in sorted(results["times"]):
+		if key not in baseline["times"]:
+			print "%-36s %12s %12.4f" % (key, "-", results["times"][key])
+			continue
+		before, now = baseline["times"][key], results["times"][key]
+		ratio = now / max(before, 1e-12)
+		verdict = ""
+		if ratio > 1 + tolerance:
+			verdict = "SLOWER"
+			failures += 1
+		elif ratio < 1 - tolerance:
+			verdict = "faster"
+		print "%-36s %12.4f %12.4f %7.2fx %s" % (key, before, now, ratio, verdict)
+
+	for key in sorted(images):
+		path = os.path.join(directory, imageName(key))
+		if not os.path.exists(path):
+			continue
+		expected = np.asarray(Image.open(path).convert("RGB"), dtype=int)
+		if expected.shape != images[key].shape:
+			difference = np.inf
+		else:
+			difference = np.max(np.abs(expected - images[key]))
+		if difference > IMAGE_TOLERANCE:
+			print "Image %s differs from the baseline by up to %s." % (key, difference)
+			failures += 1
+	return failures
+
+
+if __name__ == "__main__":
+	import argparse
+	from ray import TRACERS
+
+	parser = argparse.ArgumentParser(description="Benchmarks of the primitives, the tracers and the render processes.")
+	parser.add_argument("--tracers", nargs="+", choices=TRACERS, default=TRACERS, help="tracers to time on the reference scene.")
+	parser.add_argument("--resolutions", nargs="+", type=int, default=[32, 64], help="edge lengths of the square images the tracers render.")
+	parser.add_argument("--processes", nargs="+", type=int, default=[1, 2, 4], help="numbers of render processes to time.")
+	parser.add_argument("--scaling-tracer", choices=TRACERS, default="ShadingShadow", help="tracer of the process scaling benchmark.")
+	parser.add_argument("--scaling-size", type=int, default=128, help="edge length of the image of the process scaling benchmark.")
+	parser.add_argument("--repeat", type=int, default=3, help="runs of every benchmark, the fastest counts.")
+	parser.add_argument("--output", help="write the results to this JSON file.")
+	parser.add_argument("--baseline", help="compare with the baseline in this directory, exits with 1 on regressions.")
+	parser.add_argument("--save-baseline", help="save the results and images as the baseline in this directory.")
+	parser.add_argument("--tolerance", type=float, default=TOLERANCE, help="how much slower than the baseline still passes, 0.15 is 15%%.")
+	parser.add_argument("--legacy", action="store_true", help="only compare the triangle and cube intersection with the legacy implementation.")
+	args = parser.parse_args()
+
+	if args.legacy:
+		primitives()
+		sys.exit(0)
+
+	times = primitiveTimes(repeat=args.repeat)
+	for name, obj in benchmarkPrimitives():
+		print "%-10s %8.3fs scalar, %8.3fs packet per million rays" % (name, times["primitive/%s/scalar" % name], times["primitive/%s/packet" % name])
+
+	tracers, images = tracerTimes(args.tracers, args.resolutions, args.repeat)
+	for key in sorted(tracers):
+		print "%-36s %8.3fs" % (key, tracers[key])
+	times.update(tracers)
+
+	scaling, scalingImages = scalingTimes(args.scaling_tracer, args.scaling_size, args.processes)
+	for key in sorted(scaling):
+		print "%-36s %8.3fs" % (key, scaling[key])
+	times.update(scaling)
+	images.update(scalingImages)
+	failures = 0
+	if len(set(imageHash(image) for image in scalingImages.values())) > 1:
+		print "The number of render processes changes the image."
+		failures += 1
+
+	results = {"version": BENCHMARK_VERSION, "environment": environment(), "times": times,
+			   "images": dict((key, imageHash(image)) for key, image in images.items())}
+	if args.output:
+		with open(args.output, "w") as f:
+			json.dump(results, f, indent=1, sort_keys=True)
+	if args.save_baseline:
+		saveBaseline(args.save_baseline, results, images)
+
+	if args.baseline:
+		failures += compareBaseline(args.baseline, results, images, args.tolerance)
+		print "%d failures." % failures if failures else "No regressions."
+	sys.exit(1 if failures else 0)
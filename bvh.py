@@ -0,0 +1,523 @@
+#!/usr/bin/python
+
+from abc import ABCMeta, abstractmethod
+import time
+
+import numpy as np
+
+# surface area heuristic: number of bins per axis and relative costs of a node traversal
+# and a primitive intersection.
+SAH_BINS = 12
+TRAVERSAL_COST = 1.0
+INTERSECTION_COST = 1.0
+MAX_LEAF_SIZE = 4
+
+# bits per axis of the morton codes of a linear build.
+MORTON_BITS = 10
+
+
+# surface area of one box or of every row of (N,3) corner arrays.
+def surfaceArea(lo, hi):
+	e = np.maximum(np.asarray(hi) - lo, 0)
+	return 2 * (e[..., 0] * e[..., 1] + e[..., 1] * e[..., 2] + e[..., 2] * e[..., 0])
+
+
+# slab test of one ray against one box, returns the entry distance or np.inf.
+def boxEntry(lo, hi, origin, invDirection, tMin, tMax):
+	return boxEntry_many(lo, hi, origin, invDirection, tMin, tMax)[()]
+
+
+# slab test of a packet against one box, or of one ray against (N,3) boxes. returns the entry
+# distance per ray or box, np.inf for misses. fmin and fmax skip the nan of 0 * inf.
+def boxEntry_many(lo, hi, origins, invDirections, tMin, tMax):
+	with np.errstate(invalid="ignore"):
+		t1 = (lo - origins) * invDirections
+		t2 = (hi - origins) * invDirections
+	tNear = np.maximum(np.fmax.reduce(np.fmin(t1, t2), axis=-1), tMin)
+	tFar = np.minimum(np.fmin.reduce(np.fmax(t1, t2), axis=-1), tMax)
+	return np.where(tNear <= tFar, tNear, np.inf)
+
+
+def inverse(directions):
+	with np.errstate(divide="ignore"):
+		return 1.0 / directions
+
+
+# spreads the lowest MORTON_BITS bits of every value apart, two zero bits after every bit.
+def spreadBits(values):
+	x = np.asarray(values, dtype=np.uint64)
+	for shift, mask in [(16, 0x030000FF), (8, 0x0300F00F), (4, 0x030C30C3), (2, 0x09249249)]:
+		x = (x | (x << np.uint64(shift))) & np.uint64(mask)
+	return x
+
+
+# z-order curve index of every point, points close in space get close codes.
+def mortonCodes(points):
+	lo = points.min(axis=0)
+	extent = np.maximum(points.max(axis=0) - lo, 1e-12)
+	grid = ((points - lo) / extent * ((1 << MORTON_BITS) - 1)).astype(np.uint64)
+	return spreadBits(grid[:, 0]) | (spreadBits(grid[:, 1]) << np.uint64(1)) | (spreadBits(grid[:, 2]) << np.uint64(2))
+
+
+# Bounding volume hierarchy over a set of axis aligned boxes, built top-down with binned
+# SAH splits. Nodes are stored as flat arrays; a node is a leaf if nodeLeft is -1, then
+# it references nodeCount primitives starting at nodeStart in self.order.
+# Subclasses say what a primitive is by implementing intersectLeaf and intersectLeaf_many,
+# and pass a lower intersectionCost if their leaves test many primitives at once.
+# A linear build sorts the primitives along a morton curve instead and puts a balanced tree
+# over runs of maxLeafSize of them. The trees are worse than the SAH ones, but built with a
+# few numpy calls per level instead of several per node, for hundred thousands of primitives.
+class BVH:
+	__metaclass__ = ABCMeta
+
+	def __init__(self, lo, hi, maxLeafSize=MAX_LEAF_SIZE, intersectionCost=INTERSECTION_COST, linear=False):
+		startTime = time.time()
+
+		lo = np.asarray(lo, dtype=float).reshape(-1, 3)
+		hi = np.asarray(hi, dtype=float).reshape(-1, 3)
+		self.maxLeafSize = maxLeafSize
+		self.intersectionCost = intersectionCost
+		self.depth = 0
+
+		if linear:
+			self.__buildLinear(lo, hi)
+		else:
+			self.__lo, self.__hi, self.__left, self.__right, self.__start, self.__count = [], [], [], [], [], []
+			self.order = []
+			if len(lo):
+				self.__build(lo, hi, (lo + hi) / 2, np.arange(len(lo)), 1)
+
+			self.nodeLo = np.array(self.__lo, dtype=float).reshape(-1, 3)
+			self.nodeHi = np.array(self.__hi, dtype=float).reshape(-1, 3)
+			self.nodeLeft = np.array(self.__left, dtype=int)
+			self.nodeRight = np.array(self.__right, dtype=int)
+			self.nodeStart = np.array(self.__start, dtype=int)
+			self.nodeCount = np.array(self.__count, dtype=int)
+			self.order = np.array(self.order, dtype=int)
+			del self.__lo, self.__hi, self.__left, self.__right, self.__start, self.__count
+
+		self.buildTime = time.time() - startTime
+		self.resetStatistics()
+
+	# the leaves are the morton sorted primitives in runs of maxLeafSize, then every level
+	# pairs the nodes of the level below, an odd one out moves up as it is. nodes are numbered
+	# from the leaves up and turned around at the end, so the root is node 0.
+	def __buildLinear(self, lo, hi):
+		self.order = np.argsort(mortonCodes((lo + hi) / 2), kind="mergesort") if len(lo) else np.zeros(0, dtype=int)
+		starts = np.arange(0, len(lo), self.maxLeafSize)
+		nodeLo = np.minimum.reduceat(lo[self.order], starts) if len(lo) else np.zeros((0, 3))
+		nodeHi = np.maximum.reduceat(hi[self.order], starts) if len(lo) else np.zeros((0, 3))
+		left, right = np.full(len(starts), -1), np.full(len(starts), -1)
+		start, count = starts, np.diff(np.append(starts, len(lo)))
+
+		level = np.arange(len(starts))
+		self.depth = 1 if len(starts) else 0
+		while len(level) > 1:
+			pairs = len(level) // 2
+			a, b = level[0:2 * pairs:2], level[1:2 * pairs:2]
+			parents = np.arange(len(nodeLo), len(nodeLo) + pairs)
+			nodeLo = np.concatenate([nodeLo, np.minimum(nodeLo[a], nodeLo[b])])
+			nodeHi = np.concatenate([nodeHi, np.maximum(nodeHi[a], nodeHi[b])])
+			left, right = np.concatenate([left, a]), np.concatenate([right, b])
+			start, count = np.concatenate([start, np.zeros(pairs, dtype=int)]), np.concatenate([count, np.zeros(pairs, dtype=int)])
+			level = np.concatenate([parents, level[2 * pairs:]])
+			self.depth += 1
+
+		last = len(nodeLo) - 1
+		self.nodeLo = nodeLo[::-1].copy()
+		self.nodeHi = nodeHi[::-1].copy()
+		self.nodeLeft = np.where(left >= 0, last - left, -1)[::-1].copy()
+		self.nodeRight = np.where(right >= 0, last - right, -1)[::-1].copy()
+		self.nodeStart = start[::-1].astype(int)
+		self.nodeCount = count[::-1].astype(int)
+
+	def __newNode(self, lo, hi):
+		self.__lo.append(lo)
+		self.__hi.append(hi)
+		self.__left.append(-1)
+		self.__right.append(-1)
+		self.__start.append(len(self.order))
+		self.__count.append(0)
+		return len(self.__lo) - 1
+
+	def __build(self, lo, hi, centroids, indices, depth):
+		node = self.__newNode(lo[indices].min(axis=0), hi[indices].max(axis=0))
+		self.depth = max(self.depth, depth)
+
+		split = None
+		if len(indices) > 1:
+			split = self.__findSplit(lo, hi, centroids, indices, node)
+
+		# a leaf is cheaper than the best split, or there is no split at all.
+		if split is None or (split[0] >= self.intersectionCost * len(indices) and len(indices) <= self.maxLeafSize):
+			self.__start[node] = len(self.order)
+			self.__count[node] = len(indices)
+			self.order.extend(indices)
+			return node
+
+		cost, left = split
+		self.__left[node] = self.__build(lo, hi, centroids, indices[left], depth + 1)
+		self.__right[node] = self.__build(lo, hi, centroids, indices[~left], depth + 1)
+		return node
+
+	# returns (cost, mask of the primitives going left) of the cheapest binned split.
+	def __findSplit(self, lo, hi, centroids, indices, node):
+		c = centroids[indices]
+		nodeLo, nodeHi = lo[indices], hi[indices]
+		cmin = c.min(axis=0)
+		extent = c.max(axis=0) - cmin
+		parentArea = surfaceArea(self.__lo[node], self.__hi[node])
+
+		best = None
+		for axis in range(3):
+			if extent[axis] <= 0:
+				continue
+
+			bins = ((c[:, axis] - cmin[axis]) / extent[axis] * SAH_BINS).astype(int)
+			bins = np.minimum(bins, SAH_BINS - 1)
+
+			# bounds per bin by reducing the primitives sorted into consecutive runs per bin.
+			counts = np.bincount(bins, minlength=SAH_BINS)
+			filled = counts > 0
+			order = np.argsort(bins, kind="mergesort")
+			starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[filled]
+			binLo = np.full((SAH_BINS, 3), np.inf)
+			binHi = np.full((SAH_BINS, 3), -np.inf)
+			binLo[filled] = np.minimum.reduceat(nodeLo[order], starts)
+			binHi[filled] = np.maximum.reduceat(nodeHi[order], starts)
+
+			# sweep from both sides to get the area and count left and right of every split.
+			with np.errstate(invalid="ignore"):
+				leftArea = surfaceArea(np.minimum.accumulate(binLo), np.maximum.accumulate(binHi))[:-1]
+				rightArea = surfaceArea(np.minimum.accumulate(binLo[::-1]), np.maximum.accumulate(binHi[::-1]))[::-1][1:]
+			leftCount = np.cumsum(counts)[:-1]
+			rightCount = len(indices) - leftCount
+
+			with np.errstate(invalid="ignore"):
+				costs = TRAVERSAL_COST + self.intersectionCost * (leftCount * leftArea + rightCount * rightArea) / max(parentArea, 1e-12)
+			costs[(leftCount == 0) | (rightCount == 0)] = np.inf
+
+			b = int(np.argmin(costs))
+			if costs[b] < np.inf and (best is None or costs[b] < best[0]):
+				best = (costs[b], bins <= b)
+
+		return best
+
+	# optional stats.RayStatistics, shared by all BVHs of a process, which counts the tests of
+	# every primitive type. set on the class, so the BVHs inside of meshes count as well.
+	stats = None
+
+	def resetStatistics(self):
+		self.rays = 0
+		self.nodesVisited = 0
+		self.primitiveTests = 0
+
+	def statistics(self):
+		rays = max(self.rays, 1)
+		return {
+			"buildTime": self.buildTime,
+			"primitives": len(self.order),
+			"nodes": len(self.nodeLeft),
+			"leaves": int(np.sum(self.nodeLeft < 0)),
+			"depth": self.depth,
+			"rays": self.rays,
+			"nodesPerRay": self.nodesVisited / float(rays),
+			"testsPerRay": self.primitiveTests / float(rays),
+		}
+
+	# returns (distance, primitive) of the nearest intersection in the primitives of a leaf,
+	# only considering distances in (tMin, tMax). (np.inf, None) if nothing is hit.
+	@abstractmethod
+	def intersectLeaf(self, primitives, ray, tMin, tMax):
+		pass
+
+	# packet version of intersectLeaf, returns (distances, primitives) per ray, -1 for misses.
+	@abstractmethod
+	def intersectLeaf_many(self, primitives, origins, directions, tMin, tMax):
+		pass
+
+	# counts the tests of the primitives against that many rays into stats by their type.
+	@abstractmethod
+	def countTests(self, primitives, rays):
+		pass
+
+	# nearest hit in (tMin, tMax) as (distance, primitive), (np.inf, None) if nothing is hit.
+	# with anyHit the traversal stops at the first hit found, which need not be the nearest.
+	def closestHit(self, ray, tMin=0.0, tMax=np.inf, anyHit=False):
+		self.rays += 1
+		best = (np.inf, None)
+		if not len(self.nodeLeft):
+			return best
+
+		invDirection = inverse(ray.direction)
+		stack = [(0, boxEntry(self.nodeLo[0], self.nodeHi[0], ray.origin, invDirection, tMin, tMax))]
+		while stack:
+			node, entry = stack.pop()
+			# the box was entered behind something that has already been hit.
+			if entry >= tMax:
+				continue
+			self.nodesVisited += 1
+
+			if self.nodeLeft[node] < 0:
+				start = self.nodeStart[node]
+				primitives = self.order[start:start + self.nodeCount[node]]
+				self.primitiveTests += len(primitives)
+				if self.stats is not None:
+					self.countTests(primitives, 1)
+				distance, primitive = self.intersectLeaf(primitives, ray, tMin, tMax)
+				if distance < tMax:
+					tMax = distance
+					best = (distance, primitive)
+					if anyHit:
+						break
+				continue
+
+			# visit the nearer child first by pushing it last.
+			children = (self.nodeLeft[node], self.nodeRight[node])
+			left, right = boxEntry_many(self.nodeLo[children, :], self.nodeHi[children, :], ray.origin, invDirection, tMin, tMax).tolist()
+			if left <= right:
+				if right < np.inf:
+					stack.append((children[1], right))
+				if left < np.inf:
+					stack.append((children[0], left))
+			else:
+				if left < np.inf:
+					stack.append((children[0], left))
+				stack.append((children[1], right))
+
+		return best
+
+	# true if anything is hit in (tMin, tMax).
+	def anyHit(self, ray, tMin=0.0, tMax=np.inf):
+		return self.closestHit(ray, tMin, tMax, anyHit=True)[0] < np.inf
+
+	# packet traversal, returns (distances, primitives) with primitive -1 where nothing is hit.
+	# tMax can be given per ray. with anyHit a ray leaves the traversal at its first hit.
+	def intersect_many(self, origins, directions, tMin=0.0, tMax=np.inf, anyHit=False):
+		nearest = np.full(len(origins), np.inf)
+		nearest[:] = tMax
+		index = np.full(len(origins), -1, dtype=int)
+		self.rays += len(origins)
+		if not len(self.nodeLeft) or not len(origins):
+			nearest[index < 0] = np.inf
+			return nearest, index
+
+		invDirections = inverse(directions)
+		stack = [(0, np.arange(len(origins)))]
+		while stack:
+			node, rays = stack.pop()
+			entry = boxEntry_many(self.nodeLo[node], self.nodeHi[node], origins[rays], invDirections[rays], tMin, nearest[rays])
+			rays = rays[entry < nearest[rays]]
+			if anyHit:
+				rays = rays[index[rays] < 0]
+			if not len(rays):
+				continue
+			self.nodesVisited += len(rays)
+
+			if self.nodeLeft[node] < 0:
+				start = self.nodeStart[node]
+				primitives = self.order[start:start + self.nodeCount[node]]
+				self.primitiveTests += len(primitives) * len(rays)
+				if self.stats is not None:
+					self.countTests(primitives, len(rays))
+				d, p = self.intersectLeaf_many(primitives, origins[rays], directions[rays], tMin, nearest[rays])
+				closer = d < nearest[rays]
+				nearest[rays[closer]] = d[closer]
+				index[rays[closer]] = p[closer]
+				continue
+
+			# most rays go towards the child with the nearer center, visit that first.
+			left, right = self.nodeLeft[node], self.nodeRight[node]
+			towardsLeft = np.dot(directions[rays], (self.nodeLo[left] + self.nodeHi[left]) - (self.nodeLo[right] + self.nodeHi[right]))
+			if np.sum(towardsLeft > 0) * 2 >= len(rays):
+				stack.extend([(right, rays), (left, rays)])
+			else:
+				stack.extend([(left, rays), (right, rays)])
+
+		nearest[index < 0] = np.inf
+		return nearest, index
+
+	def anyHit_many(self, origins, directions, tMin=0.0, tMax=np.inf):
+		return self.intersect_many(origins, directions, tMin, tMax, anyHit=True)[1] >= 0
+
+
+# BVH over GeometryObjects, like Scene.geometry. Objects without bounds (infinite planes)
+# are kept in a separate list and tested against every ray.
+# Iterating over it yields the objects in their original order, so it can be used wherever
+# a list of objects is expected; primitive indices refer to that order.
+class ObjectBVH(BVH):
+	def __init__(self, objects, maxLeafSize=MAX_LEAF_SIZE):
+		self.objects = list(objects)
+
+		bounds = [obj.bounds() for obj in self.objects]
+		self.bounded = [i for i, b in enumerate(bounds) if b is not None]
+		self.unbounded = [i for i, b in enumerate(bounds) if b is None]
+
+		lo = [bounds[i][0] for i in self.bounded]
+		hi = [bounds[i][1] for i in self.bounded]
+		BVH.__init__(self, lo, hi, maxLeafSize)
+
+		# the tree references positions in self.bounded, map them back to the objects.
+		self.order = np.array(self.bounded, dtype=int)[self.order] if len(self.order) else self.order
+
+	def __iter__(self):
+		return iter(self.objects)
+
+	def __len__(self):
+		return len(self.objects)
+
+	def __getitem__(self, i):
+		return self.objects[i]
+
+	def intersectLeaf(self, primitives, ray, tMin, tMax):
+		best = (np.inf, None)
+		for i in primitives:
+			distance = self.objects[i].closestDistance(ray, tMin, min(tMax, best[0]))
+			if distance < best[0]:
+				best = (distance, self.objects[i])
+		return best
+
+	def intersectLeaf_many(self, primitives, origins, directions, tMin, tMax):
+		nearest = np.array(tMax, dtype=float)
+		index = np.full(len(origins), -1, dtype=int)
+		for i in primitives:
+			d = self.objects[i].intersect_many(origins, directions, tMin)
+			closer = d < nearest
+			nearest[closer] = d[closer]
+			index[closer] = i
+		nearest[index < 0] = np.inf
+		return nearest, index
+
+	def countTests(self, primitives, rays):
+		for i in primitives:
+			self.stats.countTests(self.objects[i].__class__.__name__, rays)
+
+	def closestHit(self, ray, tMin=0.0, tMax=np.inf, anyHit=False):
+		best = (np.inf, None)
+		for i in self.unbounded:
+			self.primitiveTests += 1
+			if self.stats is not None:
+				self.countTests([i], 1)
+			distance = self.objects[i].closestDistance(ray, tMin, min(tMax, best[0]))
+			if distance < best[0]:
+				best = (distance, self.objects[i])
+				if anyHit:
+					return best
+
+		distance, obj = BVH.closestHit(self, ray, tMin, min(tMax, best[0]), anyHit)
+		if obj is not None:
+			best = (distance, obj)
+		return best
+
+	def intersect_many(self, origins, directions, tMin=0.0, tMax=np.inf, anyHit=False):
+		nearest = np.full(len(origins), np.inf)
+		nearest[:] = tMax
+		index = np.full(len(origins), -1, dtype=int)
+		for i in self.unbounded:
+			d = self.objects[i].intersect_many(origins, directions, tMin)
+			closer = d < nearest
+			nearest[closer] = d[closer]
+			index[closer] = i
+		self.primitiveTests += len(self.unbounded) * len(origins)
+		if self.stats is not None:
+			self.countTests(self.unbounded, len(origins))
+
+		# with anyHit, rays blocked by a plane don't need the tree anymore.
+		rays = np.flatnonzero(index < 0) if anyHit else np.arange(len(origins))
+		d, p = BVH.intersect_many(self, origins[rays], directions[rays], tMin, nearest[rays], anyHit)
+		closer = p >= 0
+		nearest[rays[closer]] = d[closer]
+		index[rays[closer]] = p[closer]
+
+		nearest[index < 0] = np.inf
+		return nearest, index
+
+
+# the BVH of a scene of which only some objects move, e.g. the frames of an animation: the tree
+# over the objects that stay is built once and shared, only the one over the moving objects is
+# built again, rays are traced through both. indices and the objects hit are those of the
+# objects given, like with an ObjectBVH over all of them. fixed is an ObjectBVH over the
+# objects at the indices fixedIndices, the others move.
+class LayeredBVH:
+	def __init__(self, objects, fixed, fixedIndices):
+		self.objects = list(objects)
+		self.fixed = fixed
+		self.fixedIndices = np.asarray(fixedIndices, dtype=int)
+		fixedSet = set(self.fixedIndices.tolist())
+		self.movingIndices = np.array([i for i in range(len(self.objects)) if i not in fixedSet], dtype=int)
+		self.moving = ObjectBVH([self.objects[i] for i in self.movingIndices])
+
+	def __iter__(self):
+		return iter(self.objects)
+
+	def __len__(self):
+		return len(self.objects)
+
+	def __getitem__(self, i):
+		return self.objects[i]
+
+	def closestHit(self, ray, tMin=0.0, tMax=np.inf, anyHit=False):
+		best = self.fixed.closestHit(ray, tMin, tMax, anyHit)
+		if anyHit and best[1] is not None:
+			return best
+		distance, obj = self.moving.closestHit(ray, tMin, min(tMax, best[0]), anyHit)
+		return (distance, obj) if obj is not None else best
+
+	def anyHit(self, ray, tMin=0.0, tMax=np.inf):
+		return self.closestHit(ray, tMin, tMax, anyHit=True)[1] is not None
+
+	def intersect_many(self, origins, directions, tMin=0.0, tMax=np.inf, anyHit=False):
+		nearest, fixedIndex = self.fixed.intersect_many(origins, directions, tMin, tMax, anyHit)
+		index = np.full(len(origins), -1, dtype=int)
+		index[fixedIndex >= 0] = self.fixedIndices[fixedIndex[fixedIndex >= 0]]
+
+		# the moving objects only have to be nearer than what was hit already.
+		rays = np.flatnonzero(index < 0) if anyHit else np.arange(len(origins))
+		if len(rays) and len(self.movingIndices):
+			limit = np.minimum(np.broadcast_to(tMax, len(origins))[rays], nearest[rays])
+			d, p = self.moving.intersect_many(origins[rays], directions[rays], tMin, limit, anyHit)
+			closer = p >= 0
+			nearest[rays[closer]] = d[closer]
+			index[rays[closer]] = self.movingIndices[p[closer]]
+		return nearest, index
+
+	def anyHit_many(self, origins, directions, tMin=0.0, tMax=np.inf):
+		return self.intersect_many(origins, directions, tMin, tMax, anyHit=True)[1] >= 0
+
+if __name__ == "__main__":
+	from geometry import Sphere, Ray, normalize_many
+	from material import Material, Color
+
+	# traversal cost should grow much slower than the number of spheres.
+	random = np.random.RandomState(0)
+	for n in [10, 100, 1000, 10000]:
+		spheres = [Sphere(random.uniform(-10, 10, 3), random.uniform(0.05, 0.3), Material(Color(255, 0, 0), 1, 0)) for i in range(n)]
+		bvh = ObjectBVH(spheres)
+
+		origins = np.zeros((1000, 3)) - [0, 0, 20]
+		directions = normalize_many(random.uniform(-0.5, 0.5, (1000, 3)) + [0, 0, 1])
+		bvh.intersect_many(origins, directions)
+		for i in range(100):
+			bvh.closestHit(Ray(origins[i], directions[i]))
+
+		s = bvh.statistics()
+		print "%6d spheres: build %.3fs, %d nodes, depth %d, %.1f nodes/ray, %.1f tests/ray" % (
+			n, s["buildTime"], s["nodes"], s["depth"], s["nodesPerRay"], s["testsPerRay"])
+
+	# a layered tree has to hit what one tree over all objects hits.
+	from geometry import Plane
+	objects = spheres[:200] + [Plane([0, -12, 0], [0, 1, 0])]
+	layered = LayeredBVH(objects, ObjectBVH(objects[::2]), range(0, len(objects), 2))
+	whole = ObjectBVH(objects)
+	directions = normalize_many(random.uniform(-1, 1, (1000, 3)))
+	for anyHit in [False, True]:
+		d, i = layered.intersect_many(origins, directions, anyHit=anyHit)
+		expected = whole.intersect_many(origins, directions, anyHit=anyHit)
+		assert np.array_equal(i >= 0, expected[1] >= 0)
+		if not anyHit:
+			assert np.array_equal(d, expected[0]) and np.array_equal(i, expected[1])
+	for k in range(100):
+		ray = Ray(origins[k], directions[k])
+		assert layered.closestHit(ray) == whole.closestHit(ray)
+		assert layered.anyHit(ray, 0.0, 15.0) == whole.anyHit(ray, 0.0, 15.0)
+	print "bvh ok"
@@ -0,0 +1,210 @@
+#!/usr/bin/python
+
+import hashlib
+import inspect
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+# bump when the meaning of the cached images changes in a way the hash does not see.
+CACHE_VERSION = 1
+
+# default limit of the cache directory in bytes.
+CACHE_SIZE = 512 * 1024 * 1024
+
+# attributes that are derived from the others or change while rendering, they don't take part
+# in the hash: accelerators, random generators, counters and the names of scene objects.
+SKIP_ATTRIBUTES = ("bvh", "random", "rays", "names")
+
+
+# feeds a stable description of value into the sha1 digest. objects are described by their
+# class and their attributes, so two scenes built the same way hash the same in every run.
+def hashValue(digest, value, seen=None):
+	if seen is None:
+		seen = set()
+
+	if value is None or isinstance(value, (bool, int, long, float, str, unicode)):
+		digest.update("%s:%r;" % (type(value).__name__, value))
+	elif isinstance(value, np.ndarray):
+		digest.update("ndarray:%s:%s;" % (value.dtype.str, value.shape))
+		digest.update(np.ascontiguousarray(value).tobytes())
+	elif isinstance(value, np.generic):
+		hashValue(digest, value.item(), seen)
+	elif isinstance(value, (list, tuple)):
+		digest.update("%s:%d[" % (type(value).__name__, len(value)))
+		for item in value:
+			hashValue(digest, item, seen)
+		digest.update("]")
+	elif isinstance(value, dict):
+		digest.update("dict:%d{" % len(value))
+		for key in sorted(value):
+			hashValue(digest, key, seen)
+			hashValue(digest, value[key], seen)
+		digest.update("}")
+	elif hasattr(value, "__dict__"):
+		# shared objects, like one material on many spheres, are described once.
+		if id(value) in seen:
+			digest.update("ref:%s;" % type(value).__name__)
+			return
+		seen.add(id(value))
+		digest.update("object:%s.%s{" % (value.__class__.__module__, value.__class__.__name__))
+		hashValue(digest, dict((k, v) for k, v in vars(value).items() if k not in SKIP_ATTRIBUTES), seen)
+		digest.update("}")
+	else:
+		raise TypeError("can't hash %s for the render cache." % type(value).__name__)
+
+
+# the upper case settings of the tracer's class hierarchy and module, like MAX_DEPTH or EPSILON.
+def tracerConstants(tracer):
+	constants = {}
+	for cls in reversed(inspect.getmro(tracer.__class__)):
+		constants.update((k, v) for k, v in vars(cls).items() if k.isupper())
+	module = sys.modules[tracer.__class__.__module__]
+	constants.update((k, v) for k, v in vars(module).items() if k.isupper() and isinstance(v, (int, float)))
+	return constants
+
+
+# key of the image a tracer renders of a scene at a resolution: a hash of the geometry, the
+# materials, the lights, the screen, the tracer with its settings and the resolution.
+def renderKey(scene, tracer, width, height):
+	digest = hashlib.sha1()
+	hashValue(digest, CACHE_VERSION)
+	hashValue(digest, scene)
+	hashValue(digest, tracer.__class__.__name__)
+	hashValue(digest, tracer)
+	hashValue(digest, tracerConstants(tracer))
+	hashValue(digest, (width, height))
+	return digest.hexdigest()
+
+
+# content addressed store of rendered images on disk. every key has a directory holding the
+# finished tiles as compressed float arrays, tile_x0_y0_x1_y1.npz, and frame.npz once the
+# whole image is done, which replaces the tiles. reading an entry updates its time, the least
+# recently used entries are removed when the directory grows beyond maxBytes.
+class RenderCache:
+	def __init__(self, directory, maxBytes=CACHE_SIZE):
+		self.directory = directory
+		self.maxBytes = maxBytes
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+
+	def __entry(self, key):
+		return os.path.join(self.directory, key)
+
+	def __touch(self, key):
+		if os.path.isdir(self.__entry(key)):
+			os.utime(self.__entry(key), None)
+
+	# writes to a temporary file first, so an interrupted write leaves no broken entry.
+	def __store(self, key, name, colors):
+		entry = self.__entry(key)
+		if not os.path.isdir(entry):
+			os.makedirs(entry)
+		handle, path = tempfile.mkstemp(suffix=".npz", dir=entry)
+		with os.fdopen(handle, "wb") as f:
+			np.savez_compressed(f, colors=np.asarray(colors, dtype=np.float32))
+		os.rename(path, os.path.join(entry, name))
+		self.__touch(key)
+
+	def __load(self, path):
+		try:
+			with np.load(path) as data:
+				return data["colors"]
+		except (IOError, ValueError, KeyError):
+			return None
+
+	# the whole (height, width, 3) image, None if it is not cached.
+	def loadFrame(self, key):
+		image = self.__load(os.path.join(self.__entry(key), "frame.npz"))
+		if image is not None:
+			self.__touch(key)
+		return image
+
+	def storeFrame(self, key, image):
+		self.__store(key, "frame.npz", image)
+		for name in os.listdir(self.__entry(key)):
+			if name.startswith("tile_"):
+				os.remove(os.path.join(self.__entry(key), name))
+		self.evict()
+
+	# {(x0, y0, x1, y1): (y1 - y0, x1 - x0, 3) colors} of the finished tiles of the key.
+	def loadTiles(self, key):
+		entry = self.__entry(key)
+		if not os.path.isdir(entry):
+			return {}
+
+		tiles = {}
+		for name in os.listdir(entry):
+			if name.startswith("tile_") and name.endswith(".npz"):
+				tile = tuple(int(c) for c in name[5:-4].split("_"))
+				colors = self.__load(os.path.join(entry, name))
+				if colors is not None and colors.shape == (tile[3] - tile[1], tile[2] - tile[0], 3):
+					tiles[tile] = colors
+		self.__touch(key)
+		return tiles
+
+	def storeTile(self, key, tile, colors):
+		self.__store(key, "tile_%d_%d_%d_%d.npz" % tuple(tile), colors)
+
+	def size(self, key=None):
+		entries = [key] if key is not None else os.listdir(self.directory)
+		total = 0
+		for entry in entries:
+			path = self.__entry(entry)
+			if os.path.isdir(path):
+				total += sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+		return total
+
+	# removes the least recently used entries until the cache fits into maxBytes.
+	def evict(self):
+		entries = [e for e in os.listdir(self.directory) if os.path.isdir(self.__entry(e))]
+		entries.sort(key=lambda e: os.path.getmtime(self.__entry(e)))
+		total = sum(self.size(e) for e in entries)
+		while entries and total > self.maxBytes:
+			entry = entries.pop(0)
+			total -= self.size(entry)
+			shutil.rmtree(self.__entry(entry))
+
+	def clear(self):
+		for entry in os.listdir(self.directory):
+			if os.path.isdir(self.__entry(entry)):
+				shutil.rmtree(self.__entry(entry))
+
+
+if __name__ == "__main__":
+	from geometry import Sphere
+	from material import Material, Color
+	from scene import Screen, Scene
+	from tracer import RecursiveRayTracer
+
+	def scene(radius):
+		return Scene([0, 0, -5], Screen([0, 0, -1], [0, 0, -1], 10, 10, 1.0), [Sphere([0, 0, 2], radius, Material(Color(100, 100, 100), 1, 0, 0.1))], [])
+
+	tracer = RecursiveRayTracer([0, 0, -5])
+	key = renderKey(scene(1), tracer, 10, 10)
+	assert key == renderKey(scene(1), RecursiveRayTracer([0, 0, -5]), 10, 10)
+	assert key != renderKey(scene(1.5), tracer, 10, 10)
+	assert key != renderKey(scene(1), tracer, 10, 20)
+
+	directory = tempfile.mkdtemp()
+	try:
+		cache = RenderCache(directory)
+		tile = np.arange(12, dtype=np.float32).reshape(2, 2, 3)
+		cache.storeTile(key, (0, 0, 2, 2), tile)
+		assert np.array_equal(cache.loadTiles(key)[(0, 0, 2, 2)], tile)
+		assert cache.loadFrame(key) is None
+
+		cache.storeFrame(key, np.zeros((10, 10, 3)))
+		assert cache.loadTiles(key) == {} and cache.loadFrame(key).shape == (10, 10, 3)
+
+		os.utime(os.path.join(directory, key), (time.time() - 60, time.time() - 60))
+		cache.maxBytes = cache.size(key) * 3 / 2
+		cache.storeFrame("other", np.zeros((10, 10, 3)))
+		assert cache.loadFrame(key) is None and cache.loadFrame("other") is not None
+	finally:
+		shutil.rmtree(directory)
+	print "cache ok"
@@ -0,0 +1,143 @@
+#!/usr/bin/python
+
+import os
+
+import numpy as np
+
+# finished tiles after which a render saves its checkpoint again.
+CHECKPOINT_EVERY = 64
+
+
+# the state of an unfinished render in one compressed numpy file, so a render that was
+# interrupted or killed can be resumed where it was: the image so far (with the sample counts
+# and variances of a progressive render), the number of finished passes, a bitmap of the tiles
+# of the current pass and one of those of them that are finished. the random numbers need no
+# state of their own, every tile seeds them from the base seed of the tracer, the pass and its
+# corner, so the seed is only kept to tell renders apart.
+# tiles are numbered in the order they were given to begin, the renderer sorts them itself.
+# the file is written next to its final name and renamed, a render killed while it is saved
+# leaves the checkpoint before.
+class Checkpoint:
+	def __init__(self, fileName, every=CHECKPOINT_EVERY):
+		self.fileName = fileName
+		self.every = every
+		self.begin(None, [])
+
+	# starts the bookkeeping of a render of the given tiles, key tells renders apart.
+	def begin(self, key, tiles, seed=0):
+		self.key = key
+		self.seed = seed
+		self.tiles = [tuple(t) for t in tiles]
+		self.passes = 0
+		self.passTiles = list(self.tiles)
+		self.finished = set()
+		self.unsaved = 0
+
+	def addTile(self, tile):
+		self.finished.add(tuple(tile[:4]))
+		self.unsaved += 1
+
+	# the pass is finished, the next one renders passTiles.
+	def nextPass(self, passTiles):
+		self.passes += 1
+		self.passTiles = [tuple(t) for t in passTiles]
+		self.finished = set()
+
+	# if enough tiles were finished since the last save.
+	def due(self):
+		return self.unsaved >= self.every
+
+	def save(self, framebuffer):
+		passTiles = set(self.passTiles)
+		state = {
+			"key": np.array(self.key),
+			"seed": np.array(self.seed),
+			"passes": np.array(self.passes),
+			"tiles": np.array(self.tiles, dtype=np.int32).reshape(-1, 4),
+			"passTiles": np.array([t in passTiles for t in self.tiles], dtype=bool),
+			"finished": np.array([t in self.finished for t in self.tiles], dtype=bool),
+			"image": framebuffer.image(),
+		}
+		if hasattr(framebuffer, "counts"):
+			state["counts"], state["m2"] = framebuffer.counts, framebuffer.m2
+
+		partial = self.fileName + ".part"
+		with open(partial, "wb") as f:
+			np.savez_compressed(f, **state)
+		os.rename(partial, self.fileName)
+		self.unsaved = 0
+
+	# restores the saved render into framebuffer, after begin with the same key and tiles.
+	# returns False if there is no checkpoint, raises ValueError if it is of another render.
+	def resume(self, framebuffer):
+		if not os.path.exists(self.fileName):
+			return False
+
+		with np.load(self.fileName) as data:
+			if str(data["key"]) != self.key or int(data["seed"]) != self.seed or map(tuple, data["tiles"].tolist()) != self.tiles:
+				raise ValueError("%s is the checkpoint of another render." % self.fileName)
+			if ("counts" in data) != hasattr(framebuffer, "counts") or data["image"].shape != framebuffer.array.shape:
+				raise ValueError("%s is the checkpoint of another render." % self.fileName)
+
+			framebuffer.array[:] = data["image"]
+			if hasattr(framebuffer, "counts"):
+				framebuffer.counts[:] = data["counts"]
+				framebuffer.m2[:] = data["m2"]
+			self.passes = int(data["passes"])
+			self.passTiles = [t for t, flag in zip(self.tiles, data["passTiles"]) if flag]
+			self.finished = set(t for t, flag in zip(self.tiles, data["finished"]) if flag)
+		self.unsaved = 0
+		return True
+
+	# the render is done, its checkpoint is not needed anymore.
+	def remove(self):
+		if os.path.exists(self.fileName):
+			os.remove(self.fileName)
+
+
+if __name__ == "__main__":
+	import shutil, signal, tempfile, threading
+	from PIL import Image
+
+	from filerenderer import FileRenderer
+	from ray import referenceScene, makeTracer
+
+	# renders that are interrupted by ctrl-c at some point and resumed until they finish have
+	# to give the same image as a render that was not interrupted.
+	directory = tempfile.mkdtemp()
+	try:
+		for name, progressive in [("Recursive", False), ("PathTracing", True)]:
+			images = []
+			for interrupt in [None, 0.3, 0.6]:
+				fileName = os.path.join(directory, "%s_%s" % (name, interrupt))
+				checkpoint = Checkpoint(fileName + "_checkpoint.npz", every=4)
+				resume, attempts = False, 0
+				while True:
+					scene = referenceScene(48, 48)
+					renderer = FileRenderer(48, 48, makeTracer(name, scene), scene, processes=2, tileSize=8, checkpoint=checkpoint)
+					timer = None
+					if interrupt is not None and attempts < 3:
+						timer = threading.Timer(interrupt, os.kill, (os.getpid(), signal.SIGINT))
+						timer.start()
+					try:
+						if progressive:
+							renderer.renderProgressive(fileName, maxSamples=4, resume=resume)
+						else:
+							renderer.render(fileName, resume=resume)
+					except KeyboardInterrupt:
+						pass
+					finally:
+						if timer is not None:
+							timer.cancel()
+						renderer.close()
+					attempts += 1
+					resume = True
+					if not os.path.exists(checkpoint.fileName) and os.path.exists(fileName + ".png"):
+						break
+				images.append(np.asarray(Image.open(fileName + ".png")))
+				print "%s interrupted after %ss: %d attempts" % (name, interrupt, attempts)
+			for image in images[1:]:
+				assert np.array_equal(image, images[0]), name
+	finally:
+		shutil.rmtree(directory)
+	print "checkpoint ok"
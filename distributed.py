@@ -0,0 +1,552 @@
+#!/usr/bin/python
+
+import collections
+import multiprocessing
+import pickle
+import Queue
+import signal
+import socket
+import threading
+import time
+from multiprocessing.connection import Client, Listener, AuthenticationError
+
+from processes import TileWorker, WorkersLost, WORKER_CONFIG, configToken
+
+DEFAULT_PORT = 25252
+
+# seconds between the heartbeats of a worker, and of silence after which a worker is dead.
+HEARTBEAT_INTERVAL = 1.0
+HEARTBEAT_TIMEOUT = 10.0
+
+# tiles a worker is sent ahead, so it has the next one while the last one is on the way back.
+TILES_IN_FLIGHT = 2
+
+
+# parses HOST:PORT, PORT or HOST into an address, host is the one of a missing HOST. the
+# coordinator only listens on other interfaces than the loopback one if they are named.
+def parseAddress(text, host="127.0.0.1"):
+	if ":" in text:
+		name, port = text.rsplit(":", 1)
+		return name or host, int(port)
+	if text.isdigit():
+		return host, int(text)
+	return text, DEFAULT_PORT
+
+
+# the framebuffer of a node worker: TileWorker.renderTile writes into it like into a framebuffer,
+# the writes are sent to the coordinator, which makes them on its framebuffer. the pixels of
+# a progressive tile that still need samples come with the tile. the framebuffers of an
+# animation are a list of captures, index is the one of the framebuffer they stand for.
+class TileCapture:
+	def __init__(self, index=None):
+		self.index = index
+		self.writes = []
+		self.mask = None
+
+	def write(self, x0, y0, x1, y1, colors, mask=None):
+		self.writes.append((self.index, "write", (x0, y0, x1, y1, colors, mask)))
+
+	def add(self, x0, y0, x1, y1, colors, mask=None):
+		self.writes.append((self.index, "add", (x0, y0, x1, y1, colors, mask)))
+
+	def active(self, x0=0, y0=0, x1=None, y1=None):
+		return self.mask
+
+
+def captureFor(framebuffer):
+	if isinstance(framebuffer, list):
+		return [TileCapture(i) for i in range(len(framebuffer))]
+	return None if framebuffer is None else TileCapture()
+
+
+# a TileWorker on another machine, or another process of this one: connects to a coordinator
+# and renders the tiles it is sent until the coordinator closes the connection. the settings
+# arrive as pickles on the same connection, before the tiles that need them. one thread
+# receives, cancelled jobs are known at once while a tile is traced, one sends heartbeats,
+# so the coordinator can tell a busy worker from a dead one.
+class NodeWorker(TileWorker):
+	def __init__(self, address, authkey):
+		TileWorker.__init__(self, 0, {}, None, None, None, multiprocessing.RawValue("i", 0))
+		self.address = address
+		self.authkey = authkey
+
+	def run(self):
+		signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+		self.connection = self.connect()
+		if self.connection is None:
+			return
+		self.sendLock = threading.Lock()
+		self.messages = Queue.Queue()
+		for target in [self.receive, self.beat]:
+			thread = threading.Thread(target=target)
+			thread.daemon = True
+			thread.start()
+
+		try:
+			for message in iter(self.messages.get, None):
+				if message[0] == "config":
+					self.version = message[1]
+					self.configure(pickle.loads(message[2]))
+				elif message[0] == "tile":
+					self.send(self.render(*message[1:]))
+		except (IOError, EOFError):
+			pass
+		self.connection.close()
+
+	# waits for the coordinator, the nodes may be started before it. None if the keys differ.
+	def connect(self):
+		while True:
+			try:
+				return Client(self.address, authkey=self.authkey)
+			except socket.error:
+				time.sleep(HEARTBEAT_INTERVAL)
+			except (AuthenticationError, EOFError):
+				print "The coordinator at %s:%d has another key." % self.address
+				return None
+
+	def send(self, message):
+		with self.sendLock:
+			self.connection.send(message)
+
+	def receive(self):
+		try:
+			while True:
+				message = self.connection.recv()
+				if message[0] == "cancel":
+					self.cancelled.value = max(self.cancelled.value, message[1])
+				elif message[0] == "stop":
+					break
+				else:
+					self.messages.put(message)
+		except (IOError, EOFError):
+			pass
+		self.messages.put(None)
+
+	def beat(self):
+		try:
+			while True:
+				time.sleep(HEARTBEAT_INTERVAL)
+				self.send(("heartbeat",))
+		except (IOError, EOFError):
+			pass
+
+	def render(self, job, tile, mask):
+		captures = self.framebuffer if isinstance(self.framebuffer, list) else [self.framebuffer]
+		for capture in captures:
+			capture.writes, capture.mask = [], mask
+		data = self.processTile(job, tile)
+		return ("tile", data, sum([capture.writes for capture in captures], []))
+
+
+# the data queue of a coordinator: while it waits for tiles, it raises WorkersLost when the
+# coordinator had no workers for too long.
+class ResultQueue(Queue.Queue):
+	def __init__(self, coordinator):
+		Queue.Queue.__init__(self)
+		self.coordinator = coordinator
+
+	def get(self, block=True, timeout=None):
+		try:
+			return Queue.Queue.get(self, block, timeout)
+		except Queue.Empty:
+			self.coordinator.checkWorkers()
+			raise
+
+
+# a worker as the coordinator sees it: its tiles in flight, in the order they were sent.
+class RemoteWorker:
+	def __init__(self, workerId, connection):
+		self.workerId = workerId
+		self.connection = connection
+		self.tiles = []
+		self.rendered = 0
+		self.alive = True
+		self.lastSeen = time.time()
+
+
+# renders the tiles of a RenderPool with NodeWorkers that connect over TCP instead of local
+# render processes, it has the interface of a processes.RenderService and is passed to a
+# RenderPool or FileRenderer as their service. the settings are sent once to every worker when
+# it connects, a job only sends what differs from the job before, like a RenderService does.
+# the framebuffers stay here: the workers send the colors of their tiles back and they are
+# written when they arrive, the data queue then reports the tile like a RenderService does.
+# workers that close their connection or miss their heartbeats for heartbeatTimeout seconds
+# are dropped, their tiles are sent to the other workers again. the tracers seed every tile
+# from its pass and corner, so which worker renders a tile doesn't change the image.
+# workers can connect at any time, tiles wait until there is a worker for them. once all
+# workers are gone for heartbeatTimeout seconds, the data queue raises WorkersLost instead.
+# the messages are pickles, which run code when they are loaded, so there is no default key:
+# workers and coordinator prove to each other that they know authkey before anything is sent.
+class Coordinator:
+	def __init__(self, address, authkey, heartbeatTimeout=HEARTBEAT_TIMEOUT, **config):
+		if not authkey:
+			raise ValueError("the coordinator needs a key that is shared with the workers.")
+		self.listener = Listener(address, authkey=authkey)
+		self.address = self.listener.address
+		self.authkey = authkey
+		self.heartbeatTimeout = heartbeatTimeout
+
+		self.dataQueue = ResultQueue(self)
+		self.cancelled = multiprocessing.RawValue("i", 0)
+		self.workers = []
+		self.threads = []
+		# (job, version, tile) of the tiles that wait for a worker.
+		self.pending = collections.deque()
+		# (framebuffer, progressive) of the jobs whose tiles may still arrive.
+		self.jobConfig = {}
+		self.requeued = 0
+		# when the last worker went away, None while there are workers.
+		self.lostSince = None
+		self.closed = False
+		self.lock = threading.Condition()
+
+		self.config = dict(WORKER_CONFIG, **config)
+		self.tokens = dict((key, configToken(key, value)) for key, value in self.config.items())
+		self.version = 0
+		self.jobs = 0
+		self.__snapshot()
+
+		self.acceptor = threading.Thread(target=self.__accept)
+		self.acceptor.daemon = True
+		self.acceptor.start()
+
+	# what a worker that connects now is sent: all settings, with captures for the framebuffers.
+	def __snapshot(self):
+		config = dict(self.config, framebuffer=captureFor(self.config["framebuffer"]))
+		self.configMessage = ("config", self.version, pickle.dumps(config, pickle.HIGHEST_PROTOCOL))
+
+	# waits until count workers are connected and alive, False after timeout seconds.
+	def waitForWorkers(self, count, timeout=None):
+		end = None if timeout is None else time.time() + timeout
+		with self.lock:
+			while len([w for w in self.workers if w.alive]) < count:
+				if end is not None and time.time() >= end:
+					return False
+				self.lock.wait(0.1)
+		return True
+
+	def newJob(self, **config):
+		with self.lock:
+			changes = dict((key, value) for key, value in config.items() if configToken(key, value) != self.tokens[key])
+			if changes:
+				self.version += 1
+				self.config.update(changes)
+				self.tokens.update((key, configToken(key, value)) for key, value in changes.items())
+				if "framebuffer" in changes:
+					changes["framebuffer"] = captureFor(changes["framebuffer"])
+				message = ("config", self.version, pickle.dumps(changes, pickle.HIGHEST_PROTOCOL))
+				for worker in self.workers:
+					self.__send(worker, message)
+				self.__snapshot()
+
+			self.jobs += 1
+			self.jobConfig[self.jobs] = self.config["framebuffer"], self.config["progressive"]
+			return self.jobs, self.version
+
+	def submit(self, job, version, tiles):
+		with self.lock:
+			self.pending.extend((job, version, tuple(tile)) for tile in tiles)
+			self.__dispatch()
+
+	def cancel(self, job):
+		with self.lock:
+			self.cancelled.value = max(self.cancelled.value, job)
+			for worker in self.workers:
+				self.__send(worker, ("cancel", job))
+			for j in [j for j in self.jobConfig if j <= job]:
+				del self.jobConfig[j]
+			self.__dispatch()
+
+	# raises WorkersLost if tiles are left and there were no workers for heartbeatTimeout seconds.
+	def checkWorkers(self):
+		with self.lock:
+			if self.__lost():
+				raise WorkersLost("no render node for %ds, %d tiles are left." % (self.heartbeatTimeout, len(self.pending)))
+
+	def __lost(self):
+		return self.pending and self.lostSince is not None and time.time() - self.lostSince > self.heartbeatTimeout
+
+	# waits for the tiles submitted, then lets the workers go. tiles without workers to render
+	# them are given up.
+	def close(self):
+		with self.lock:
+			while self.pending or any(worker.tiles for worker in self.workers if worker.alive):
+				if self.__lost():
+					print "No render node for %ds, %d tiles are not rendered." % (self.heartbeatTimeout, len(self.pending))
+					break
+				self.lock.wait(0.1)
+			for worker in self.workers:
+				self.__send(worker, ("stop",))
+		self.__stop()
+
+	# drops the workers right away, without waiting for their tiles.
+	def terminate(self):
+		self.__stop()
+
+	def __stop(self):
+		with self.lock:
+			self.closed = True
+		# wakes the acceptor up.
+		try:
+			Client(self.address, authkey=self.authkey).close()
+		except (socket.error, EOFError, AuthenticationError):
+			pass
+		self.acceptor.join()
+		self.listener.close()
+		for thread in self.threads:
+			thread.join()
+
+	def __accept(self):
+		while True:
+			try:
+				connection = self.listener.accept()
+			except (socket.error, EOFError, AuthenticationError):
+				if self.closed:
+					break
+				continue
+
+			with self.lock:
+				if self.closed:
+					connection.close()
+					break
+				worker = RemoteWorker(len(self.workers), connection)
+				self.workers.append(worker)
+				self.lostSince = None
+				self.__send(worker, self.configMessage)
+				thread = threading.Thread(target=self.__serve, args=(worker,))
+				thread.daemon = True
+				self.threads.append(thread)
+				thread.start()
+				self.__dispatch()
+				self.lock.notify_all()
+
+	# receives the tiles and heartbeats of a worker until it is gone.
+	def __serve(self, worker):
+		connection = worker.connection
+		try:
+			while not self.closed:
+				if not connection.poll(HEARTBEAT_INTERVAL):
+					if time.time() - worker.lastSeen > self.heartbeatTimeout:
+						print "Worker %d missed its heartbeats." % worker.workerId
+						break
+					continue
+				message = connection.recv()
+				worker.lastSeen = time.time()
+				if message[0] == "tile":
+					self.__finish(worker, message[1], message[2])
+		except (IOError, EOFError):
+			pass
+
+		with self.lock:
+			self.__drop(worker)
+		connection.close()
+
+	# writes the colors of the tile into the framebuffer of its job, then reports the tile.
+	def __finish(self, worker, data, writes):
+		tile, rays, record, frame, job, workerId, busy, rendered, statistics = data
+		with self.lock:
+			for i, (j, version, item) in enumerate(worker.tiles):
+				if j == job and item[:4] == tuple(tile) and (frame is None or item[5] == frame):
+					del worker.tiles[i]
+					break
+
+			# the job was cancelled while the tile was traced, the job after it may have
+			# the same pixels already.
+			if job <= self.cancelled.value:
+				rendered = False
+			if rendered:
+				framebuffer = self.jobConfig[job][0]
+				for index, method, args in writes:
+					getattr(framebuffer if index is None else framebuffer[index], method)(*args)
+				worker.rendered += 1
+			self.dataQueue.put((tile, rays, record, frame, job, worker.workerId, busy, rendered, statistics))
+			self.__dispatch()
+			self.lock.notify_all()
+
+	# a worker is gone, its tiles are sent to the others again, in the order they came.
+	def __drop(self, worker):
+		if not worker.alive:
+			return
+		worker.alive = False
+		if worker.tiles:
+			print "Worker %d is gone, rendering its %d tiles again." % (worker.workerId, len(worker.tiles))
+		self.__requeue(worker)
+		self.__dispatch()
+		self.lock.notify_all()
+
+	def __send(self, worker, message):
+		if not worker.alive:
+			return False
+		try:
+			worker.connection.send(message)
+			return True
+		except (IOError, EOFError, socket.error):
+			# the thread of the worker notices as well and drops it.
+			worker.alive = False
+			self.__requeue(worker)
+			return False
+
+	def __requeue(self, worker):
+		self.requeued += len(worker.tiles)
+		self.pending.extendleft(reversed(worker.tiles))
+		worker.tiles = []
+		if not any(w.alive for w in self.workers):
+			self.lostSince = time.time()
+
+	# tiles of cancelled jobs are reported without sending them, the others fill the workers
+	# up to TILES_IN_FLIGHT tiles, the workers with the fewest tiles first.
+	def __dispatch(self):
+		while self.pending:
+			job, version, tile = self.pending[0]
+			if job <= self.cancelled.value:
+				self.pending.popleft()
+				frame = tile[5] if len(tile) > 5 else None
+				self.dataQueue.put((tile[:4], 0, None, frame, job, -1, 0.0, False, None))
+				continue
+
+			workers = [w for w in self.workers if w.alive and len(w.tiles) < TILES_IN_FLIGHT]
+			if not workers:
+				break
+			worker = min(workers, key=lambda w: len(w.tiles))
+			self.pending.popleft()
+			if self.__send(worker, ("tile", job, tile, self.__mask(job, tile))):
+				worker.tiles.append((job, version, tile))
+			else:
+				self.pending.appendleft((job, version, tile))
+		self.lock.notify_all()
+
+	# the pixels of a progressive tile that still need samples, the worker doesn't have them.
+	def __mask(self, job, tile):
+		framebuffer, progressive = self.jobConfig[job]
+		if not progressive:
+			return None
+		if isinstance(framebuffer, list):
+			framebuffer = framebuffer[tile[5] % len(framebuffer)]
+		return framebuffer.active(*tile[:4])
+
+
+# starts processes workers that connect to the coordinator at address, until it is done.
+def runNode(address, authkey, processes=None):
+	workers = [NodeWorker(address, authkey) for i in range(processes or multiprocessing.cpu_count())]
+	for worker in workers:
+		worker.start()
+	try:
+		for worker in workers:
+			worker.join()
+	except KeyboardInterrupt:
+		for worker in workers:
+			worker.terminate()
+			worker.join()
+
+
+if __name__ == "__main__":
+	import sys
+
+	if len(sys.argv) > 1 and sys.argv[1] == "worker":
+		import argparse
+
+		parser = argparse.ArgumentParser(description="Render node: renders the tiles of a coordinator (ray.py -r ... --listen).")
+		parser.add_argument("command", choices=["worker"])
+		parser.add_argument("address", help="HOST:PORT of the coordinator.")
+		parser.add_argument("--processes", type=int, help="number of render processes, defaults to the number of cpus.")
+		parser.add_argument("--authkey", help="key shared with the coordinator.", required=True)
+		args = parser.parse_args()
+		runNode(parseAddress(args.address), args.authkey, args.processes)
+		exit(0)
+
+	import os, shutil, tempfile
+	import numpy as np
+	from PIL import Image
+
+	from checkpoint import Checkpoint
+	from filerenderer import FileRenderer
+	from ray import referenceScene, makeTracer
+
+	def startNodes(coordinator, count):
+		nodes = [NodeWorker(coordinator.address, "test") for i in range(count)]
+		for node in nodes:
+			node.start()
+		assert coordinator.waitForWorkers(count, 30)
+		return nodes
+
+	def stopNodes(nodes):
+		for node in nodes:
+			if node.is_alive():
+				os.kill(node.pid, signal.SIGKILL)
+			node.join()
+
+	# kills the nodes and stops others once the first tiles are in.
+	def sabotage(coordinator, kill, stop=()):
+		def run():
+			while sum(w.rendered for w in coordinator.workers) < 2:
+				if coordinator.closed:
+					return
+				time.sleep(0.01)
+			for node in kill:
+				os.kill(node.pid, signal.SIGKILL)
+			for node in stop:
+				os.kill(node.pid, signal.SIGSTOP)
+		thread = threading.Thread(target=run)
+		thread.start()
+		return thread
+
+	# renders on several localhost workers have to give the same image as local render
+	# processes, also when a worker is killed while it renders and when one hangs.
+	directory = tempfile.mkdtemp()
+	try:
+		expected = {}
+		for name, progressive in [("Recursive", False), ("PathTracing", True)]:
+			scene = referenceScene(40, 40)
+			local = FileRenderer(40, 40, makeTracer(name, scene), scene, processes=2, tileSize=8)
+			fileName = os.path.join(directory, name + "_local")
+			if progressive:
+				local.renderProgressive(fileName, maxSamples=3)
+			else:
+				local.render(fileName)
+			local.close()
+			expected[name] = np.asarray(Image.open(fileName + ".png"))
+
+			coordinator = Coordinator(("127.0.0.1", 0), "test", heartbeatTimeout=3.0)
+			nodes = startNodes(coordinator, 3)
+			thread = sabotage(coordinator, nodes[:1], nodes[1:2])
+
+			scene = referenceScene(40, 40)
+			remote = FileRenderer(40, 40, makeTracer(name, scene), scene, tileSize=8, service=coordinator)
+			fileName = os.path.join(directory, name + "_remote")
+			try:
+				if progressive:
+					remote.renderProgressive(fileName, maxSamples=3)
+				else:
+					remote.render(fileName)
+			finally:
+				remote.close()
+				thread.join()
+				stopNodes(nodes)
+
+			print "%s: %d tiles rendered again, tiles per worker %s" % (name, coordinator.requeued, [w.rendered for w in coordinator.workers])
+			assert coordinator.requeued > 0
+			assert np.array_equal(np.asarray(Image.open(fileName + ".png")), expected[name]), name
+
+		# without workers left the render stops and saves its checkpoint, new ones finish it.
+		fileName = os.path.join(directory, "lost")
+		checkpoint = Checkpoint(fileName + "_checkpoint.npz", every=1)
+		for resume in [False, True]:
+			coordinator = Coordinator(("127.0.0.1", 0), "test", heartbeatTimeout=1.0)
+			nodes = startNodes(coordinator, 2)
+			thread = sabotage(coordinator, nodes if not resume else [])
+			scene = referenceScene(40, 40)
+			remote = FileRenderer(40, 40, makeTracer("Recursive", scene), scene, tileSize=8, checkpoint=checkpoint, service=coordinator)
+			try:
+				remote.render(fileName, resume)
+				assert resume
+			except WorkersLost:
+				assert not resume and os.path.exists(checkpoint.fileName)
+			finally:
+				remote.close()
+				thread.join()
+				stopNodes(nodes)
+		assert np.array_equal(np.asarray(Image.open(fileName + ".png")), expected["Recursive"])
+	finally:
+		shutil.rmtree(directory)
+	print "distributed ok"
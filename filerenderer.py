@@ -1,39 +1,233 @@
-from PIL import Image, ImageDraw
+import numpy as np
 from geometry import Ray
+from imagefile import ImageOutput
 
 class FileRenderer():
-	RENDER_PROCESSES = 4
+	# cache is an optional RenderCache, finished tiles and frames are stored in it and taken
+	# from it instead of rendering them again. with stats the rays, intersection tests and tile
+	# times are counted and summed up after the render, statsFile is where they are dumped to
+	# as statsFile.json and statsFile_heatmap.png. output is the imagefile.ImageOutput the image
+	# is saved with, a PNG of the clamped radiance by default. with a checkpoint.Checkpoint the
+	# state of the render is saved every checkpoint.every tiles and on ctrl-c, a render with
+	# resume continues from there. it is removed when the image is finished. service renders the
+	# tiles instead of local render processes, e.g. a distributed.Coordinator, it is closed with
+	# the renderer.
+	def __init__(self, width, height, tracer, scene, processes=None, tileSize=None, tileOrder="spiral", cache=None, stats=False, statsFile=None, output=None, checkpoint=None, service=None):
+		from processes import TILE_SIZE
 
-	def __init__(self, width, height, tracer, scene):
 		self.width = width
 		self.height = height
 		self.tracer = tracer
 		self.scene = scene
+		self.processes = processes
+		self.tileSize = tileSize or TILE_SIZE
+		self.tileOrder = tileOrder
+		self.cache = cache
+		self.stats = stats or statsFile is not None
+		self.statsFile = statsFile
+		self.output = output or ImageOutput()
+		self.checkpoint = checkpoint
+		self.service = service
 
-	def render(self, fileName):
-		import sys, time
-		img = Image.new("RGB", (self.width, self.height))
+	# the render processes are started by the first render and kept for the next ones.
+	def __service(self):
+		from processes import RenderService
 
-		from multiprocessing import Queue
-		finishedQueue = Queue()
-		dataQueue = Queue() # in this case yolo.
+		if self.service is None:
+			self.service = RenderService(self.processes, tracer=self.tracer, scene=self.scene)
+		return self.service
 
-		from processes import BlockProcess
+	def close(self):
+		if self.service is not None:
+			self.service.close()
+			self.service = None
 
-		threads = BlockProcess.forCount(self.RENDER_PROCESSES, self.width, self.height, self.tracer, self.scene, dataQueue, finishedQueue)
+	def render(self, fileName, resume=False):
+		import time
+
+		from cache import renderKey
+		from framebuffer import Framebuffer
+		from processes import RenderPool, WorkersLost, makeTiles, estimateTileCosts
+
+		startTime = time.time()
+		framebuffer = Framebuffer(self.width, self.height)
+		statistics = self.__statistics()
+
+		key, cached, finished = None, {}, set()
+		if self.cache is not None or self.checkpoint is not None:
+			key = renderKey(self.scene, self.tracer, self.width, self.height)
+		rows = makeTiles(self.width, self.height, self.tileSize, "rows")
+		if self.checkpoint is not None:
+			self.checkpoint.begin(key, rows, self.tracer.baseSeed)
+			if resume and self.__resume(framebuffer):
+				finished = set(self.checkpoint.finished)
+
+		if self.cache is not None:
+			image = self.cache.loadFrame(key)
+			if image is not None and image.shape == framebuffer.array.shape:
+				print "Found the frame in the cache: %s" % key
+				framebuffer.array[:] = image
+				self.__save(framebuffer, fileName)
+				if statistics is not None:
+					statistics.count("cached frames")
+					self.__report(statistics)
+				return
+
+			# tiles of an earlier, interrupted render.
+			cached = self.cache.loadTiles(key)
+			for (x0, y0, x1, y1), colors in cached.items():
+				framebuffer.write(x0, y0, x1, y1, colors)
+
+		bvh = self.scene.bvh.statistics()
+		print "BVH: %d objects, %d nodes, depth %d, built in %.3fs" % (len(self.scene.bvh), bvh["nodes"], bvh["depth"], bvh["buildTime"])
+
+		costs = None
+		if self.tileOrder == "cost":
+			print "Estimating tile costs..."
+			remaining = [t for t in rows if t not in cached and t not in finished]
+			estimates = dict(zip(remaining, estimateTileCosts(remaining, self.tracer, self.scene)))
+			costs = [estimates.get(t, 0) for t in rows]
+		tiles = [t for t in makeTiles(self.width, self.height, self.tileSize, self.tileOrder, costs) if t not in cached and t not in finished]
+		if statistics is not None and self.cache is not None:
+			statistics.count("cached tiles", len(cached))
+			statistics.count("cache misses", len(tiles))
+
+		pool = RenderPool(self.tracer, self.scene, framebuffer, service=self.__service(), statistics=statistics)
+
+		print "Starting %d Processes for %d tiles, %d tiles from the cache..." % (len(pool.workers), len(tiles), len(cached))
+		pool.start(tiles)
+
+		try:
+			rays = self.__waitForTiles(pool, startTime, framebuffer, sum((x1 - x0) * (y1 - y0) for x0, y0, x1, y1 in tiles), key if self.cache is not None else None)
+		except (KeyboardInterrupt, WorkersLost):
+			self.__saveCheckpoint(framebuffer)
+			self.service.terminate()
+			self.service = None
+			raise
+
+		print "Saving to file..."
+		self.__save(framebuffer, fileName)
+		if self.cache is not None:
+			self.cache.storeFrame(key, framebuffer.image())
+		if self.checkpoint is not None:
+			self.checkpoint.remove()
+
+		print "Joining Processes..."
+		pool.join()
+		print pool.utilization()
+		print "Rays cast: %d, %.1f per pixel" % (rays, rays / float(self.width * self.height))
+		self.__report(statistics)
+		print "Finished in %02dm %02ds"%(divmod(time.time()-startTime, 60))
+
+	# renders one sample per pixel per pass into an accumulation buffer, until maxSamples
+	# passes are done, the next pass would exceed timeBudget seconds or ctrl-c is pressed.
+	# with a noise target, only pixels that are not converged yet get samples (adaptive
+	# sampling), so passes get cheaper and rendering stops once every pixel is converged.
+	# the image so far is saved every dumpEvery passes and when rendering stops. checkpoints
+	# are saved at the end of a pass, when the pass is consistent, and on ctrl-c once the tiles
+	# in progress are in, the pass is then continued by a resumed render.
+	def renderProgressive(self, fileName, maxSamples=None, timeBudget=None, dumpEvery=None, noise=None, minSamples=None, resume=False):
+		import time, Queue
+
+		from cache import renderKey
+		from framebuffer import AccumulationBuffer, MIN_SAMPLES
+		from processes import RenderPool, WorkersLost, makeTiles
 
 		startTime = time.time()
+		tiles = makeTiles(self.width, self.height, self.tileSize, self.tileOrder if self.tileOrder != "cost" else "spiral")
+
+		framebuffer = AccumulationBuffer(self.width, self.height, noise, minSamples or MIN_SAMPLES)
+		passes, passTiles, finished = 0, tiles, set()
+		if self.checkpoint is not None:
+			key = "%s-progressive-%r-%r" % (renderKey(self.scene, self.tracer, self.width, self.height), noise, framebuffer.minSamples)
+			self.checkpoint.begin(key, makeTiles(self.width, self.height, self.tileSize, "rows"), self.tracer.baseSeed)
+			if resume and self.__resume(framebuffer):
+				passes = self.checkpoint.passes
+				passTiles = [t for t in tiles if t in set(self.checkpoint.passTiles)]
+				finished = set(self.checkpoint.finished)
+
+		statistics = self.__statistics()
+		pool = RenderPool(self.tracer, self.scene, framebuffer, progressive=True, service=self.__service(), statistics=statistics)
+
+		print "Starting %d Processes for progressive rendering, %d tiles per pass..." % (len(pool.workers), len(tiles))
+		pool.start([t for t in passTiles if t not in finished], close=False, samplePass=passes)
+
+		rays, lost = 0, None
+		try:
+			while True:
+				passStart = time.time()
+				# with a timeout, so ctrl-c gets through while waiting.
+				while len(finished) < len(passTiles):
+					try:
+						tile, tileRays = pool.dataQueue.get(timeout=1)[:2]
+					except Queue.Empty:
+						continue
+					rays += tileRays
+					finished.add(tuple(tile))
+					if self.checkpoint is not None:
+						self.checkpoint.addTile(tile)
+				passes += 1
+				finished = set()
+
+				elapsed = time.time() - startTime
+				passTime = time.time() - passStart
+				active = framebuffer.active()
+				print "Pass %d done after %02dm %02ds, %.2fs per pass, %d pixels active, noise %.4f mean %.4f max" % (
+					(passes,) + divmod(elapsed, 60) + (passTime, np.sum(active)) + framebuffer.noiseLevel())
+
+				if dumpEvery and passes % dumpEvery == 0:
+					self.__save(framebuffer, fileName)
+				if maxSamples is not None and passes >= maxSamples:
+					break
+				if timeBudget is not None and elapsed + passTime > timeBudget:
+					break
+
+				passTiles = [t for t in tiles if np.any(active[t[1]:t[3], t[0]:t[2]])]
+				if not passTiles:
+					print "All pixels converged."
+					break
+				if self.checkpoint is not None:
+					self.checkpoint.nextPass(passTiles)
+					if self.checkpoint.due():
+						self.checkpoint.save(framebuffer)
+				pool.submit(passTiles, passes)
+		except (KeyboardInterrupt, WorkersLost) as e:
+			print "Stopped after %d passes." % passes
+			if isinstance(e, WorkersLost):
+				lost = e
+			# the samples of the tiles finished meanwhile are in the framebuffer already.
+			for tile, tileRays in [data[:2] for data in pool.terminate()]:
+				rays += tileRays
+				if self.checkpoint is not None:
+					self.checkpoint.addTile(tile)
+			self.__saveCheckpoint(framebuffer)
+		else:
+			pool.close()
+			pool.join()
+			if self.checkpoint is not None:
+				self.checkpoint.remove()
 
-		print "Starting Processes..."
-		for t in threads:
-			t.start()
+		print "Saving to file..."
+		self.__save(framebuffer, fileName)
+		counts = framebuffer.counts
+		print "Samples per pixel: %.1f mean, %d min, %d max" % (np.mean(counts), np.min(counts), np.max(counts))
+		print "Noise: %.4f mean, %.4f max" % framebuffer.noiseLevel()
+		print "Rays cast: %d, %.1f per pixel" % (rays, rays / float(self.width * self.height))
+		self.__report(statistics)
+		print "Finished %d passes in %02dm %02ds" % ((passes,) + divmod(time.time() - startTime, 60))
+		if lost is not None:
+			raise lost
 
-		count_finished = 0
-		drawn = 0
-		draw = ImageDraw.Draw(img)
+	# shows the progress until the given number of pixels has been reported, returns the
+	# number of rays cast. with a cache key, every finished tile is stored in the cache, so an
+	# interrupted render can continue from there.
+	def __waitForTiles(self, pool, startTime, framebuffer, pixels, key=None):
+		import sys, time, Queue
 
-		while count_finished < self.RENDER_PROCESSES:
-			progress = dataQueue.qsize() / float(self.width*self.height)
+		# the processes write into the framebuffer and only report finished tiles.
+		drawn, rays = 0, 0
+		while drawn < pixels:
+			progress = drawn / float(pixels)
 
 			timeString = ""
 			if progress > 0:
@@ -44,22 +238,48 @@ class FileRenderer():
 			sys.stdout.write("Progress: %2.2f%% %s          \r" % (progress * 100, timeString))
 			sys.stdout.flush()
 
-			import Queue
 			try:
-				info = finishedQueue.get(timeout=1)
-				if info == "finished.":
-					count_finished = count_finished+1
+				(x0, y0, x1, y1), tileRays = pool.dataQueue.get(timeout=1)[:2]
+				drawn = drawn + (x1 - x0) * (y1 - y0)
+				rays += tileRays
 			except Queue.Empty:
 				continue;
 
-		while not dataQueue.empty():
-			info = dataQueue.get()
-			draw.point(info[0], fill=info[1])
+			if key is not None:
+				self.cache.storeTile(key, (x0, y0, x1, y1), framebuffer.image(x0, y0, x1, y1))
+			if self.checkpoint is not None:
+				self.checkpoint.addTile((x0, y0, x1, y1))
+				if self.checkpoint.due():
+					self.checkpoint.save(framebuffer)
 
-		print "Saving to file..."
-		img.save(fileName + ".png", format="png")
+		return rays
 
-		print "Joining Processes..."
-		for t in threads:
-			t.join()
-		print "Finished in %02dm %02ds"%(divmod(time.time()-startTime, 60))
\ No newline at end of file
+	# restores the checkpoint into the framebuffer, False if there is none.
+	def __resume(self, framebuffer):
+		if not self.checkpoint.resume(framebuffer):
+			print "No checkpoint at %s, starting from the beginning." % self.checkpoint.fileName
+			return False
+		print "Resuming from %s: %d passes and %d tiles done." % (self.checkpoint.fileName, self.checkpoint.passes, len(self.checkpoint.finished))
+		return True
+
+	def __saveCheckpoint(self, framebuffer):
+		if self.checkpoint is None:
+			return
+		self.checkpoint.save(framebuffer)
+		print "Saved the state of the render to %s, continue with --resume." % self.checkpoint.fileName
+
+	def __statistics(self):
+		from stats import RenderStatistics
+
+		return RenderStatistics(self.width, self.height, self.tracer) if self.stats else None
+
+	def __report(self, statistics):
+		if statistics is None:
+			return
+		print statistics.summary()
+		if self.statsFile is not None:
+			statistics.dump(self.statsFile)
+			print "Statistics written to %s.json and %s_heatmap.png" % (self.statsFile, self.statsFile)
+
+	def __save(self, framebuffer, fileName):
+		self.output.save(framebuffer.image(), fileName)
@@ -0,0 +1,146 @@
+import os
+import tempfile
+
+import numpy as np
+
+# weights of the channels for the luminance, whose variance decides when a pixel is converged.
+LUMINANCE = np.array([0.2126, 0.7152, 0.0722], dtype=np.float32)
+
+# samples every pixel gets before its variance is trusted.
+MIN_SAMPLES = 8
+
+# where shared memory lives, /dev/shm is memory backed.
+SHARED_MEMORY = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+
+
+# numpy array in shared memory, which unlike a multiprocessing.RawArray can also be sent to
+# processes that are already running: a file in SHARED_MEMORY that every process maps, pickled
+# as its path. the process that created it removes the file once it is garbage collected.
+class SharedMemory:
+	def __init__(self, size, dtype):
+		handle, self.path = tempfile.mkstemp(prefix="raypy-", dir=SHARED_MEMORY)
+		os.close(handle)
+		self.size = size
+		self.dtype = np.dtype(dtype).str
+		self.owner = os.getpid()
+		self.array = np.memmap(self.path, dtype=self.dtype, mode="w+", shape=(max(size, 1),))[:size]
+
+	def __getstate__(self):
+		return self.path, self.size, self.dtype, self.owner
+
+	def __setstate__(self, state):
+		self.path, self.size, self.dtype, self.owner = state
+		self.array = np.memmap(self.path, dtype=self.dtype, mode="r+", shape=(max(self.size, 1),))[:self.size]
+
+	def __del__(self):
+		if os.getpid() == self.owner and os.path.exists(self.path):
+			os.remove(self.path)
+
+
+# (height, width, 3) float rgb image in shared memory. render processes write finished tiles
+# straight into it and only send the tile coordinates back, instead of one message per pixel.
+class Framebuffer:
+	def __init__(self, width, height):
+		self.width = width
+		self.height = height
+		self.raw = SharedMemory(width * height * 3, np.float32)
+		self.__view()
+
+	def __view(self):
+		self.array = self.raw.array.reshape(self.height, self.width, 3)
+
+	# the numpy view can't be pickled, it is created again on the other side.
+	def __getstate__(self):
+		return self.width, self.height, self.raw
+
+	def __setstate__(self, state):
+		self.width, self.height, self.raw = state
+		self.__view()
+
+	# with a (y1 - y0, x1 - x0) mask, colors are those of the masked pixels only.
+	def write(self, x0, y0, x1, y1, colors, mask=None):
+		if mask is not None:
+			self.array[y0:y1, x0:x1][mask] = colors
+			return
+		self.array[y0:y1, x0:x1] = np.reshape(colors, (y1 - y0, x1 - x0, 3))
+
+	def clear(self, x0=0, y0=0, x1=None, y1=None):
+		self.array[y0:y1, x0:x1] = 0
+
+	# the unclamped image.
+	def image(self, x0=0, y0=0, x1=None, y1=None):
+		return self.array[y0:y1, x0:x1]
+
+	# 8 bit rgb values, truncated like Color.toHex did.
+	def toBytes(self, x0=0, y0=0, x1=None, y1=None):
+		return np.clip(self.image(x0, y0, x1, y1), 0, 255).astype(np.uint8)
+
+
+# framebuffer for progressive rendering: array holds the running mean of all samples of a
+# pixel, counts how many there are and m2 the sum of squared differences from the mean of
+# their luminance (welford's algorithm), for the variance.
+# with a noise target, pixels whose relative standard error of the mean is below it after
+# minSamples samples are converged and don't get any more samples.
+class AccumulationBuffer(Framebuffer):
+	def __init__(self, width, height, noise=None, minSamples=MIN_SAMPLES):
+		self.noiseTarget = noise
+		self.minSamples = max(minSamples, 2)
+		self.rawCounts = SharedMemory(width * height, np.int32)
+		self.rawM2 = SharedMemory(width * height, np.float32)
+		Framebuffer.__init__(self, width, height)
+		self.__statisticsView()
+
+	def __statisticsView(self):
+		self.counts = self.rawCounts.array.reshape(self.height, self.width)
+		self.m2 = self.rawM2.array.reshape(self.height, self.width)
+
+	def __getstate__(self):
+		return Framebuffer.__getstate__(self), self.noiseTarget, self.minSamples, self.rawCounts, self.rawM2
+
+	def __setstate__(self, state):
+		Framebuffer.__setstate__(self, state[0])
+		self.noiseTarget, self.minSamples, self.rawCounts, self.rawM2 = state[1:]
+		self.__statisticsView()
+
+	# adds one sample to every pixel of the tile, or only to the pixels in mask, then colors
+	# holds one row per pixel in mask.
+	def add(self, x0, y0, x1, y1, colors, mask=None):
+		mean, m2, counts = self.array[y0:y1, x0:x1], self.m2[y0:y1, x0:x1], self.counts[y0:y1, x0:x1]
+		if mask is None:
+			mask = np.ones(counts.shape, dtype=bool)
+		colors = np.reshape(colors, (-1, 3))
+
+		n = counts[mask] + 1
+		previous = mean[mask]
+		updated = previous + (colors - previous) / n[:, np.newaxis]
+		mean[mask] = updated
+		m2[mask] += np.dot(colors - previous, LUMINANCE) * np.dot(colors - updated, LUMINANCE)
+		counts[mask] = n
+
+	def clear(self, x0=0, y0=0, x1=None, y1=None):
+		Framebuffer.clear(self, x0, y0, x1, y1)
+		self.counts[y0:y1, x0:x1] = 0
+		self.m2[y0:y1, x0:x1] = 0
+
+	# relative standard error of the mean luminance per pixel, np.inf below two samples.
+	# one 8 bit step is added to the mean, so black pixels don't need infinite samples.
+	def noise(self, x0=0, y0=0, x1=None, y1=None):
+		counts = self.counts[y0:y1, x0:x1].astype(float)
+		with np.errstate(divide="ignore", invalid="ignore"):
+			variance = self.m2[y0:y1, x0:x1] / (counts - 1)
+			error = np.sqrt(np.maximum(variance, 0) / counts) / (np.dot(self.array[y0:y1, x0:x1], LUMINANCE) + 1.0)
+		return np.where(counts > 1, error, np.inf)
+
+	# mask of the pixels that still need samples.
+	def active(self, x0=0, y0=0, x1=None, y1=None):
+		if self.noiseTarget is None:
+			return np.ones(self.counts[y0:y1, x0:x1].shape, dtype=bool)
+		return (self.counts[y0:y1, x0:x1] < self.minSamples) | (self.noise(x0, y0, x1, y1) > self.noiseTarget)
+
+	# (mean, max) of the noise over all pixels that have at least two samples.
+	def noiseLevel(self):
+		noise = self.noise()
+		noise = noise[noise < np.inf]
+		if not len(noise):
+			return np.inf, np.inf
+		return float(np.mean(noise)), float(np.max(noise))
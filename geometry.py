@@ -15,6 +15,18 @@ def normalize(v):
 	return v / vector_length(v)
 
 
+# normalizes every row of a (N,3) array.
+def normalize_many(v):
+	return v / np.sqrt(np.einsum("ij,ij->i", v, v))[:, np.newaxis]
+
+
+# row-wise dot product of two (N,3) arrays (or a (N,3) array and a vector).
+def dot_many(a, b):
+	if np.ndim(b) == 1:
+		return np.dot(a, b)
+	return np.einsum("ij,ij->i", a, b)
+
+
 class Ray:
 	def __init__(self, origin, direction):
 		self.origin = np.array(origin)
@@ -54,6 +66,42 @@ class GeometryObject:
 	def normalAt(self, point):
 		pass
 
+	# packet version of intersect: takes (N,3) origins and normalized directions and returns
+	# the nearest distance greater than tMin for every ray, np.inf where nothing is hit.
+	# the scalar path stays the reference, subclasses override this with numpy code.
+	def intersect_many(self, origins, directions, tMin=0.0):
+		result = np.empty(len(origins))
+		for i in range(len(origins)):
+			ray = Ray(origins[i], directions[i])
+			hits = [d for d in self.intersect(ray) if d > tMin]
+			result[i] = min(hits) if hits else np.inf
+		return result
+
+	def normalAt_many(self, points):
+		return np.array([self.normalAt(p) for p in points], dtype=float).reshape(len(points), 3)
+
+	# axis aligned bounding box as (min, max) corners, None for unbounded objects.
+	def bounds(self):
+		return None
+
+	# a copy of the object moved by offset, with the same material.
+	@abstractmethod
+	def translated(self, offset):
+		pass
+
+	# nearest intersection distance in (tMin, tMax), np.inf if there is none. aggregates whose
+	# intersect only reports one hit (meshes) override this to search the interval themselves.
+	def closestDistance(self, ray, tMin=0.0, tMax=np.inf):
+		nearest = np.inf
+		for distance in self.intersect(ray):
+			if tMin < distance < tMax and distance < nearest:
+				nearest = distance
+		return nearest
+
+	# true if anything of the object is hit in (tMin, tMax).
+	def occludes(self, ray, tMin=0.0, tMax=np.inf):
+		return self.closestDistance(ray, tMin, tMax) < np.inf
+
 
 class Plane(GeometryObject):
 	def __init__(self, origin, normal, material=None):
@@ -70,9 +118,23 @@ class Plane(GeometryObject):
 			return [np.inf]
 		return [d]
 
+	def intersect_many(self, origins, directions, tMin=0.0):
+		denom = dot_many(directions, self.normal)
+		parallel = np.abs(denom) < 1e-6
+		with np.errstate(divide="ignore", invalid="ignore"):
+			d = dot_many(self.origin - origins, self.normal) / denom
+		d[parallel | (d <= tMin) | np.isnan(d)] = np.inf
+		return d
+
 	def normalAt(self, point):
 		return self.normal
 
+	def normalAt_many(self, points):
+		return np.tile(self.normal, (len(points), 1))
+
+	def translated(self, offset):
+		return Plane(self.origin + offset, self.normal, self.material)
+
 
 class Sphere(GeometryObject):
 	def __init__(self, center, radius, material=None):
@@ -97,6 +159,20 @@ class Sphere(GeometryObject):
 
 		return filter(lambda e: e > 0, [loc * -1 - np.sqrt(term), loc * -1 + np.sqrt(term)]) 
 
+	def intersect_many(self, origins, directions, tMin=0.0):
+		oc = origins - self.center
+		loc = dot_many(directions, oc)
+		term = loc * loc - dot_many(oc, oc) + self.radius * self.radius
+
+		root = np.sqrt(np.maximum(term, 0))
+		near = -loc - root
+		far = -loc + root
+
+		# take the near intersection if it is in front of tMin, otherwise the far one.
+		d = np.where(near > tMin, near, far)
+		d[(term < 0) | (d <= tMin)] = np.inf
+		return d
+
 	def normalAt(self, point):
 		#    N = ((x - cx)/R, (y - cy)/R, (z - cz)/R)
 		nx = (point[0] - self.center[0]) / self.radius
@@ -105,116 +181,173 @@ class Sphere(GeometryObject):
 
 		return np.array([nx, ny, nz])
 
+	def normalAt_many(self, points):
+		return (points - self.center) / self.radius
+
+	def bounds(self):
+		return self.center - self.radius, self.center + self.radius
+
+	def translated(self, offset):
+		return Sphere(self.center + offset, self.radius, self.material)
+
 class Triangle(GeometryObject):
 	def __init__(self, v0, v1, v2, material=None):
 		GeometryObject.__init__(self, material)
-		self.v0 = np.array(v0)
-		self.v1 = np.array(v1)
-		self.v2 = np.array(v2)
+		self.v0 = np.array(v0, dtype=float)
+		self.v1 = np.array(v1, dtype=float)
+		self.v2 = np.array(v2, dtype=float)
+
+		# everything that only depends on the vertices is computed once here.
+		self.e1 = self.v1 - self.v0
+		self.e2 = self.v2 - self.v0
+		self.normal = normalize(np.cross(self.e1, self.e2))
 
+		# barycentric denominators for pointIn.
+		self.uu = np.dot(self.e1, self.e1)
+		self.uv = np.dot(self.e1, self.e2)
+		self.vv = np.dot(self.e2, self.e2)
+		self.D = self.uv*self.uv - self.uu*self.vv
+
+		# plain floats for the scalar intersection, numpy is slow on 3 element vectors.
+		self.__scalar = self.v0.tolist() + self.e1.tolist() + self.e2.tolist()
+
+	# moeller-trumbore ray-triangle intersection.
 	def intersect(self, ray):
-		# get triangles normal plane
-		U = self.v1 - self.v0
-		V = self.v2 - self.v0
-		N = np.cross(U, V)
+		v0x, v0y, v0z, e1x, e1y, e1z, e2x, e2y, e2z = self.__scalar
+		dx, dy, dz = ray.direction.tolist()
+		ox, oy, oz = ray.origin.tolist()
+
+		# P = D x E2
+		px, py, pz = dy*e2z - dz*e2y, dz*e2x - dx*e2z, dx*e2y - dy*e2x
+		det = e1x*px + e1y*py + e1z*pz
+		# ray is parallel to the triangle.
+		if abs(det) < 1e-12:
+			return [np.inf]
+		inv = 1.0 / det
 
-		P = Plane(self.v0, N)
+		tx, ty, tz = ox - v0x, oy - v0y, oz - v0z
+		u = (tx*px + ty*py + tz*pz) * inv
+		if u < 0.0 or u > 1.0:
+			return [np.inf]
 
-		distance = P.intersect(ray)[0]
+		# Q = T x E1
+		qx, qy, qz = ty*e1z - tz*e1y, tz*e1x - tx*e1z, tx*e1y - ty*e1x
+		v = (dx*qx + dy*qy + dz*qz) * inv
+		if v < 0.0 or u + v > 1.0:
+			return [np.inf]
 
-		if distance == np.inf:
+		distance = (e2x*qx + e2y*qy + e2z*qz) * inv
+		if distance < 0:
 			return [np.inf]
+		return [distance]
 
-		intersection = ray.origin + ray.direction * distance
+	def intersect_many(self, origins, directions, tMin=0.0):
+		P = np.cross(directions, self.e2)
+		det = np.dot(P, self.e1)
+		parallel = np.abs(det) < 1e-12
+		with np.errstate(divide="ignore", invalid="ignore"):
+			inv = 1.0 / det
 
-		if self.pointIn(intersection):
-			return [distance]
+			T = origins - self.v0
+			u = dot_many(T, P) * inv
+			Q = np.cross(T, self.e1)
+			v = dot_many(directions, Q) * inv
+			d = np.dot(Q, self.e2) * inv
 
-		return [np.inf]
+		d[parallel | (u < 0.0) | (u > 1.0) | (v < 0.0) | (u + v > 1.0) | (d <= tMin)] = np.inf
+		return d
 
 	def pointIn(self, point):
-		U = self.v1 - self.v0
-		V = self.v2 - self.v0
-
 		# is intersection inside the triangle?
-		uu = np.dot(U, U)
-		uv = np.dot(U, V)
-		vv = np.dot(V, V)
 		w = point - self.v0
-		wu = np.dot(w, U)
-		wv = np.dot(w, V)
-		D = uv*uv - uu*vv
+		wu = np.dot(w, self.e1)
+		wv = np.dot(w, self.e2)
 
-		s = (uv*wv - vv*wu) / D
+		s = (self.uv*wv - self.vv*wu) / self.D
 		if s < 0.0 or s > 1.0:
 			return False
 
-		t = (uv*wu - uu*wv) / D
+		t = (self.uv*wu - self.uu*wv) / self.D
 		if t < 0.0 or (s+t) > 1.0:
 			return False
 
 		return True
 
 	def normalAt(self, point):
-		# get triangles normal plane
-		U = self.v1 - self.v0
-		V = self.v2 - self.v0
-		N = np.cross(U, V)
+		return self.normal
+
+	def normalAt_many(self, points):
+		return np.tile(self.normal, (len(points), 1))
 
-		return N
+	def bounds(self):
+		vertices = np.array([self.v0, self.v1, self.v2])
+		return vertices.min(axis=0), vertices.max(axis=0)
 
+	def translated(self, offset):
+		return Triangle(self.v0 + offset, self.v1 + offset, self.v2 + offset, self.material)
+
+# axis aligned cube, intersected as a box with the slab method.
 class Cube(GeometryObject):
 	def __init__(self, center, length, material=None):
 		GeometryObject.__init__(self, material)
-		self.center = np.array(center)
-		self.radius = length / 2
+		self.center = np.array(center, dtype=float)
+		self.radius = length / 2.0
+		self.lo = self.center - self.radius
+		self.hi = self.center + self.radius
+		self.__lo = self.lo.tolist()
+		self.__hi = self.hi.tolist()
+
+	# slab test on plain floats, returns (tNear, tFar) or None for a miss. the normal of the face
+	# that is hit comes from normalAt afterwards, like for every other object.
+	def __slabs(self, ray):
+		tNear, tFar = -np.inf, np.inf
+		for o, d, lo, hi in zip(ray.origin.tolist(), ray.direction.tolist(), self.__lo, self.__hi):
+			if d == 0:
+				if o < lo or o > hi:
+					return None
+				continue
+
+			t1, t2 = (lo - o) / d, (hi - o) / d
+			if t1 > t2:
+				t1, t2 = t2, t1
+			tNear, tFar = max(tNear, t1), min(tFar, t2)
+			if tNear > tFar:
+				return None
+		return tNear, tFar
 
-		v1 = [center[0] - self.radius, center[1] + self.radius, center[2] - self.radius]
-		v2 = [center[0] + self.radius, center[1] + self.radius, center[2] - self.radius]
-		v3 = [center[0] + self.radius, center[1] + self.radius, center[2] + self.radius]
-		v4 = [center[0] - self.radius, center[1] + self.radius, center[2] + self.radius]
-		v5 = [center[0] - self.radius, center[1] - self.radius, center[2] - self.radius]
-		v6 = [center[0] + self.radius, center[1] - self.radius, center[2] - self.radius]
-		v7 = [center[0] + self.radius, center[1] - self.radius, center[2] + self.radius]
-		v8 = [center[0] - self.radius, center[1] - self.radius, center[2] + self.radius]
-
-		# unten
-		t1 = Triangle(v1, v2, v3, self.material)
-		t2 = Triangle(v1, v3, v4, self.material)
-
-		# vorne 
-		t3 = Triangle(v1, v2, v6, self.material)
-		t4 = Triangle(v1, v6, v5, self.material)
-
-		# links
-		t5 = Triangle(v4, v1, v5, self.material)
-		t6 = Triangle(v4, v5, v8, self.material)
-
-		# rechts
-		t7 = Triangle(v2, v3, v7, self.material)
-		t8 = Triangle(v2, v7, v6, self.material)
+	def intersect(self, ray):
+		slabs = self.__slabs(ray)
+		if slabs is None:
+			return [np.inf]
+		return [d for d in slabs if d > 0]
 
-		# hinten
-		t9 = Triangle(v3, v4, v8, self.material)
-		t10 = Triangle(v3, v8, v7, self.material)
+	def intersect_many(self, origins, directions, tMin=0.0):
+		with np.errstate(divide="ignore", invalid="ignore"):
+			t1 = (self.lo - origins) / directions
+			t2 = (self.hi - origins) / directions
+		tNear = np.nanmax(np.fmin(t1, t2), axis=1)
+		tFar = np.nanmin(np.fmax(t1, t2), axis=1)
 
-		# oben
-		t11 = Triangle(v5, v6, v7, self.material)
-		t12 = Triangle(v5, v7, v8, self.material)
+		d = np.where(tNear > tMin, tNear, tFar)
+		d[(tNear > tFar) | (d <= tMin)] = np.inf
+		return d
 
-		self.triangles = [t1, t2, t3, t4, t5, t6, t7, t8, t9, t10, t11, t12]
+	# the face whose plane is closest to the point, no need to test the point against faces.
+	def normalAt(self, point):
+		return self.normalAt_many(np.reshape(point, (1, 3)))[0]
 
-	def intersect(self, ray):
-		lol = map(lambda t: t.intersect(ray), self.triangles)
-		distance = reduce(lambda x,y: min(x, y), lol)
-		return distance
+	def normalAt_many(self, points):
+		local = (points - self.center) / self.radius
+		axis = np.argmax(np.abs(local), axis=1)
+		normals = np.zeros((len(points), 3))
+		normals[np.arange(len(points)), axis] = np.sign(local[np.arange(len(points)), axis])
+		return normals
 
-	def normalAt(self, point):
-		for t in self.triangles:
-			if t.pointIn(point):
-				return t.normalAt(point)
+	def bounds(self):
+		return self.lo, self.hi
 
-		return None
+	def translated(self, offset):
+		return Cube(self.center + offset, 2 * self.radius, self.material)
 
 
 
@@ -0,0 +1,135 @@
+#!/usr/bin/python
+
+import numpy as np
+
+# the radiance of white in the framebuffers, HDR files are divided by it so 1.0 is white.
+WHITE = 255.0
+
+TONE_MAPS = ["clamp", "reinhard", "aces"]
+
+HDR_FORMATS = ["pfm", "npy", "exr"]
+
+
+# maps a (height, width, 3) radiance image to 8 bit rgb. exposure scales the radiance first.
+# clamp cuts everything above white off, like the framebuffers always did, reinhard compresses
+# x to x / (1 + x), aces is narkowicz's fit of the ACES filmic curve.
+def toneMap(image, operator="clamp", exposure=1.0):
+	x = np.asarray(image, dtype=np.float32) * np.float32(exposure)
+	if operator == "clamp":
+		return np.clip(x, 0, 255).astype(np.uint8)
+
+	x /= np.float32(WHITE)
+	if operator == "reinhard":
+		x = x / (1 + x)
+	elif operator == "aces":
+		x = (x * (2.51 * x + 0.03)) / (x * (2.43 * x + 0.59) + 0.14)
+	else:
+		raise ValueError("unknown tone mapping operator: %s" % operator)
+	return np.clip(x * WHITE, 0, 255).astype(np.uint8)
+
+
+def writePng(fileName, image, operator="clamp", exposure=1.0):
+	from PIL import Image
+
+	Image.fromarray(toneMap(image, operator, exposure), "RGB").save(fileName, format="png")
+
+
+# portable float map: a small text header and little endian float32 rows, the bottom row first.
+def writePfm(fileName, image):
+	image = np.asarray(image, dtype="<f4") / np.float32(WHITE)
+	with open(fileName, "wb") as f:
+		f.write("PF\n%d %d\n-1.0\n" % (image.shape[1], image.shape[0]))
+		f.write(np.ascontiguousarray(image[::-1]).tobytes())
+
+
+def readPfm(fileName):
+	with open(fileName, "rb") as f:
+		kind = f.readline().strip()
+		width, height = [int(v) for v in f.readline().split()]
+		scale = float(f.readline())
+		data = np.frombuffer(f.read(), dtype="<f4" if scale < 0 else ">f4")
+	channels = 3 if kind == "PF" else 1
+	return data.reshape(height, width, channels)[::-1] * np.float32(WHITE)
+
+
+# written through a memory map, read back with readNpy, which maps the file as well, so big
+# images are not copied into memory. the file keeps white at 1.0, like the other HDR files.
+def writeNpy(fileName, image):
+	array = np.lib.format.open_memmap(fileName, mode="w+", dtype=np.float32, shape=np.shape(image))
+	array[:] = np.asarray(image) / np.float32(WHITE)
+	array.flush()
+	del array
+
+
+# the read only memory map of the file, white is 1.0. scaling it by WHITE to the radiance of
+# the framebuffers makes a copy in memory, so that is up to the caller.
+def readNpy(fileName):
+	return np.load(fileName, mmap_mode="r")
+
+
+# the OpenEXR modules, which are only imported when EXR files are written.
+def exrModules():
+	try:
+		import OpenEXR
+		import Imath
+	except ImportError:
+		raise ImportError("writing EXR files needs the OpenEXR module.")
+	return OpenEXR, Imath
+
+
+def writeExr(fileName, image):
+	OpenEXR, Imath = exrModules()
+	image = np.asarray(image, dtype=np.float32) / np.float32(WHITE)
+	header = OpenEXR.Header(image.shape[1], image.shape[0])
+	header["channels"] = dict((c, Imath.Channel(Imath.PixelType(Imath.PixelType.FLOAT))) for c in "RGB")
+	out = OpenEXR.OutputFile(fileName, header)
+	out.writePixels(dict((c, np.ascontiguousarray(image[:, :, i]).tobytes()) for i, c in enumerate("RGB")))
+	out.close()
+
+
+# how rendered images are saved: a tone mapped PNG and the radiance in the given HDR formats,
+# each as fileName plus its extension.
+class ImageOutput:
+	def __init__(self, formats=(), toneMap="clamp", exposure=1.0):
+		if toneMap not in TONE_MAPS:
+			raise ValueError("unknown tone mapping operator: %s" % toneMap)
+		for fmt in formats:
+			if fmt not in HDR_FORMATS:
+				raise ValueError("unknown image format: %s" % fmt)
+		# fails before rendering instead of when the image is saved.
+		if "exr" in formats:
+			exrModules()
+		self.formats = list(formats)
+		self.toneMap = toneMap
+		self.exposure = exposure
+
+	def save(self, image, fileName):
+		writePng(fileName + ".png", image, self.toneMap, self.exposure)
+		for fmt in self.formats:
+			{"pfm": writePfm, "npy": writeNpy, "exr": writeExr}[fmt](fileName + "." + fmt, image)
+
+
+if __name__ == "__main__":
+	import os, shutil, tempfile
+
+	random = np.random.RandomState(0)
+	image = (random.uniform(0, 600, (5, 7, 3))).astype(np.float32)
+	assert np.array_equal(toneMap(image), np.clip(image, 0, 255).astype(np.uint8))
+	for operator in TONE_MAPS:
+		mapped = toneMap(image, operator).astype(int)
+		# brighter radiance never gets darker.
+		order = np.argsort(image.ravel())
+		assert np.all(np.diff(mapped.ravel()[order]) >= 0), operator
+
+	directory = tempfile.mkdtemp()
+	try:
+		ImageOutput(["pfm", "npy"], "aces").save(image, os.path.join(directory, "test"))
+		assert np.allclose(readPfm(os.path.join(directory, "test.pfm")), image)
+		mapped = readNpy(os.path.join(directory, "test.npy"))
+		assert isinstance(mapped, np.memmap)
+		assert np.allclose(mapped * np.float32(WHITE), image)
+		del mapped
+		assert os.path.exists(os.path.join(directory, "test.png"))
+	finally:
+		shutil.rmtree(directory)
+	print "imagefile ok"
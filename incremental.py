@@ -0,0 +1,227 @@
+#!/usr/bin/python
+
+import hashlib
+
+import numpy as np
+
+from cache import hashValue, SKIP_ATTRIBUTES
+
+# boxes of a tile are grown by this much before they are tested against the bounds of an
+# edited object, so rays that only graze an object count as touching it.
+BOX_TOLERANCE = 1e-4
+
+
+# what the rays of one tile touched, collected by the tracer while the tile is rendered:
+# the indices of the objects that were hit and, per packet query, the bounding box of the ray
+# segments, from the origins to the hits or to the end of the shadow rays. scalar queries go
+# into one box, since a box per ray would be as big as the rays themselves.
+# an edited object can only change a tile if it was hit by one of its rays, or if its old or
+# new bounds overlap one of the boxes.
+class RayRecord:
+	def __init__(self, objects):
+		self.indices = dict((id(obj), i) for i, obj in enumerate(objects))
+		self.touched = set()
+		self.boxes = []
+		self.lo = np.full(3, np.inf)
+		self.hi = np.full(3, -np.inf)
+
+	# the far end of a segment, infinitely far in the direction of a ray that hit nothing.
+	def __end(self, origins, directions, distances):
+		finite = np.isfinite(distances)
+		ends = origins + directions * np.where(finite, distances, 0)[..., np.newaxis]
+		return np.where(finite[..., np.newaxis], ends, np.where(directions > 0, np.inf, np.where(directions < 0, -np.inf, origins)))
+
+	def hit(self, origin, direction, distance, obj=None):
+		end = self.__end(origin, direction, np.asarray(distance, dtype=float))
+		np.minimum(self.lo, np.minimum(origin, end), out=self.lo)
+		np.maximum(self.hi, np.maximum(origin, end), out=self.hi)
+		if obj is not None:
+			self.touched.add(self.indices[id(obj)])
+
+	def hit_many(self, origins, directions, distances, index=None):
+		if not len(origins):
+			return
+		ends = self.__end(origins, directions, distances)
+		self.boxes.append((np.minimum(origins, ends).min(axis=0), np.maximum(origins, ends).max(axis=0)))
+		if index is not None:
+			self.touched.update(np.unique(index[index >= 0]).tolist())
+
+	# (sorted touched indices, (N, 2, 3) boxes), small enough to be sent back by the worker.
+	def summary(self):
+		boxes = list(self.boxes)
+		if np.all(self.lo <= self.hi):
+			boxes.append((self.lo, self.hi))
+		return sorted(self.touched), np.array(boxes, dtype=float).reshape(-1, 2, 3)
+
+
+# hash of everything but the material of an object, to tell a new material from a new shape.
+def shapeHash(obj):
+	digest = hashlib.sha1()
+	hashValue(digest, obj.__class__.__name__)
+	hashValue(digest, dict((k, v) for k, v in vars(obj).items() if k != "material" and k not in SKIP_ATTRIBUTES))
+	return digest.hexdigest()
+
+
+# the RayRecords of all tiles of an image and the scene edits since it was rendered. every
+# edit marks the tiles it may change as dirty, dirty returns those that have to be traced
+# again, all other tiles of the previous image stay valid. the edits change the scene and
+# rebuild its BVH, render processes started afterwards see the edited scene.
+class TileRecords:
+	def __init__(self, scene):
+		self.scene = scene
+		self.touched = {}
+		self.boxes = {}
+		self.invalid = set()
+
+	# adds the summary of a RayRecord, the records of the passes of a progressive render are
+	# merged box by box, since every pass queries in the same order.
+	def add(self, tile, summary):
+		touched, boxes = summary
+		tile = tuple(tile)
+		if tile in self.invalid or tile not in self.boxes:
+			self.invalid.discard(tile)
+			self.touched[tile], self.boxes[tile] = set(touched), boxes
+			return
+
+		self.touched[tile].update(touched)
+		previous = self.boxes[tile]
+		n = min(len(previous), len(boxes))
+		merged = np.concatenate([previous, boxes[n:]]) if len(boxes) > n else previous.copy()
+		merged[:n, 0] = np.minimum(merged[:n, 0], boxes[:n, 0])
+		merged[:n, 1] = np.maximum(merged[:n, 1], boxes[:n, 1])
+		self.boxes[tile] = merged
+
+	# the tiles, in the given order, that have no record or were invalidated by an edit.
+	def dirty(self, tiles):
+		return [t for t in tiles if tuple(t) in self.invalid or tuple(t) not in self.boxes]
+
+	def clear(self):
+		self.touched, self.boxes, self.invalid = {}, {}, set()
+
+	# marks tiles as dirty, e.g. those whose render was cancelled before it was complete.
+	def invalidate(self, tiles):
+		self.invalid.update(tuple(t) for t in tiles if tuple(t) in self.boxes)
+
+	def __invalidateTouching(self, index):
+		self.invalid.update(t for t, touched in self.touched.items() if index in touched)
+
+	# tiles with a box overlapping bounds, all tiles for unbounded objects (bounds None).
+	def __invalidateOverlapping(self, bounds):
+		if bounds is None:
+			self.invalid.update(self.boxes)
+			return
+
+		lo, hi = np.asarray(bounds[0], dtype=float) - BOX_TOLERANCE, np.asarray(bounds[1], dtype=float) + BOX_TOLERANCE
+		for tile, boxes in self.boxes.items():
+			if np.any(np.all((boxes[:, 0] <= hi) & (boxes[:, 1] >= lo), axis=1)):
+				self.invalid.add(tile)
+
+	def __rebuild(self):
+		self.scene.buildAccelerator()
+
+	# replaces the object at index of the scene geometry. a new material only changes the
+	# tiles whose rays hit the object, a new shape also those whose rays pass its old or new
+	# bounds.
+	def replaceObject(self, index, obj):
+		previous = self.scene.geometry[index]
+		self.__invalidateTouching(index)
+		if shapeHash(previous) != shapeHash(obj):
+			self.__invalidateOverlapping(previous.bounds())
+			self.__invalidateOverlapping(obj.bounds())
+		self.scene.geometry[index] = obj
+		self.__rebuild()
+
+	def addObject(self, obj):
+		self.__invalidateOverlapping(obj.bounds())
+		self.scene.geometry.append(obj)
+		self.__rebuild()
+
+	# the objects after index move down by one, so do their indices in the records.
+	def removeObject(self, index):
+		self.__invalidateTouching(index)
+		self.__invalidateOverlapping(self.scene.geometry[index].bounds())
+		del self.scene.geometry[index]
+		for tile, touched in self.touched.items():
+			self.touched[tile] = set(i - 1 if i > index else i for i in touched if i != index)
+		self.__rebuild()
+
+	# every pixel is lit by every light, so a light edit changes the whole image.
+	def replaceLight(self, index, light):
+		self.scene.lights[index] = light
+		self.invalid.update(self.boxes)
+
+
+# renders an image with recording render processes and, after scene edits through records,
+# traces only the tiles the edits made dirty again, into the same framebuffer.
+class IncrementalRenderer:
+	def __init__(self, width, height, tracer, scene, processes=None, tileSize=None):
+		from framebuffer import Framebuffer
+		from processes import makeTiles, TILE_SIZE
+
+		self.tracer = tracer
+		self.scene = scene
+		self.processes = processes
+		self.framebuffer = Framebuffer(width, height)
+		self.tiles = makeTiles(width, height, tileSize or TILE_SIZE)
+		self.records = TileRecords(scene)
+		self.service = None
+
+	# renders the dirty tiles and returns them. the render processes are started by the first
+	# render, the later ones only send them the edited scene.
+	def render(self):
+		from processes import RenderPool, RenderService
+
+		tiles = self.records.dirty(self.tiles)
+		if not tiles:
+			return tiles
+
+		if self.service is None:
+			self.service = RenderService(self.processes, tracer=self.tracer, scene=self.scene)
+		pool = RenderPool(self.tracer, self.scene, self.framebuffer, record=True, service=self.service)
+		pool.start(tiles)
+		for i in range(len(tiles)):
+			tile, rays, summary = pool.dataQueue.get()[:3]
+			self.records.add(tile, summary)
+		pool.join()
+		return tiles
+
+	def close(self):
+		if self.service is not None:
+			self.service.close()
+			self.service = None
+
+
+if __name__ == "__main__":
+	from geometry import Plane, Sphere
+	from material import Material, Color
+	from scene import Screen, Scene
+	from tracer import ShadingShadowRayTracer, PathTracer
+
+	def scene():
+		walls = [Plane([0, -3, 0], [0, 1, 0], Material(Color(200, 200, 200), 1, 0, 0.1)), Plane([0, 0, 8], [0, 0, -1], Material(Color(100, 100, 200), 1, 0, 0.1))]
+		spheres = [Sphere([x, -2, 3], 0.7, Material(Color(200, 80, 80), 1, 0.3, 0.1)) for x in [-3, 0, 3]]
+		lights = [Sphere([-3, 4, 0], 0.5, Material(Color(255, 255, 255), 1, 1, 1))]
+		return Scene([0, 0, -5], Screen([0, 0, -1], [0, 0, -1], 48, 48, 10.0 / 48), walls + spheres, lights)
+
+	edits = [
+		("material", lambda r: r.records.replaceObject(4, Sphere([3, -2, 3], 0.7, Material(Color(80, 200, 80), 1, 0.3, 0.1)))),
+		("move", lambda r: r.records.replaceObject(2, Sphere([-3, -1.5, 3], 0.7, Material(Color(200, 80, 80), 1, 0.3, 0.1)))),
+		("add", lambda r: r.records.addObject(Sphere([0, 1, 2], 0.4, Material(Color(80, 80, 200), 1, 0, 0.1)))),
+		("remove", lambda r: r.records.removeObject(3)),
+	]
+
+	# after every edit, the incremental image has to be the image of the edited scene.
+	for makeTracer in [lambda s: ShadingShadowRayTracer(s.eye), lambda s: PathTracer(s.eye)]:
+		edited = scene()
+		renderer = IncrementalRenderer(48, 48, makeTracer(edited), edited, processes=1, tileSize=8)
+		renderer.render()
+		for name, edit in edits:
+			edit(renderer)
+			tiles = renderer.render()
+
+			reference = IncrementalRenderer(48, 48, makeTracer(edited), edited, processes=1, tileSize=8)
+			reference.render()
+			assert np.array_equal(renderer.framebuffer.image(), reference.framebuffer.image()), name
+			reference.close()
+			print "%s %-8s: %2d of %d tiles traced again" % (renderer.tracer.__class__.__name__, name, len(tiles), len(renderer.tiles))
+		renderer.close()
@@ -43,6 +43,68 @@ class Color:
 
 WHITE = Color(255, 255, 255)
 
+
+# unclamped rgb value used by the tracers while shading. unlike Color it keeps three plain
+# floats instead of a numpy array and can accumulate in place, so the shading code does not
+# allocate and clip on every operation. values are clamped once, when a pixel is written out.
+class Radiance(object):
+	__slots__ = ("r", "g", "b")
+
+	def __init__(self, r=0.0, g=0.0, b=0.0):
+		self.r = r
+		self.g = g
+		self.b = b
+
+	@classmethod
+	def fromColor(cls, color):
+		return cls(float(color.r), float(color.g), float(color.b))
+
+	@property
+	def rgb(self):
+		return np.array([self.r, self.g, self.b])
+
+	def copy(self):
+		return Radiance(self.r, self.g, self.b)
+
+	def __add__(self, other):
+		return Radiance(self.r + other.r, self.g + other.g, self.b + other.b)
+
+	def __sub__(self, other):
+		return Radiance(self.r - other.r, self.g - other.g, self.b - other.b)
+
+	def __mul__(self, scalar):
+		return Radiance(self.r * scalar, self.g * scalar, self.b * scalar)
+
+	def __div__(self, scalar):
+		return Radiance(self.r / scalar, self.g / scalar, self.b / scalar)
+
+	__truediv__ = __div__
+
+	def __iadd__(self, other):
+		self.r += other.r
+		self.g += other.g
+		self.b += other.b
+		return self
+
+	def __imul__(self, scalar):
+		self.r *= scalar
+		self.g *= scalar
+		self.b *= scalar
+		return self
+
+	# self += other * scalar, without the temporary.
+	def addScaled(self, other, scalar):
+		self.r += other.r * scalar
+		self.g += other.g * scalar
+		self.b += other.b * scalar
+		return self
+
+	def __str__(self):
+		return "R:%s G:%s B:%s" % (self.r, self.g, self.b)
+
+	def toColor(self):
+		return Color(self.r, self.g, self.b)
+
 if __name__ == "__main__":
 	a = Color(100, 100, 100)
 	b = Color(50, 50, 50)
@@ -76,3 +138,10 @@ if __name__ == "__main__":
 	assert (g.r == 10)
 	assert (g.g == 10)
 	assert (g.b == 10)
+
+	h = Radiance.fromColor(Color(200, 200, 200))
+	h += Radiance(200, 200, 200)
+	assert (h.r == 400)
+	h.addScaled(Radiance(10, 20, 30), 0.5)
+	assert (h.r == 405 and h.g == 410 and h.b == 415)
+	assert (h.toColor().r == 255)
@@ -0,0 +1,403 @@
+#!/usr/bin/python
+
+import array
+import copy
+import os
+
+import numpy as np
+
+from bvh import BVH
+from geometry import GeometryObject, normalize_many
+
+# meshes test a whole leaf with one numpy call, so a triangle test costs only a fraction of a
+# node visit and bigger leaves are cheaper than deeper trees.
+MESH_LEAF_SIZE = 32
+MESH_INTERSECTION_COST = 0.05
+
+# tolerance for finding the triangle a hit point lies on, relative to the size of the mesh.
+LOCATE_TOLERANCE = 1e-5
+
+PLY_TYPES = {
+	"char": "i1", "int8": "i1", "uchar": "u1", "uint8": "u1",
+	"short": "i2", "int16": "i2", "ushort": "u2", "uint16": "u2",
+	"int": "i4", "int32": "i4", "uint": "u4", "uint32": "u4",
+	"float": "f4", "float32": "f4", "double": "f8", "float64": "f8",
+}
+
+
+# area weighted vertex normals, the average of the normals of all triangles around a vertex.
+def vertexNormals(vertices, indices):
+	v = vertices.astype(float)
+	faceNormals = np.cross(v[indices[:, 1]] - v[indices[:, 0]], v[indices[:, 2]] - v[indices[:, 0]])
+	normals = np.zeros_like(v)
+	for corner in range(3):
+		np.add.at(normals, indices[:, corner], faceNormals)
+	lengths = np.sqrt(np.einsum("ij,ij->i", normals, normals))
+	normals[lengths > 0] /= lengths[lengths > 0, np.newaxis]
+	return normals.astype(np.float32)
+
+
+# moeller-trumbore of rays against triangles given as (v0, e1, e2) arrays. everything is
+# broadcast, so it works for one ray against many triangles and many rays against one.
+def intersectTriangles(v0, e1, e2, origins, directions, tMin, tMax):
+	P = np.cross(directions, e2)
+	det = np.einsum("...i,...i", P, e1)
+	with np.errstate(divide="ignore", invalid="ignore"):
+		inv = 1.0 / det
+		T = origins - v0
+		u = np.einsum("...i,...i", T, P) * inv
+		Q = np.cross(T, e1)
+		v = np.einsum("...i,...i", directions, Q) * inv
+		d = np.einsum("...i,...i", Q, e2) * inv
+		miss = (np.abs(det) < 1e-12) | (u < 0.0) | (u > 1.0) | (v < 0.0) | (u + v > 1.0) | (d <= tMin) | (d >= tMax)
+	return np.where(miss, np.inf, d)
+
+
+# streams an OBJ file line by line into flat arrays, polygons are split into triangle fans.
+# returns (vertices, indices, normals, normalIndices), the normals are None if the file has
+# none or not every face references them.
+def loadObj(path):
+	vertices = array.array("f")
+	normals = array.array("f")
+	indices = array.array("i")
+	normalIndices = array.array("i")
+	allNormals = True
+
+	def index(value, count):
+		i = int(value)
+		return i - 1 if i > 0 else count + i
+
+	with open(path) as f:
+		for line in f:
+			parts = line.split()
+			if not parts:
+				continue
+			if parts[0] == "v":
+				vertices.extend(map(float, parts[1:4]))
+			elif parts[0] == "vn":
+				normals.extend(map(float, parts[1:4]))
+			elif parts[0] == "f":
+				corners = [p.split("/") for p in parts[1:]]
+				vertexCount, normalCount = len(vertices) / 3, len(normals) / 3
+				v = [index(c[0], vertexCount) for c in corners]
+				if all(len(c) > 2 and c[2] for c in corners):
+					n = [index(c[2], normalCount) for c in corners]
+				else:
+					n, allNormals = None, False
+
+				for i in range(1, len(corners) - 1):
+					indices.extend((v[0], v[i], v[i + 1]))
+					if n is not None:
+						normalIndices.extend((n[0], n[i], n[i + 1]))
+
+	vertices = np.frombuffer(vertices, dtype=np.float32).reshape(-1, 3)
+	indices = np.frombuffer(indices, dtype=np.int32).reshape(-1, 3)
+	if not allNormals or not len(normals):
+		return vertices, indices, None, None
+	return vertices, indices, np.frombuffer(normals, dtype=np.float32).reshape(-1, 3), np.frombuffer(normalIndices, dtype=np.int32).reshape(-1, 3)
+
+
+# reads the header of a binary PLY file, returns (byte order, elements, size of the header)
+# where elements is a list of (name, count, properties) and a property is (name, type) or
+# (name, (count type, item type)) for lists.
+def readPlyHeader(f):
+	if f.readline().strip() != "ply":
+		raise ValueError("not a PLY file.")
+
+	byteOrder, elements = None, []
+	for line in iter(f.readline, ""):
+		parts = line.split()
+		if not parts or parts[0] in ("comment", "obj_info"):
+			continue
+		if parts[0] == "format":
+			if parts[1] == "ascii":
+				raise ValueError("only binary PLY files are supported.")
+			byteOrder = "<" if parts[1] == "binary_little_endian" else ">"
+		elif parts[0] == "element":
+			elements.append((parts[1], int(parts[2]), []))
+		elif parts[0] == "property":
+			if parts[1] == "list":
+				elements[-1][2].append((parts[4], (PLY_TYPES[parts[2]], PLY_TYPES[parts[3]])))
+			else:
+				elements[-1][2].append((parts[2], PLY_TYPES[parts[1]]))
+		elif parts[0] == "end_header":
+			return byteOrder, elements, f.tell()
+	raise ValueError("PLY header has no end.")
+
+
+# loads a binary PLY file. fixed size elements are memory mapped and only the columns that
+# are needed get copied. faces are mapped as well if they are all triangles, which is what
+# most exporters write, other polygons are read one by one and split into fans.
+# returns (vertices, indices, normals, None) like loadObj.
+def loadPly(path):
+	with open(path, "rb") as f:
+		byteOrder, elements, offset = readPlyHeader(f)
+
+	vertices, indices, normals = None, None, None
+	for name, count, properties in elements:
+		lists = [p for p in properties if isinstance(p[1], tuple)]
+
+		if not lists:
+			dtype = np.dtype([(p, byteOrder + t) for p, t in properties])
+			data = np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=(count,))
+			if name == "vertex":
+				vertices = np.column_stack([data["x"], data["y"], data["z"]]).astype(np.float32)
+				if all(n in dtype.names for n in ("nx", "ny", "nz")):
+					normals = np.column_stack([data["nx"], data["ny"], data["nz"]]).astype(np.float32)
+			offset += dtype.itemsize * count
+			continue
+
+		if name != "face" or len(lists) != 1 or properties[-1] is not lists[0]:
+			raise ValueError("unsupported PLY element: %s" % name)
+		countType, itemType = lists[0][1]
+		fields = [(p, byteOrder + t) for p, t in properties[:-1]]
+		dtype = np.dtype(fields + [("n", byteOrder + countType), ("i", byteOrder + itemType, 3)])
+
+		data = None
+		if offset + dtype.itemsize * count <= os.path.getsize(path):
+			data = np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=(count,))
+		if data is not None and np.all(data["n"] == 3):
+			indices = np.array(data["i"], dtype=np.int32)
+			offset += dtype.itemsize * count
+		else:
+			indices, offset = readPlyPolygons(path, offset, count, byteOrder, fields, countType, itemType)
+
+	if vertices is None or indices is None:
+		raise ValueError("PLY file needs vertex and face elements.")
+	return vertices, indices, normals, None
+
+
+def readPlyPolygons(path, offset, count, byteOrder, fields, countType, itemType):
+	head = np.dtype(fields + [("n", byteOrder + countType)])
+	item = np.dtype(byteOrder + itemType)
+	indices = array.array("i")
+	with open(path, "rb") as f:
+		f.seek(offset)
+		for face in range(count):
+			n = int(np.frombuffer(f.read(head.itemsize), dtype=head)["n"][0])
+			v = np.frombuffer(f.read(item.itemsize * n), dtype=item).tolist()
+			for i in range(1, n - 1):
+				indices.extend((v[0], v[i], v[i + 1]))
+		offset = f.tell()
+	return np.frombuffer(indices, dtype=np.int32).reshape(-1, 3), offset
+
+
+# BVH over the triangles of a mesh. Primitives are triangle indices.
+class MeshBVH(BVH):
+	def __init__(self, mesh, maxLeafSize=MESH_LEAF_SIZE, intersectionCost=MESH_INTERSECTION_COST):
+		self.mesh = mesh
+		corners = mesh.vertices[mesh.indices]
+		BVH.__init__(self, corners.min(axis=1), corners.max(axis=1), maxLeafSize, intersectionCost)
+
+	def intersectLeaf(self, primitives, ray, tMin, tMax):
+		m = self.mesh
+		d = intersectTriangles(m.v0[primitives], m.e1[primitives], m.e2[primitives], ray.origin, ray.direction, tMin, tMax)
+		i = int(np.argmin(d))
+		if d[i] == np.inf:
+			return np.inf, None
+		return d[i], primitives[i]
+
+	def intersectLeaf_many(self, primitives, origins, directions, tMin, tMax):
+		m = self.mesh
+		d = intersectTriangles(m.v0[primitives], m.e1[primitives], m.e2[primitives],
+							   origins[:, np.newaxis], directions[:, np.newaxis], tMin, np.asarray(tMax)[:, np.newaxis])
+		best = np.argmin(d, axis=1)
+		nearest = d[np.arange(len(origins)), best]
+		return nearest, np.where(nearest < np.inf, primitives[best], -1)
+
+	# counted apart from the Triangle objects of a scene, which are tested one by one.
+	def countTests(self, primitives, rays):
+		self.stats.countTests("MeshTriangle", len(primitives) * rays)
+
+	# returns (triangle, u, v) of the triangle the point lies on, with barycentric u and v of
+	# the point, searched through all boxes containing the point. if no triangle contains it
+	# within the tolerance the one with the nearest plane is used.
+	def locate(self, point):
+		m = self.mesh
+		tolerance = m.tolerance
+		best = (np.inf, -1, 0.0, 0.0)
+		stack = [0] if len(self.nodeLeft) else []
+		while stack:
+			node = stack.pop()
+			if np.any(point < self.nodeLo[node] - tolerance) or np.any(point > self.nodeHi[node] + tolerance):
+				continue
+			if self.nodeLeft[node] >= 0:
+				stack.extend((self.nodeLeft[node], self.nodeRight[node]))
+				continue
+
+			start = self.nodeStart[node]
+			primitives = self.order[start:start + self.nodeCount[node]]
+			w = point - m.v0[primitives]
+			planeDistance = np.abs(np.einsum("ij,ij->i", w, m.faceNormals[primitives]))
+			u, v = self.barycentric(primitives, w)
+			outside = np.maximum(np.maximum(-u, -v), u + v - 1.0)
+			# prefer triangles that contain the point, then the ones with the nearest plane.
+			score = planeDistance + np.where(outside > tolerance, m.size, 0.0)
+			i = int(np.argmin(score))
+			if score[i] < best[0]:
+				best = (score[i], primitives[i], u[i], v[i])
+		return best[1:]
+
+	def barycentric(self, primitives, w):
+		m = self.mesh
+		e1, e2 = m.e1[primitives], m.e2[primitives]
+		uu, uv, vv = np.einsum("ij,ij->i", e1, e1), np.einsum("ij,ij->i", e1, e2), np.einsum("ij,ij->i", e2, e2)
+		wu, wv = np.einsum("ij,ij->i", w, e1), np.einsum("ij,ij->i", w, e2)
+		with np.errstate(divide="ignore", invalid="ignore"):
+			D = uv * uv - uu * vv
+			u = np.nan_to_num((uv * wv - vv * wu) / D)
+			v = np.nan_to_num((uv * wu - uu * wv) / D)
+		return u, v
+
+
+# Triangle mesh stored as a struct of arrays: (V,3) float32 vertices, (T,3) int32 vertex
+# indices per triangle and optional normals. Normals are given per vertex, or as a separate
+# normal array with normalIndices per triangle corner like in OBJ files. With smooth and no
+# normals given, vertex normals are computed from the faces; otherwise the face normal is used.
+# The mesh is a single GeometryObject with its own BVH, the scene BVH only sees its bounds.
+class TriangleMesh(GeometryObject):
+	def __init__(self, vertices, indices, material=None, normals=None, normalIndices=None, smooth=True):
+		GeometryObject.__init__(self, material)
+		self.vertices = np.ascontiguousarray(vertices, dtype=np.float32).reshape(-1, 3)
+		self.indices = np.ascontiguousarray(indices, dtype=np.int32).reshape(-1, 3)
+
+		if normals is None and smooth:
+			normals = vertexNormals(self.vertices, self.indices)
+		if normals is not None:
+			normals = np.ascontiguousarray(normals, dtype=np.float32).reshape(-1, 3)
+			if normalIndices is None:
+				normalIndices = self.indices
+			normalIndices = np.ascontiguousarray(normalIndices, dtype=np.int32).reshape(-1, 3)
+		self.normals = normals
+		self.normalIndices = normalIndices
+
+		self.__precompute()
+		self.bvh = MeshBVH(self)
+
+	# loads an OBJ or binary PLY file, picked by the file extension.
+	@classmethod
+	def fromFile(cls, path, material=None, smooth=True):
+		extension = os.path.splitext(path)[1].lower()
+		if extension == ".obj":
+			vertices, indices, normals, normalIndices = loadObj(path)
+		elif extension == ".ply":
+			vertices, indices, normals, normalIndices = loadPly(path)
+		else:
+			raise ValueError("unknown mesh format: %s" % extension)
+		return cls(vertices, indices, material, normals, normalIndices, smooth)
+
+	# per triangle first vertex, edges and unit normal for intersection and point location.
+	def __precompute(self):
+		corners = self.vertices[self.indices]
+		self.v0 = corners[:, 0]
+		self.e1 = corners[:, 1] - corners[:, 0]
+		self.e2 = corners[:, 2] - corners[:, 0]
+		normals = np.cross(self.e1.astype(float), self.e2.astype(float))
+		lengths = np.sqrt(np.einsum("ij,ij->i", normals, normals))
+		self.faceNormals = (normals / np.where(lengths > 0, lengths, 1.0)[:, np.newaxis]).astype(np.float32)
+
+		lo, hi = self.bounds()
+		self.size = float(np.max(hi - lo)) if len(self.indices) else 0.0
+		self.tolerance = max(self.size, 1.0) * LOCATE_TOLERANCE
+
+	# scales and moves the mesh so its bounding box is centered on center and its longest
+	# side has the given size.
+	def fit(self, center, size):
+		lo, hi = self.bounds()
+		scale = size / max(float(np.max(hi - lo)), 1e-12)
+		self.vertices = ((self.vertices - (lo + hi) / 2.0) * scale + center).astype(np.float32)
+		self.__precompute()
+		self.bvh = MeshBVH(self)
+		return self
+
+	# moving a mesh doesn't change its tree, the copy gets the boxes of the BVH moved along
+	# instead of a new one. they are padded a little, since the vertices are float32.
+	def translated(self, offset):
+		mesh = copy.copy(self)
+		mesh.vertices = (self.vertices + offset).astype(np.float32)
+		mesh.__precompute()
+
+		padding = (np.max(np.abs(mesh.vertices)) if len(mesh.vertices) else 0.0) * 1e-6
+		mesh.bvh = copy.copy(self.bvh)
+		mesh.bvh.mesh = mesh
+		mesh.bvh.nodeLo = self.bvh.nodeLo + offset - padding
+		mesh.bvh.nodeHi = self.bvh.nodeHi + offset + padding
+		return mesh
+
+	def intersect(self, ray):
+		return [self.closestDistance(ray)]
+
+	def intersect_many(self, origins, directions, tMin=0.0):
+		return self.bvh.intersect_many(origins, directions, tMin)[0]
+
+	def closestDistance(self, ray, tMin=0.0, tMax=np.inf):
+		return self.bvh.closestHit(ray, tMin, tMax)[0]
+
+	def occludes(self, ray, tMin=0.0, tMax=np.inf):
+		return self.bvh.anyHit(ray, tMin, tMax)
+
+	def normalAt(self, point):
+		triangle, u, v = self.bvh.locate(np.asarray(point, dtype=float))
+		if triangle < 0:
+			return np.zeros(3)
+		if self.normals is None:
+			return self.faceNormals[triangle].astype(float)
+
+		n = self.normals[self.normalIndices[triangle]].astype(float)
+		normal = (1.0 - u - v) * n[0] + u * n[1] + v * n[2]
+		length = np.sqrt(np.dot(normal, normal))
+		if length == 0:
+			return self.faceNormals[triangle].astype(float)
+		return normal / length
+
+	def bounds(self):
+		if not len(self.vertices):
+			return np.zeros(3), np.zeros(3)
+		return self.vertices.min(axis=0).astype(float), self.vertices.max(axis=0).astype(float)
+
+	def __len__(self):
+		return len(self.indices)
+
+
+# uv sphere as a test mesh, with the given number of rings and segments.
+def uvSphere(center, radius, rings, segments, material=None, smooth=True):
+	theta = np.linspace(0, np.pi, rings + 1)[:, np.newaxis]
+	phi = np.linspace(0, 2 * np.pi, segments, endpoint=False)[np.newaxis, :]
+	directions = np.dstack([np.sin(theta) * np.cos(phi), np.cos(theta) * np.ones_like(phi), np.sin(theta) * np.sin(phi)]).reshape(-1, 3)
+
+	r, s = np.mgrid[0:rings, 0:segments]
+	a = r * segments + s
+	b = r * segments + (s + 1) % segments
+	c, d = a + segments, b + segments
+	indices = np.concatenate([np.dstack([a, c, b]).reshape(-1, 3), np.dstack([b, c, d]).reshape(-1, 3)])
+	return TriangleMesh(np.asarray(center) + radius * directions, indices, material, directions if smooth else None, smooth=smooth)
+
+
+if __name__ == "__main__":
+	import time
+	from geometry import Ray, Sphere
+
+	# a fine sphere mesh has to agree with the analytic sphere it approximates.
+	for rings in [20, 100, 250]:
+		start = time.time()
+		mesh = uvSphere([0, 0, 0], 1.0, rings, 2 * rings)
+		build = time.time() - start
+
+		random = np.random.RandomState(0)
+		origins = np.tile([0.0, 0.0, -5.0], (1000, 1))
+		directions = normalize_many(random.uniform(-0.15, 0.15, (1000, 3)) + [0, 0, 1])
+		start = time.time()
+		d = mesh.intersect_many(origins, directions)
+		packet = time.time() - start
+
+		sphere = Sphere([0, 0, 0], 1.0)
+		exact = sphere.intersect_many(origins, directions)
+		hit = exact < np.inf
+		error = np.max(np.abs(d[hit] - exact[hit])) if np.any(hit) else 0.0
+
+		point = origins[0] + directions[0] * d[0]
+		normal = mesh.normalAt(point)
+		s = mesh.bvh.statistics()
+		print "%7d triangles: build %.2fs, %d nodes, packet %.1fus/ray, distance error %.4f, normal error %.4f, scalar %s" % (
+			len(mesh), build, s["nodes"], packet / len(origins) * 1e6, error,
+			np.linalg.norm(normal - sphere.normalAt(point)), abs(mesh.closestDistance(Ray(origins[0], directions[0])) - d[0]) < 1e-6)
@@ -1,25 +1,374 @@
+import hashlib
+import math
 import multiprocessing
+import pickle
+import Queue
+import signal
+import time
 
-class BlockProcess(multiprocessing.Process):
-	def __init__(self, y_s, y_e, width, tracer, scene, dataQueue, finishedQueue):
+import numpy as np
+
+TILE_SIZE = 32
+
+
+# splits the image into tiles (x0, y0, x1, y1) of at most size x size pixels.
+# "spiral" orders them in rings around the center of the image, because that is where the
+# interesting part of a picture usually is. "cost" puts the most expensive tiles first, so
+# the cheap ones fill the gaps at the end, costs is then a list of estimates per tile.
+def makeTiles(width, height, size=TILE_SIZE, order="spiral", costs=None):
+	tiles = [(x, y, min(x + size, width), min(y + size, height)) for y in range(0, height, size) for x in range(0, width, size)]
+
+	if order == "spiral":
+		cx, cy = width / 2.0, height / 2.0
+
+		def ring(tile):
+			dx = ((tile[0] + tile[2]) / 2.0 - cx) / size
+			dy = ((tile[1] + tile[3]) / 2.0 - cy) / size
+			return int(round(max(abs(dx), abs(dy)))), math.atan2(dy, dx)
+		tiles.sort(key=ring)
+	elif order == "cost":
+		if costs is None:
+			raise ValueError("cost order needs cost estimates for the tiles.")
+		tiles = [t for c, t in sorted(zip(costs, tiles), key=lambda e: -e[0])]
+	elif order != "rows":
+		raise ValueError("unknown tile order: %s" % order)
+
+	return tiles
+
+
+# times a few primary rays per tile as a guess how long the tile will take.
+def estimateTileCosts(tiles, tracer, scene, samples=4):
+	costs = []
+	random = np.random.RandomState(0)
+	for x0, y0, x1, y1 in tiles:
+		xs = random.randint(x0, x1, samples)
+		ys = random.randint(y0, y1, samples)
+		origins, directions = scene.screen.primaryRays(scene.eye, xs, ys)
+
+		start = time.time()
+		tracer.trace_batch(origins, directions, scene.bvh, scene.lights)
+		costs.append(time.time() - start)
+	return costs
+
+
+# raised by the data queue of a service whose workers are all gone while tiles are left, e.g.
+# a distributed.Coordinator whose render nodes died. the local workers of a RenderService don't
+# go away on their own.
+class WorkersLost(Exception):
+	pass
+
+
+# settings of the workers of a RenderService.
+WORKER_CONFIG = {"tracer": None, "scene": None, "framebuffer": None, "progressive": False, "record": False, "animation": None, "stats": False}
+
+
+# what tells if a setting of the workers changed: the scene and the tracer are edited in place,
+# so their contents are hashed, framebuffers are shared memory, their files tell them apart.
+def configToken(key, value):
+	if key == "framebuffer":
+		return tuple(b.raw.path for b in (value if isinstance(value, list) else [value]) if b is not None)
+	if key in ("scene", "tracer", "animation") and value is not None:
+		from cache import hashValue
+		digest = hashlib.sha1()
+		hashValue(digest, value)
+		return digest.hexdigest()
+	return value
+
+
+# render process of a RenderService: pulls tiles from the shared tile queue until it gets None,
+# so fast workers simply take more tiles. every tile is traced as one packet of primary rays
+# and written into the shared framebuffer, progressive workers add one sample to the pixels
+# of an AccumulationBuffer that are not converged yet instead. with record, the summary of an
+# incremental.RayRecord of what the rays of the tile touched is sent along, with stats the
+# stats.RayStatistics of the tile.
+# workers of an animation.Animation get tiles tagged with a frame number as well, they render
+# the scene of that frame into framebuffer[frame % len(framebuffer)].
+# what the worker renders with (tracer, scene, framebuffer, progressive, record, animation, stats)
+# comes with the fork, changes arrive on its own config queue, tagged with a version. every
+# tile says which version it needs, so changes are only read when the first tile needs them.
+# every tile is reported on the data queue as (tile, rays cast, record, frame, job, workerId,
+# busy time, rendered, statistics), tiles of cancelled jobs are reported without rendering them.
+class TileWorker(multiprocessing.Process):
+	def __init__(self, workerId, config, tileQueue, configQueue, dataQueue, cancelled):
 		multiprocessing.Process.__init__(self)
-		self.y_s = y_s
-		self.y_e = y_e
-		self.tracer = tracer
-		self.scene = scene
-		self.width = width
+		self.daemon = True
+		self.workerId = workerId
+		self.tileQueue = tileQueue
+		self.configQueue = configQueue
 		self.dataQueue = dataQueue
-		self.finishedQueue = finishedQueue
+		self.cancelled = cancelled
+		self.version = 0
+		self.job = 0
+		self.configure(config)
+
+	def configure(self, config):
+		for key, value in config.items():
+			setattr(self, key, value)
+		self.frameScenes = {}
 
 	def run(self):
-		from geometry import Ray
-		for y in range(self.y_s, self.y_e):
-			for x in range(self.width):
-				R = Ray.fromPoints(p1=self.scene.eye, p2=self.scene.screen.pixelToWorldCoord((x, y)))
-				C = self.tracer.trace(R, self.scene.geometry, self.scene.lights).toHex()
-				self.dataQueue.put(((x,y), C))
-		self.finishedQueue.put("finished.")
-
-	@classmethod
-	def forCount(cls, processCount, width, height, tracer, scene, dataQueue, finishedQueue):
-		return [cls(y * height/processCount, (y+1) * height/processCount, width, tracer, scene, dataQueue, finishedQueue) for y in range(processCount)]
\ No newline at end of file
+		# ctrl-c is handled by the main process, which decides when to stop the workers.
+		signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+		for item in iter(self.tileQueue.get, None):
+			version, job, tile = item[0], item[1], item[2:]
+			while self.version < version:
+				self.version, changes = pickle.loads(self.configQueue.get())
+				self.configure(changes)
+			self.dataQueue.put(self.processTile(job, tile))
+
+	# renders the tile of the job unless the job is cancelled, returns what is reported for it.
+	def processTile(self, job, tile):
+		frame = tile[5] if len(tile) > 5 else None
+		if job <= self.cancelled.value:
+			return tile[:4], 0, None, frame, job, self.workerId, 0.0, False, None
+
+		tileStart = time.time()
+		rays = self.tracer.rays
+		self.tracer.record = None
+		if self.record:
+			from incremental import RayRecord
+			self.tracer.record = RayRecord(self.scene.geometry)
+		statistics = self.countStatistics()
+		self.job = job
+		rendered = self.renderTile(*tile)
+		summary = self.tracer.record.summary() if self.record else None
+		return tile[:4], self.tracer.rays - rays, summary, frame, job, self.workerId, time.time() - tileStart, rendered, statistics
+
+	# a new RayStatistics for the tracer and the BVHs to count into, None without stats.
+	def countStatistics(self):
+		from bvh import BVH
+
+		statistics = None
+		if self.stats:
+			from stats import RayStatistics
+			statistics = RayStatistics()
+		self.tracer.stats = BVH.stats = statistics
+		return statistics
+
+	# tiles of progressive renders carry the number of their pass, which is part of the seed.
+	# tiles of a preview carry a step: only every step-th pixel of every step-th row, counted
+	# from the corner of the tile, is traced and fills the step x step block below and right of
+	# it. pixels on the grid of reuse were traced by the coarser preview before and are skipped.
+	# a tile whose job is cancelled while it is traced is not written, the job after it may be
+	# tracing the same pixels already, renderTile returns if it was written.
+	def renderTile(self, x0, y0, x1, y1, samplePass=0, frame=None, step=1, reuse=0):
+		scene, framebuffer = self.scene, self.framebuffer
+		if frame is not None:
+			scene, framebuffer = self.frameScene(frame), framebuffer[frame % len(framebuffer)]
+
+		self.tracer.seed(samplePass, x0, y0)
+		ys, xs = np.mgrid[y0:y1, x0:x1]
+		if self.progressive:
+			active = framebuffer.active(x0, y0, x1, y1)
+			origins, directions = scene.screen.primaryRays(scene.eye, xs[active], ys[active])
+			colors = self.tracer.sample_batch(origins, directions, scene.bvh, scene.lights)
+			if self.cancelledMeanwhile():
+				return False
+			framebuffer.add(x0, y0, x1, y1, colors, active)
+		elif step > 1 or reuse:
+			dy, dx = np.mgrid[0:y1 - y0, 0:x1 - x0]
+			traced = (dx % step == 0) & (dy % step == 0)
+			if reuse:
+				traced &= (dx % reuse != 0) | (dy % reuse != 0)
+			origins, directions = scene.screen.primaryRays(scene.eye, xs[traced], ys[traced])
+			colors = np.zeros((y1 - y0, x1 - x0, 3))
+			colors[traced] = self.tracer.trace_batch(origins, directions, scene.bvh, scene.lights)
+
+			# the blocks of pixels traced before keep their colors.
+			cornerX, cornerY = dx - dx % step, dy - dy % step
+			fill = traced[cornerY, cornerX]
+			if self.cancelledMeanwhile():
+				return False
+			framebuffer.write(x0, y0, x1, y1, colors[cornerY[fill], cornerX[fill]], fill)
+		else:
+			origins, directions = scene.screen.primaryRays(scene.eye, xs.ravel(), ys.ravel())
+			colors = self.tracer.trace_batch(origins, directions, scene.bvh, scene.lights)
+			if self.cancelledMeanwhile():
+				return False
+			framebuffer.write(x0, y0, x1, y1, colors)
+		return True
+
+	def cancelledMeanwhile(self):
+		return self.job <= self.cancelled.value
+
+	# the scenes of the frames in flight are kept, tiles of two frames may come in turns. the
+	# tracers that shade with the eye position look from the eye of the frame.
+	def frameScene(self, frame):
+		if frame not in self.frameScenes:
+			if len(self.frameScenes) >= len(self.framebuffer):
+				del self.frameScenes[min(self.frameScenes)]
+			self.frameScenes[frame] = self.animation.frameScene(frame)
+		scene = self.frameScenes[frame]
+		if hasattr(self.tracer, "eye"):
+			self.tracer.eye = scene.eye
+		return scene
+
+
+# render processes that are started once and then render job after job, e.g. every image of
+# an interactive session. what the workers are started with comes with the fork, a job only
+# sends the settings that differ from the ones before, pickled once for all workers.
+class RenderService:
+	def __init__(self, processCount=None, **config):
+		if processCount is None:
+			processCount = multiprocessing.cpu_count()
+
+		self.tileQueue = multiprocessing.Queue()
+		self.dataQueue = multiprocessing.Queue()
+		self.configQueues = [multiprocessing.Queue() for i in range(processCount)]
+		# the highest cancelled job, the workers skip tiles of it and all jobs before.
+		self.cancelled = multiprocessing.RawValue("i", 0)
+
+		self.config = dict(WORKER_CONFIG, **config)
+		self.tokens = dict((key, configToken(key, value)) for key, value in self.config.items())
+		self.version = 0
+		self.jobs = 0
+		self.workers = [TileWorker(i, self.config, self.tileQueue, self.configQueues[i], self.dataQueue, self.cancelled) for i in range(processCount)]
+		for worker in self.workers:
+			worker.start()
+
+	# a new job rendering with the given settings, returns (job id, config version).
+	def newJob(self, **config):
+		changes = dict((key, value) for key, value in config.items() if configToken(key, value) != self.tokens[key])
+		if changes:
+			self.version += 1
+			message = pickle.dumps((self.version, changes), pickle.HIGHEST_PROTOCOL)
+			for queue in self.configQueues:
+				queue.put(message)
+			self.config.update(changes)
+			self.tokens.update((key, configToken(key, value)) for key, value in changes.items())
+
+		self.jobs += 1
+		return self.jobs, self.version
+
+	def submit(self, job, version, tiles):
+		for tile in tiles:
+			self.tileQueue.put((version, job) + tuple(tile))
+
+	def cancel(self, job):
+		self.cancelled.value = max(self.cancelled.value, job)
+
+	# lets the workers finish their tiles and exit.
+	def close(self):
+		for worker in self.workers:
+			self.tileQueue.put(None)
+		for worker in self.workers:
+			worker.join()
+
+	# stops the workers right away, without waiting for their tiles.
+	def terminate(self):
+		for worker in self.workers:
+			worker.terminate()
+			worker.join()
+
+
+# the data queue of a RenderService as one job sees it: (tile, rays cast, record, frame) for
+# its rendered tiles, everything else is counted and dropped. the time and the statistics of
+# the tiles go to the RenderStatistics of the pool.
+class JobQueue:
+	def __init__(self, pool):
+		self.pool = pool
+
+	def get(self, block=True, timeout=None):
+		while True:
+			tile, rays, record, frame, job, workerId, busy, rendered, statistics = self.pool.service.dataQueue.get(block, timeout)
+			if job != self.pool.job:
+				continue
+			self.pool.received += 1
+			if rendered:
+				# the workers of a distributed.Coordinator may connect while the job runs.
+				missing = workerId + 1 - len(self.pool.tiles)
+				if missing > 0:
+					self.pool.tiles += [0] * missing
+					self.pool.busy += [0.0] * missing
+				self.pool.tiles[workerId] += 1
+				self.pool.busy[workerId] += busy
+				if self.pool.statistics is not None:
+					self.pool.statistics.addTile(tile, workerId, busy, statistics)
+				return tile, rays, record, frame
+
+	def empty(self):
+		return self.pool.service.dataQueue.empty()
+
+
+# the tiles of one image, rendered by a RenderService: a private one that stops with the pool,
+# or a shared one that keeps running for the next image. start with close False keeps
+# accepting tiles, e.g. the next pass of a progressive render, until close is called.
+# with a stats.RenderStatistics the workers count what their rays do into it.
+class RenderPool:
+	def __init__(self, tracer, scene, framebuffer, processCount=None, progressive=False, record=False, animation=None, service=None, statistics=None):
+		config = {"tracer": tracer, "scene": scene, "framebuffer": framebuffer, "progressive": progressive, "record": record, "animation": animation, "stats": statistics is not None}
+		self.ownService = service is None
+		self.service = RenderService(processCount, **config) if service is None else service
+		self.job, self.version = self.service.newJob(**config)
+		self.workers = self.service.workers
+		self.dataQueue = JobQueue(self)
+		self.submitted, self.received = 0, 0
+		self.tiles = [0] * len(self.workers)
+		self.busy = [0.0] * len(self.workers)
+		self.stats = []
+		self.statistics = statistics
+		self.closed = False
+		self.startTime = time.time()
+
+	def start(self, tiles, close=True, samplePass=None):
+		self.startTime = time.time()
+		self.submit(tiles, samplePass)
+		if close:
+			self.close()
+
+	# tiles of a progressive pass are tagged with the number of the pass, tiles of an animation
+	# with the number of the pass and the frame, tiles of a preview with its step and the step
+	# of the preview before (see TileWorker.renderTile).
+	def submit(self, tiles, samplePass=None, frame=None, step=None, reuse=0):
+		if step is not None:
+			tiles = [tuple(tile[:4]) + (samplePass or 0, frame, step, reuse) for tile in tiles]
+		elif frame is not None:
+			tiles = [tuple(tile[:4]) + (samplePass or 0, frame) for tile in tiles]
+		elif samplePass is not None:
+			tiles = [tuple(tile) + (samplePass,) for tile in tiles]
+		self.service.submit(self.job, self.version, tiles)
+		self.submitted += len(tiles)
+
+	# no more tiles, join waits for the ones submitted.
+	def close(self):
+		self.closed = True
+
+	# stops rendering without waiting for the tiles: a private service is stopped right away,
+	# on a shared one the rest of the tiles is skipped and only those in progress are waited for.
+	# returns what the data queue returns for the tiles that were finished meanwhile.
+	def terminate(self):
+		if self.ownService:
+			self.service.terminate()
+			return []
+
+		self.service.cancel(self.job)
+		return self.__drain()
+
+	# with a timeout, the data queue doesn't return for skipped tiles, even the last one.
+	def __drain(self):
+		tiles = []
+		while self.received < self.submitted:
+			try:
+				tiles.append(self.dataQueue.get(timeout=0.1))
+			except Queue.Empty:
+				continue
+		return tiles
+
+	# waits for all tiles, returns (workerId, tiles, busy time, wall time) per worker.
+	def join(self):
+		self.__drain()
+		self.wallTime = time.time() - self.startTime
+		if self.statistics is not None:
+			self.statistics.finish()
+		if self.ownService:
+			self.service.close()
+
+		self.stats = [(i, self.tiles[i], self.busy[i], self.wallTime) for i in range(len(self.tiles))]
+		return self.stats
+
+	def utilization(self):
+		lines = []
+		for workerId, tiles, busy, lifetime in self.stats:
+			lines.append("Worker %d: %4d tiles, busy %6.2fs of %6.2fs (%5.1f%%)" % (workerId, tiles, busy, self.wallTime, 100.0 * busy / max(self.wallTime, 1e-9)))
+		return "\n".join(lines)
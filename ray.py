@@ -1,71 +1,155 @@
 #!/usr/bin/python
 
-from geometry import Plane, Sphere, Triangle, Cube
-from scene import Screen, Scene
+from geometry import Sphere
+from scenefile import loadScene, applyTracerSettings, DEFAULT_SCENE
 from tracer import SimpleRayTracer, SimpleShadowRayTracer, ShadingShadowRayTracer, RecursiveRayTracer, PathTracer
 from material import Material, Color
-from window import Window
 
-if __name__ == "__main__":
-	p1 = Plane([0, 5, 0], [0, -1, 0], Material(Color(255, 0, 0), 1, 0, 0.1))
-	p2 = Plane([0, -5, 0], [0, 1, 0], Material(Color(0, 255, 0), 1, 0, 0.1))
-	p3 = Plane([5, 0, 0], [-1, 0, 0], Material(Color(0, 0, 255), 1, 0, 0.1))
-	p4 = Plane([-5, 0, 0], [1, 0, 0], Material(Color(255, 255, 0), 1, 0, 0.1))
-	p5 = Plane([0, 0, 5], [0, 0, -1], Material(Color(255, 0, 255), 1, 0, 0.1))
-	p6 = Plane([0, 0, -5], [0, 0, 1], Material(Color(0, 255, 255), 1, 0, 0.1))
 
-	s1 = Sphere([0, 3, 2], 2, Material(Color(100, 100, 100), 1, 0, 0.1, refractive=False, n=1.52))
-	s2 = Sphere([4, 2, 1], 0.5, Material(Color(100, 100, 100), 1, 0, 0.1, refractive=False, n=1.52))
-	s3 = Sphere([-3, 2, 1], 1, Material(Color(100, 100, 100), 1, 0, 0.1, refractive=False, n=1.52))
-	s4 = Sphere([2, -2, 1], 0.8, Material(Color(100, 100, 100), 1, 0, 0.1, refractive=False, n=1.52))
+# the reference scene, scenes/default.json: a room of six colored planes with four spheres,
+# lit by two sphere lights, seen through a screen of width x height pixels. benchmark.py
+# renders it as well.
+def referenceScene(width, height):
+	return loadScene(DEFAULT_SCENE, width, height)[0]
+
 
-	center = [0, 4, 0]
-	length = 2
-	cube_color = Color(125, 125, 125)
+# the names of the tracers on the command line, in the order they build on each other.
+TRACERS = ["Simple", "Shadow", "ShadingShadow", "Recursive", "PathTracing"]
 
-	#c1 = Cube(center, length, Material(cube_color, 1, 1, 0.1))
 
-	l1 = Sphere([-3, -2.5, 3], 1, Material(Color(255, 255, 255), 1, 1, 1))
-	l2 = Sphere([3, -2.5, -3], 1, Material(Color(255, 255, 255), 1, 1, 1))
+# the tracer of the given name for the scene, None for an unknown name.
+def makeTracer(name, scene, seed=0):
+	if name == "Simple":
+		return SimpleRayTracer()
+	elif name == "Shadow":
+		return SimpleShadowRayTracer()
+	elif name == "ShadingShadow":
+		return ShadingShadowRayTracer(scene.eye)
+	elif name == "Recursive":
+		return RecursiveRayTracer(scene.eye)
+	elif name == "PathTracing":
+		return PathTracer(scene.eye, seed)
+	return None
 
-	eye = [0, 0, -4.9]
 
+if __name__ == "__main__":
 	import argparse
+	from checkpoint import Checkpoint, CHECKPOINT_EVERY
+	from imagefile import ImageOutput, TONE_MAPS, HDR_FORMATS
 	parser = argparse.ArgumentParser(description="Ray Tracing in Python.")
-	parser.add_argument("-r", "--render", help="activate non-interactive rendering into a file.", nargs=2,
+	parser.add_argument("-r", "--render", help="activate non-interactive rendering into a file, with the tracer of the scene file if no ALGORITHM is given.", nargs="+",
 						metavar=("FILENAME", "ALGORITHM"))
-	parser.add_argument("--width", type=int, help="width of the image.", default=200)
-	parser.add_argument("--height", type=int, help="height of the image.", default=200)
+	parser.add_argument("--scene", help="JSON or YAML scene file, see scenefile.py, defaults to scenes/default.json.", default=DEFAULT_SCENE)
+	parser.add_argument("--width", type=int, help="width of the image, defaults to the resolution of the scene file.")
+	parser.add_argument("--height", type=int, help="height of the image, defaults to the resolution of the scene file.")
+	parser.add_argument("--processes", type=int, help="number of render processes, defaults to the number of cpus.")
+	parser.add_argument("--tile-size", type=int, help="edge length of the tiles handed to the render processes.")
+	parser.add_argument("--tile-order", help="order in which tiles are rendered.", default="spiral",
+						choices=["spiral", "cost", "rows"])
+	parser.add_argument("--mesh", help="OBJ or binary PLY file to place in the middle of the room.")
+	parser.add_argument("--samples", type=int, help="render progressively, one sample per pixel and pass, up to this many samples.")
+	parser.add_argument("--time-budget", type=float, help="render progressively until the next pass would exceed this many seconds.")
+	parser.add_argument("--dump-every", type=int, help="save the image every that many passes of a progressive render.")
+	parser.add_argument("--noise", type=float, help="adaptive sampling: stop sampling pixels whose relative standard error is below this.")
+	parser.add_argument("--min-samples", type=int, help="samples every pixel gets before adaptive sampling may stop it.")
+	parser.add_argument("--seed", type=int, help="seed of the random numbers of the path tracer, defaults to the seed of the scene file or 0.")
+	parser.add_argument("--cache", help="directory of a render cache, finished frames and tiles are reused from there.")
+	parser.add_argument("--frames", type=int, help="render an animation of that many frames: the camera circles the room while a sphere bounces, saved as FILENAME_0000.png and so on.")
+	parser.add_argument("--cache-size", type=int, help="size limit of the render cache in megabytes.", default=512)
+	parser.add_argument("--stats", action="store_true", help="count rays by kind, intersection tests by primitive type and the time of every tile, and print a summary after rendering.")
+	parser.add_argument("--stats-file", help="like --stats, and write the statistics to STATS_FILE.json and a heatmap of the time per pixel to STATS_FILE_heatmap.png.")
+	parser.add_argument("--no-preview", action="store_true", help="interactive mode: render at full resolution right away instead of coarse to fine.")
+	parser.add_argument("--tone-map", help="how the radiance is mapped to the colors of the PNG.", default="clamp", choices=TONE_MAPS)
+	parser.add_argument("--exposure", type=float, help="factor of the radiance before tone mapping.", default=1.0)
+	parser.add_argument("--hdr", nargs="+", help="also save the unclamped radiance as FILENAME.pfm, .npy or .exr (needs OpenEXR).", default=[], choices=HDR_FORMATS)
+	parser.add_argument("--checkpoint-every", type=int, help="save the state of the render to FILENAME_checkpoint.npz every that many tiles, at the end of a pass for progressive renders, and on ctrl-c.", default=CHECKPOINT_EVERY)
+	parser.add_argument("--resume", action="store_true", help="continue the render from FILENAME_checkpoint.npz.")
+	parser.add_argument("--listen", help="render on other machines: wait on [HOST:]PORT for render nodes started with distributed.py worker HOST:PORT. HOST defaults to 127.0.0.1, name it, e.g. 0.0.0.0, to accept nodes of other machines.")
+	parser.add_argument("--nodes", type=int, help="with --listen, the number of render processes to wait for before rendering.", default=1)
+	parser.add_argument("--authkey", help="with --listen, the secret key shared with the render nodes, required.")
 
 	args = parser.parse_args()
+	if args.render is not None and len(args.render) > 2:
+		parser.error("-r takes FILENAME and optionally ALGORITHM.")
+	if args.listen is not None and (args.render is None or args.frames is not None):
+		parser.error("--listen renders single images with -r.")
+	if args.listen is not None and not args.authkey:
+		parser.error("--listen needs an --authkey, the render nodes run what the coordinator sends.")
 
-	WIDTH = args.width
-	HEIGHT = args.height
-	bla = 10.0 / WIDTH
-	screen = Screen([0, 0, -1], [0, 0, -1], WIDTH, HEIGHT, bla)
-	scene = Scene(eye=eye, screen=screen, geometry=[p1, p2, p3, p4, p5, p6, s1, s2, s3, s4], lights=[l1,l2])
+	try:
+		scene, settings = loadScene(args.scene, args.width, args.height)
+	except (IOError, ValueError) as e:
+		print "Could not load the scene: %s" % e
+		exit(1)
+	WIDTH = scene.screen.resolutionX
+	HEIGHT = scene.screen.resolutionY
+	geometry = scene.geometry
+	# the edits of the window and the bouncing sphere of the animation are made to the spheres
+	# the scene file names bigSphere and bouncingSphere, scenes without them have none.
+	s1, s4 = scene.names.get("bigSphere"), scene.names.get("bouncingSphere")
+	if args.mesh:
+		from mesh import TriangleMesh
+		mesh = TriangleMesh.fromFile(args.mesh, Material(Color(200, 200, 200), 1, 0.5, 0.1))
+		geometry.append(mesh.fit([0, -1, 1], 4))
+		scene.buildAccelerator()
+		print "Mesh: %d triangles, BVH built in %.2fs" % (len(mesh), mesh.bvh.buildTime)
 
 	if not args.render is None:
-		print "rendering mode into: %s with %s" % (args.render[0], args.render[1])
+		name = args.render[1] if len(args.render) > 1 else settings.get("name")
+		if name is None:
+			parser.error("the scene file names no tracer, -r needs FILENAME ALGORITHM.")
+		print "rendering mode into: %s with %s" % (args.render[0], name)
 		from filerenderer import FileRenderer
 
-		value = args.render[1]
-
-		if value == "Simple":
-			tracer = SimpleRayTracer()
-		elif value == "Shadow":
-			tracer = SimpleShadowRayTracer()
-		elif value == "ShadingShadow":
-			tracer = ShadingShadowRayTracer(scene.eye)
-		elif value == "Recursive":
-			tracer = RecursiveRayTracer(scene.eye)
-		elif value == "PathTracing":
-			tracer = PathTracer(scene.eye)
-		else:
+		tracer = makeTracer(name, scene, args.seed if args.seed is not None else settings.get("seed", 0))
+		if tracer is None:
 			print "Unknown Ray-Tracer Algorithm. Exiting ..."
 			exit(1)
+		applyTracerSettings(tracer, settings)
+
+		cache = None
+		if args.cache:
+			from cache import RenderCache
+			cache = RenderCache(args.cache, args.cache_size * 1024 * 1024)
 
-		renderer = FileRenderer(WIDTH, HEIGHT, tracer, scene)
-		renderer.render(args.render[0])
+		output = ImageOutput(args.hdr, args.tone_map, args.exposure)
+		checkpoint = Checkpoint(args.render[0] + "_checkpoint.npz", args.checkpoint_every)
+		service = None
+		if args.listen is not None:
+			from distributed import Coordinator, parseAddress
+
+			service = Coordinator(parseAddress(args.listen), args.authkey)
+			print "Waiting for %d render nodes on %s:%d..." % ((args.nodes,) + service.address)
+			service.waitForWorkers(args.nodes)
+		renderer = FileRenderer(WIDTH, HEIGHT, tracer, scene, args.processes, args.tile_size, args.tile_order, cache, args.stats, args.stats_file, output, checkpoint, service)
+		if args.frames is not None:
+			from animation import Animation, AnimationRenderer, Keyframes, turntable
+
+			bounce = Keyframes([(0, [0, 0, 0]), (args.frames / 2, [0, 2.5, 0]), (args.frames - 1, [0, 0, 0])])
+			animation = Animation(scene, args.frames, turntable([0, 0, 1], 3.5, args.frames), {geometry.index(s4): bounce} if s4 is not None else {})
+			AnimationRenderer(animation, tracer, args.processes, args.tile_size, args.tile_order, args.stats, args.stats_file, output).render(args.render[0])
+		else:
+			from processes import WorkersLost
+
+			try:
+				if args.samples is not None or args.time_budget is not None or args.noise is not None:
+					renderer.renderProgressive(args.render[0], args.samples, args.time_budget, args.dump_every, args.noise, args.min_samples, args.resume)
+				else:
+					renderer.render(args.render[0], args.resume)
+			except KeyboardInterrupt:
+				print "\nStopped."
+				exit(130)
+			except WorkersLost as e:
+				print "\nStopped: %s" % e
+				exit(1)
+		renderer.close()
 	else:
-		window = Window(WIDTH, HEIGHT, scene, tracer=SimpleRayTracer())
+		from window import Window
+
+		# scene edits for the Edit button of the window, only the tiles they change are traced again.
+		edits = []
+		if isinstance(s1, Sphere):
+			edits.append(lambda records: records.replaceObject(geometry.index(s1), Sphere(s1.center, s1.radius, Material(Color(200, 120, 50), 1, 0, 0.1))))
+		if s4 is not None:
+			edits.append(lambda records: records.replaceObject(geometry.index(s4), s4.translated([0, 1, 0])))
+		window = Window(WIDTH, HEIGHT, scene, tracer=SimpleRayTracer(), processes=args.processes, tileSize=args.tile_size, maxSamples=args.samples, noise=args.noise, edits=edits, preview=not args.no_preview)
@@ -0,0 +1,101 @@
+#!/usr/bin/python
+
+import numpy as np
+
+
+# random number generator for a seed, which may be a sequence of ints like (seed, pass, x, y).
+# numpy's Generator where it exists, RandomState on older numpy. both are only used through
+# uniform, which they have in common.
+def generator(seed=None):
+	if hasattr(np.random, "default_rng"):
+		return np.random.default_rng(seed)
+	return np.random.RandomState(seed)
+
+
+# two unit vectors that form an orthonormal basis with every row of the (N,3) unit normals,
+# without branches (Duff et al., "Building an Orthonormal Basis, Revisited", 2017).
+def orthonormalBasis_many(normals):
+	x, y, z = normals[:, 0], normals[:, 1], normals[:, 2]
+	sign = np.where(z >= 0, 1.0, -1.0)
+	a = -1.0 / (sign + z)
+	b = x * y * a
+	tangents = np.column_stack([1.0 + sign * x * x * a, sign * b, -sign * x])
+	bitangents = np.column_stack([b, sign + y * y * a, -y])
+	return tangents, bitangents
+
+
+# directions in the hemispheres around the normals, distributed with a density proportional
+# to the cosine to the normal (cos / pi). u1 and u2 are uniform random numbers in [0, 1).
+def cosineHemisphere_many(normals, u1, u2):
+	r = np.sqrt(u1)
+	phi = 2 * np.pi * u2
+	tangents, bitangents = orthonormalBasis_many(normals)
+	return (tangents * (r * np.cos(phi))[:, np.newaxis] + bitangents * (r * np.sin(phi))[:, np.newaxis]
+			+ normals * np.sqrt(np.maximum(1.0 - u1, 0))[:, np.newaxis])
+
+
+# directions from the points towards a sphere, uniformly distributed over the cone in which
+# the sphere is seen. returns (directions, distances to the near side of the sphere, density
+# per solid angle), the density is 0 for points inside the sphere.
+def sampleSphere_many(points, center, radius, u1, u2):
+	w = center - points
+	d2 = np.einsum("ij,ij->i", w, w)
+	d = np.sqrt(d2)
+	w /= d[:, np.newaxis]
+
+	outside = d2 > radius * radius
+	cosMax = np.sqrt(np.maximum(1.0 - radius * radius / d2, 0))
+	cos = 1.0 - u1 * (1.0 - cosMax)
+	sin = np.sqrt(np.maximum(1.0 - cos * cos, 0))
+	phi = 2 * np.pi * u2
+	tangents, bitangents = orthonormalBasis_many(w)
+	directions = tangents * (sin * np.cos(phi))[:, np.newaxis] + bitangents * (sin * np.sin(phi))[:, np.newaxis] + w * cos[:, np.newaxis]
+
+	projection = d * cos
+	distances = projection - np.sqrt(np.maximum(radius * radius - (d2 - projection * projection), 0))
+	return directions, distances, np.where(outside, sphereDensity_many(points, center, radius), 0.0)
+
+
+# density per solid angle of sampleSphere_many: one over the solid angle of the cone.
+def sphereDensity_many(points, center, radius):
+	w = center - points
+	d2 = np.einsum("ij,ij->i", w, w)
+	cosMax = np.sqrt(np.maximum(1.0 - radius * radius / d2, 0))
+	with np.errstate(divide="ignore"):
+		return np.where(d2 > radius * radius, 1.0 / (2 * np.pi * (1.0 - cosMax)), 0.0)
+
+
+# multiple importance sampling weight of a sample with density a, that could also have been
+# drawn with density b by another strategy (veach's power heuristic with exponent 2).
+def powerHeuristic(a, b):
+	a2, b2 = a * a, b * b
+	with np.errstate(divide="ignore", invalid="ignore"):
+		return np.where(a2 + b2 > 0, a2 / (a2 + b2), 0.0)
+
+
+if __name__ == "__main__":
+	random = generator(0)
+	normals = random.normal(size=(100000, 3))
+	normals /= np.sqrt(np.einsum("ij,ij->i", normals, normals))[:, np.newaxis]
+
+	t, b = orthonormalBasis_many(normals)
+	for u, v in [(t, b), (t, normals), (b, normals)]:
+		assert np.allclose(np.einsum("ij,ij->i", u, v), 0)
+	assert np.allclose(np.einsum("ij,ij->i", t, t), 1) and np.allclose(np.einsum("ij,ij->i", b, b), 1)
+
+	d = cosineHemisphere_many(normals, random.uniform(size=len(normals)), random.uniform(size=len(normals)))
+	cos = np.einsum("ij,ij->i", d, normals)
+	assert np.allclose(np.einsum("ij,ij->i", d, d), 1) and np.all(cos >= 0)
+	# for a density of cos / pi the mean cosine is 2/3.
+	assert abs(np.mean(cos) - 2.0 / 3.0) < 0.01
+
+	# every direction of the cone hits the sphere at the returned distance.
+	points = random.uniform(-5, 5, (100000, 3))
+	d, t, pdf = sampleSphere_many(points, np.array([1.0, 2.0, 0.5]), 0.7, random.uniform(size=len(points)), random.uniform(size=len(points)))
+	outside = pdf > 0
+	hits = points + d * t[:, np.newaxis] - [1.0, 2.0, 0.5]
+	assert np.allclose(np.sqrt(np.einsum("ij,ij->i", hits, hits))[outside], 0.7)
+	assert abs(powerHeuristic(np.array([1.0]), np.array([1.0]))[0] - 0.5) < 1e-12
+
+	assert np.array_equal(generator((1, 2, 3)).uniform(size=4), generator((1, 2, 3)).uniform(size=4))
+	print "sampling ok"
@@ -1,11 +1,14 @@
 #!/usr/bin/python
 import numpy as np
 
-from geometry import Plane
+from bvh import ObjectBVH
+from geometry import Plane, normalize, normalize_many
 
 
+# names is {name: object} of objects of the geometry that are looked up by name, e.g. the ones
+# a scene file names.
 class Scene:
-	def __init__(self, eye, screen, geometry=None, lights=None):
+	def __init__(self, eye, screen, geometry=None, lights=None, names=None):
 		if geometry is None:
 			geometry = []
 
@@ -16,19 +19,58 @@ class Scene:
 		self.screen = screen
 		self.geometry = geometry
 		self.lights = lights
+		self.names = names or {}
+		self.buildAccelerator()
 
+	# (re)builds the BVH over the geometry, has to be called again after the geometry changed.
+	def buildAccelerator(self):
+		self.bvh = ObjectBVH(self.geometry)
 
+
+# the pixels of the image on a plane in world space. without axes the pixel rows run along x
+# and the columns along y, right and up turn the screen for cameras looking elsewhere.
 class Screen(Plane):
-	def __init__(self, origin, normal, resolutionX, resolutionY, pixelSizeInWorldCoords):
+	def __init__(self, origin, normal, resolutionX, resolutionY, pixelSizeInWorldCoords, right=None, up=None):
 		Plane.__init__(self, origin, normal)
 		self.resolutionX = resolutionX
 		self.resolutionY = resolutionY
 		self.pixelSizeInWorldCoords = pixelSizeInWorldCoords
 		self.width = resolutionX * pixelSizeInWorldCoords
 		self.height = resolutionY * pixelSizeInWorldCoords
+		self.right = None if right is None else normalize(np.array(right, dtype=float))
+		self.up = None if up is None else normalize(np.array(up, dtype=float))
+
+	# the screen of a camera at eye looking at target, distance in front of the eye. up is the
+	# direction that should point up in the image.
+	@classmethod
+	def lookAt(cls, eye, target, resolutionX, resolutionY, pixelSizeInWorldCoords, distance, up=(0, 1, 0)):
+		forward = normalize(np.asarray(target, dtype=float) - eye)
+		right = normalize(np.cross(up, forward))
+		return cls(eye + forward * distance, -forward, resolutionX, resolutionY, pixelSizeInWorldCoords, right, np.cross(forward, right))
 
 	def pixelToWorldCoord(self, pixel):
+		if self.right is not None:
+			return self.pixelsToWorldCoords([pixel[0]], [pixel[1]])[0].tolist()
 		x = self.origin[0] - self.width / 2.0 + pixel[0] * self.pixelSizeInWorldCoords
 		y = self.origin[1] - self.height / 2.0 + pixel[1] * self.pixelSizeInWorldCoords
 		z = self.origin[2]
 		return [x, y, z]
+
+	# vectorized pixelToWorldCoord, takes arrays of pixel coordinates and returns a (N,3) array.
+	def pixelsToWorldCoords(self, xs, ys):
+		if self.right is not None:
+			u = -self.width / 2.0 + np.asarray(xs) * self.pixelSizeInWorldCoords
+			v = -self.height / 2.0 + np.asarray(ys) * self.pixelSizeInWorldCoords
+			return self.origin + u[:, np.newaxis] * self.right + v[:, np.newaxis] * self.up
+
+		points = np.empty((len(xs), 3))
+		points[:, 0] = self.origin[0] - self.width / 2.0 + np.asarray(xs) * self.pixelSizeInWorldCoords
+		points[:, 1] = self.origin[1] - self.height / 2.0 + np.asarray(ys) * self.pixelSizeInWorldCoords
+		points[:, 2] = self.origin[2]
+		return points
+
+	# origins and normalized directions of the primary rays through the given pixels.
+	def primaryRays(self, eye, xs, ys):
+		points = self.pixelsToWorldCoords(xs, ys)
+		origins = np.tile(np.asarray(eye, dtype=float), (len(points), 1))
+		return origins, normalize_many(points - origins)
@@ -0,0 +1,338 @@
+#!/usr/bin/python
+
+import json
+import os
+
+import numpy as np
+
+from geometry import Plane, Sphere, Triangle, Cube
+from material import Material, Color
+from scene import Screen, Scene
+
+# where the scenes that come with raypy are, default.json is the scene of ray.py.
+SCENES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "scenes")
+DEFAULT_SCENE = os.path.join(SCENES, "default.json")
+
+# resolution of scenes that give none.
+DEFAULT_RESOLUTION = (200, 200)
+
+# the tracer settings of a scene file besides name and seed, and the constants they set.
+TRACER_SETTINGS = {"maxDepth": "MAX_DEPTH", "raysPerPixel": "RAY_PER_PIXEL", "rouletteDepth": "ROULETTE_DEPTH"}
+
+# what every entry of a scene file may hold, entries with anything else are rejected, so
+# typos don't go unnoticed.
+KEYS = {
+	"scene": ["camera", "materials", "objects", "lights", "tracer"],
+	"camera": ["eye", "resolution", "screen", "target", "distance", "width", "up"],
+	"screen": ["origin", "normal", "width", "right", "up"],
+	"material": ["color", "diffuse", "specular", "ambient", "refractive", "n"],
+	"plane": ["type", "name", "origin", "normal", "material"],
+	"sphere": ["type", "name", "center", "radius", "material"],
+	"triangle": ["type", "name", "vertices", "material"],
+	"cube": ["type", "name", "center", "length", "material"],
+	"mesh": ["type", "name", "file", "material", "smooth", "fit"],
+	"spheres": ["type", "name", "centers", "radii", "file", "material"],
+	"tracer": ["name", "seed"] + sorted(TRACER_SETTINGS),
+}
+
+
+# the PyYAML module, which is only imported for YAML scene files.
+def yamlModule():
+	try:
+		import yaml
+	except ImportError:
+		raise ImportError("reading YAML scene files needs the PyYAML module.")
+	return yaml
+
+
+# reads the description of a scene from a JSON file, or a YAML file with PyYAML installed.
+def readDescription(path):
+	with open(path) as f:
+		if os.path.splitext(path)[1].lower() in (".yaml", ".yml"):
+			return yamlModule().safe_load(f)
+		return json.load(f)
+
+
+def fail(where, message):
+	raise ValueError("%s: %s" % (where, message))
+
+
+def checkKeys(entry, kind, where):
+	if not isinstance(entry, dict):
+		fail(where, "expected an object")
+	unknown = sorted(set(entry) - set(KEYS[kind]))
+	if unknown:
+		fail(where, "unknown %s" % ", ".join(unknown))
+
+
+def required(entry, key, where):
+	if key not in entry:
+		fail(where, "%s is missing" % key)
+	return entry[key]
+
+
+# numbers and vectors are passed on as they are in the file, integers stay integers.
+def number(value, where, positive=False):
+	if isinstance(value, bool) or not isinstance(value, (int, long, float)):
+		fail(where, "expected a number, got %r" % (value,))
+	if positive and value <= 0:
+		fail(where, "has to be positive, got %r" % (value,))
+	return value
+
+
+def vector(value, where, size=3):
+	if not isinstance(value, list) or len(value) != size:
+		fail(where, "expected a list of %d numbers, got %r" % (size, value))
+	return [number(v, "%s[%d]" % (where, i)) for i, v in enumerate(value)]
+
+
+# a material is given in place or as the name of one of the materials of the scene.
+def makeMaterial(value, materials, where):
+	if isinstance(value, basestring):
+		if value not in materials:
+			fail(where, "unknown material %s" % value)
+		return materials[value]
+
+	checkKeys(value, "material", where)
+	color = vector(required(value, "color", where), where + ".color")
+	if not all(0 <= c <= 255 for c in color):
+		fail(where + ".color", "channels have to be in 0..255, got %r" % (color,))
+	refractive = value.get("refractive", False)
+	if not isinstance(refractive, bool):
+		fail(where + ".refractive", "expected true or false, got %r" % (refractive,))
+	return Material(Color(*color), number(required(value, "diffuse", where), where + ".diffuse"), number(required(value, "specular", where), where + ".specular"),
+					number(value.get("ambient", 0), where + ".ambient"), refractive, number(value.get("n", 1), where + ".n", positive=True))
+
+
+# (centers, radii) of a sphere set, given in the file or as an .npz or .npy file of them
+# next to it: an .npz holds the arrays centers and radii, an .npy (N,4) rows of x, y, z and
+# the radius. the binary files are the faster way for millions of spheres.
+def sphereArrays(entry, directory, where):
+	if "file" in entry:
+		if "centers" in entry or "radii" in entry:
+			fail(where, "spheres come from a file or from centers and radii, not both")
+		path = os.path.join(directory, entry["file"])
+		if path.lower().endswith(".npz"):
+			with np.load(path) as data:
+				centers, radii = data["centers"], data["radii"]
+		else:
+			data = np.load(path)
+			if data.ndim != 2 or data.shape[1] != 4:
+				fail(where + ".file", "expected (N,4) rows of x, y, z and the radius")
+			centers, radii = data[:, :3], data[:, 3]
+	else:
+		centers, radii = required(entry, "centers", where), required(entry, "radii", where)
+
+	try:
+		centers = np.array(centers, dtype=float)
+		radii = np.array(radii, dtype=float)
+	except (TypeError, ValueError):
+		fail(where, "centers and radii have to be numbers")
+	if centers.ndim != 2 or centers.shape[1] != 3:
+		fail(where + ".centers", "expected a list of [x, y, z]")
+	if radii.ndim > 1 or (radii.ndim == 1 and len(radii) != len(centers)):
+		fail(where + ".radii", "expected one radius or one per center")
+	if not np.all(np.isfinite(centers)) or not np.all(radii > 0):
+		fail(where, "centers have to be finite and radii positive")
+	return centers, radii
+
+
+def makeObject(entry, materials, directory, where):
+	kind = required(entry, "type", where) if isinstance(entry, dict) else None
+	if kind not in ("plane", "sphere", "triangle", "cube", "mesh", "spheres"):
+		fail(where, "unknown type %r" % (kind,))
+	checkKeys(entry, kind, where)
+	material = makeMaterial(required(entry, "material", where), materials, where + ".material")
+
+	if kind == "plane":
+		return Plane(vector(required(entry, "origin", where), where + ".origin"), vector(required(entry, "normal", where), where + ".normal"), material)
+	if kind == "sphere":
+		return Sphere(vector(required(entry, "center", where), where + ".center"), number(required(entry, "radius", where), where + ".radius", positive=True), material)
+	if kind == "triangle":
+		vertices = required(entry, "vertices", where)
+		if not isinstance(vertices, list) or len(vertices) != 3:
+			fail(where + ".vertices", "expected three vertices")
+		return Triangle(*[vector(v, "%s.vertices[%d]" % (where, i)) for i, v in enumerate(vertices)] + [material])
+	if kind == "cube":
+		return Cube(vector(required(entry, "center", where), where + ".center"), number(required(entry, "length", where), where + ".length", positive=True), material)
+	if kind == "mesh":
+		from mesh import TriangleMesh
+		mesh = TriangleMesh.fromFile(os.path.join(directory, required(entry, "file", where)), material, entry.get("smooth", True))
+		if "fit" in entry:
+			fit = entry["fit"]
+			if not isinstance(fit, dict) or sorted(fit) != ["center", "size"]:
+				fail(where + ".fit", "expected center and size")
+			mesh.fit(vector(fit["center"], where + ".fit.center"), number(fit["size"], where + ".fit.size", positive=True))
+		return mesh
+
+	from sphereset import SphereSet
+	centers, radii = sphereArrays(entry, directory, where)
+	return SphereSet(centers, radii, material)
+
+
+# the eye and the screen. the screen is given as a plane with the width it has in the scene,
+# or by a target the camera looks at, the distance of the screen from the eye and its width.
+# the resolution of the file is used unless one is given.
+def makeCamera(entry, width, height, where):
+	checkKeys(entry, "camera", where)
+	eye = vector(required(entry, "eye", where), where + ".eye")
+	resolution = entry.get("resolution", list(DEFAULT_RESOLUTION))
+	if not isinstance(resolution, list) or len(resolution) != 2 or not all(isinstance(r, int) and r > 0 for r in resolution):
+		fail(where + ".resolution", "expected [width, height] in pixels, got %r" % (resolution,))
+	width, height = width or resolution[0], height or resolution[1]
+
+	if "screen" in entry:
+		if "target" in entry or "distance" in entry or "width" in entry or "up" in entry:
+			fail(where, "a camera has a screen or a target, not both")
+		screen = entry["screen"]
+		checkKeys(screen, "screen", where + ".screen")
+		size = number(required(screen, "width", where + ".screen"), where + ".screen.width", positive=True)
+		right = vector(screen["right"], where + ".screen.right") if "right" in screen else None
+		up = vector(screen["up"], where + ".screen.up") if "up" in screen else None
+		if (right is None) != (up is None):
+			fail(where + ".screen", "right and up go together")
+		return eye, Screen(vector(required(screen, "origin", where + ".screen"), where + ".screen.origin"), vector(required(screen, "normal", where + ".screen"), where + ".screen.normal"),
+						   width, height, float(size) / width, right, up)
+
+	target = vector(required(entry, "target", where), where + ".target")
+	distance = number(entry.get("distance", 1.0), where + ".distance", positive=True)
+	size = number(required(entry, "width", where), where + ".width", positive=True)
+	up = vector(entry.get("up", [0, 1, 0]), where + ".up")
+	return eye, Screen.lookAt(np.array(eye, dtype=float), target, width, height, float(size) / width, distance, up)
+
+
+# the tracer settings of the file: name, seed and the constants in TRACER_SETTINGS.
+def tracerSettings(entry, where):
+	checkKeys(entry, "tracer", where)
+	settings = dict(entry)
+	if "name" in settings and not isinstance(settings["name"], basestring):
+		fail(where + ".name", "expected the name of a tracer")
+	if "seed" in settings and (isinstance(settings["seed"], bool) or not isinstance(settings["seed"], (int, long))):
+		fail(where + ".seed", "expected an integer")
+	for key in TRACER_SETTINGS:
+		if key in settings and (isinstance(settings[key], bool) or not isinstance(settings[key], int) or settings[key] < 0):
+			fail(where + "." + key, "expected a count")
+	return settings
+
+
+# sets the constants of the tracer settings that the tracer has, e.g. MAX_DEPTH.
+def applyTracerSettings(tracer, settings):
+	for key, constant in TRACER_SETTINGS.items():
+		if key in settings:
+			if not hasattr(tracer, constant):
+				raise ValueError("tracer.%s: the %s has no such setting" % (key, tracer.__class__.__name__))
+			setattr(tracer, constant, settings[key])
+
+
+# builds the scene of a description, as read by readDescription, and returns it with the
+# tracer settings. a description has the camera, named materials objects can refer to, the
+# objects, the lights, which are spheres, and optionally the tracer:
+#   {"camera": {"eye": [0, 0, -5], "resolution": [200, 200],
+#               "screen": {"origin": [0, 0, -1], "normal": [0, 0, -1], "width": 10}},
+#    "materials": {"red": {"color": [255, 0, 0], "diffuse": 1, "specular": 0, "ambient": 0.1}},
+#    "objects": [{"type": "plane", "origin": [0, -5, 0], "normal": [0, 1, 0], "material": "red"},
+#                {"type": "spheres", "centers": [[0, 0, 0], [1, 0, 0]], "radii": 0.1, "material": "red"}],
+#    "lights": [{"type": "sphere", "center": [0, 4, 0], "radius": 1, "material": {...}}],
+#    "tracer": {"name": "PathTracing", "seed": 0, "maxDepth": 8}}
+# objects are planes, spheres, triangles, cubes, meshes from OBJ or PLY files and sets of
+# spheres, which are stored as arrays. files are relative to directory. objects can have a
+# unique name, scene.names holds them by it. every mistake is a ValueError saying where it is.
+def buildScene(description, width=None, height=None, directory="."):
+	checkKeys(description, "scene", "scene")
+	materials = {}
+	for name, entry in sorted(description.get("materials", {}).items()):
+		materials[name] = makeMaterial(entry, {}, "materials.%s" % name)
+
+	eye, screen = makeCamera(required(description, "camera", "scene"), width, height, "camera")
+	objects = description.get("objects", [])
+	lights = description.get("lights", [])
+	if not isinstance(objects, list) or not isinstance(lights, list):
+		fail("scene", "objects and lights have to be lists")
+	geometry = [makeObject(entry, materials, directory, "objects[%d]" % i) for i, entry in enumerate(objects)]
+
+	names = {}
+	for i, entry in enumerate(objects):
+		if "name" in entry:
+			name = entry["name"]
+			if not isinstance(name, basestring) or name in names:
+				fail("objects[%d].name" % i, "expected a name no other object has")
+			names[name] = geometry[i]
+
+	lightSpheres = []
+	for i, entry in enumerate(lights):
+		where = "lights[%d]" % i
+		if isinstance(entry, dict) and entry.get("type", "sphere") != "sphere":
+			fail(where, "lights have to be spheres")
+		if isinstance(entry, dict) and "name" in entry:
+			fail(where, "lights have no names")
+		lightSpheres.append(makeObject(dict(entry, type="sphere") if isinstance(entry, dict) else entry, materials, directory, where))
+
+	return Scene(eye=eye, screen=screen, geometry=geometry, lights=lightSpheres, names=names), tracerSettings(description.get("tracer", {}), "tracer")
+
+
+# loads a scene file, see buildScene. width and height override its resolution.
+def loadScene(path, width=None, height=None):
+	try:
+		description = readDescription(path)
+	except ValueError as e:
+		raise ValueError("%s: %s" % (path, e))
+	try:
+		return buildScene(description, width, height, os.path.dirname(os.path.abspath(path)))
+	except ValueError as e:
+		raise ValueError("%s: %s" % (path, e))
+
+
+if __name__ == "__main__":
+	import shutil, tempfile, time
+
+	scene, settings = loadScene(DEFAULT_SCENE, 40, 30)
+	assert (scene.screen.resolutionX, scene.screen.resolutionY) == (40, 30)
+	assert sorted(scene.names) == ["bigSphere", "bouncingSphere"] and all(obj in scene.geometry for obj in scene.names.values())
+
+	# mistakes are reported with where they are.
+	mistakes = [
+		({"objects": []}, "camera is missing"),
+		({"camera": {"eye": [0, 0], "screen": {}}}, "camera.eye"),
+		({"camera": {"eye": [0, 0, 0], "target": [0, 0, 1], "width": 1}, "objects": [{"type": "sphere", "center": [0, 0, 0], "radius": -1, "material": {"color": [0, 0, 0], "diffuse": 1, "specular": 0}}]}, "objects[0].radius"),
+		({"camera": {"eye": [0, 0, 0], "target": [0, 0, 1], "width": 1}, "objects": [{"type": "cone", "material": "red"}]}, "objects[0]: unknown type"),
+		({"camera": {"eye": [0, 0, 0], "target": [0, 0, 1], "width": 1}, "objects": [{"type": "plane", "origin": [0, 0, 0], "normal": [0, 1, 0], "material": "red"}]}, "unknown material red"),
+		({"camera": {"eye": [0, 0, 0], "target": [0, 0, 1], "width": 1}, "tracer": {"maxDepht": 3}}, "tracer: unknown maxDepht"),
+		({"camera": {"eye": [0, 0, 0], "target": [0, 0, 1], "width": 1}, "objects": [{"type": "plane", "name": "floor", "origin": [0, 0, 0], "normal": [0, 1, 0], "material": {"color": [0, 0, 0], "diffuse": 1, "specular": 0}}] * 2}, "objects[1].name"),
+	]
+	for description, message in mistakes:
+		try:
+			buildScene(description)
+		except ValueError as e:
+			assert message in str(e), (str(e), message)
+		else:
+			raise AssertionError("no error for %s" % message)
+
+	# a generated scene of a hundred thousand spheres, in the file and as a binary file.
+	random = np.random.RandomState(0)
+	centers = np.round(random.uniform(-4, 4, (100000, 3)), 4)
+	radii = np.round(random.uniform(0.005, 0.02, 100000), 4)
+	description = {
+		"camera": {"eye": [0, 0, -4.9], "screen": {"origin": [0, 0, -1], "normal": [0, 0, -1], "width": 10}},
+		"materials": {"grey": {"color": [100, 100, 100], "diffuse": 1, "specular": 0, "ambient": 0.1}},
+		"objects": [{"type": "spheres", "centers": centers.tolist(), "radii": radii.tolist(), "material": "grey"}],
+		"lights": [{"center": [0, 4.5, 0], "radius": 0.5, "material": {"color": [255, 255, 255], "diffuse": 1, "specular": 1, "ambient": 1}}],
+	}
+	directory = tempfile.mkdtemp()
+	try:
+		with open(os.path.join(directory, "spheres.json"), "w") as f:
+			json.dump(description, f)
+		np.save(os.path.join(directory, "spheres.npy"), np.column_stack([centers, radii]))
+		description["objects"] = [{"type": "spheres", "file": "spheres.npy", "material": "grey"}]
+		with open(os.path.join(directory, "binary.json"), "w") as f:
+			json.dump(description, f)
+
+		for name in ["spheres.json", "binary.json"]:
+			start = time.time()
+			scene, settings = loadScene(os.path.join(directory, name))
+			seconds = time.time() - start
+			print "%s: %d spheres loaded in %.3fs" % (name, len(scene.geometry[0]), seconds)
+			assert len(scene.geometry[0]) == 100000 and np.array_equal(scene.geometry[0].centers, centers)
+			assert seconds < 1.0
+	finally:
+		shutil.rmtree(directory)
+	print "scenefile ok"
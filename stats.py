@@ -0,0 +1,133 @@
+#!/usr/bin/python
+
+import json
+import time
+
+import numpy as np
+
+# kinds of rays counted by RayStatistics, in the order of the summary.
+RAY_KINDS = ("primary", "shadow", "reflection", "refraction", "diffuse")
+
+
+# counters of what the rays of a render do: rays cast by kind, intersection tests by primitive
+# type and events like cache hits. a render process counts into one per tile, the tracer the
+# rays and the BVHs the tests, and sends it back with the tile.
+class RayStatistics:
+	def __init__(self):
+		self.rays = dict((kind, 0) for kind in RAY_KINDS)
+		self.tests = {}
+		self.events = {}
+
+	def countRays(self, kind, n=1):
+		self.rays[kind] += int(n)
+
+	def countTests(self, primitive, n=1):
+		self.tests[primitive] = self.tests.get(primitive, 0) + int(n)
+
+	def count(self, event, n=1):
+		self.events[event] = self.events.get(event, 0) + int(n)
+
+	def add(self, other):
+		for counters, others in [(self.rays, other.rays), (self.tests, other.tests), (self.events, other.events)]:
+			for key, value in others.items():
+				counters[key] = counters.get(key, 0) + value
+
+	def totalRays(self):
+		return sum(self.rays.values())
+
+	def totalTests(self):
+		return sum(self.tests.values())
+
+	def toDict(self):
+		return {"rays": dict(self.rays), "tests": dict(self.tests), "events": dict(self.events)}
+
+
+# the statistics of a whole render: the RayStatistics of every worker and of all of them, and
+# the time spent on every tile, summed over the passes of a progressive render. the cost of a
+# pixel is the time of its tile spread evenly over the pixels of the tile. the tiles of all
+# frames of an animation go to the same pixels.
+class RenderStatistics:
+	def __init__(self, width, height, tracer=None, frames=1):
+		self.width = width
+		self.height = height
+		self.frames = frames
+		self.tracer = tracer.__class__.__name__ if tracer is not None else None
+		self.total = RayStatistics()
+		self.workers = {}
+		self.workerTiles = {}
+		self.workerBusy = {}
+		self.tiles = {}
+		self.startTime = time.time()
+		self.wallTime = 0.0
+
+	# events of the main process, like tiles taken from the cache.
+	def count(self, event, n=1):
+		self.total.count(event, n)
+
+	def addTile(self, tile, workerId, seconds, statistics):
+		tile = tuple(tile[:4])
+		if workerId not in self.workers:
+			self.workers[workerId] = RayStatistics()
+			self.workerTiles[workerId], self.workerBusy[workerId] = 0, 0.0
+		self.workerTiles[workerId] += 1
+		self.workerBusy[workerId] += seconds
+
+		rays = 0
+		if statistics is not None:
+			self.workers[workerId].add(statistics)
+			self.total.add(statistics)
+			rays = statistics.totalRays()
+		seconds0, rays0 = self.tiles.get(tile, (0.0, 0))
+		self.tiles[tile] = (seconds0 + seconds, rays0 + rays)
+
+	# called when the last tile is in, until then the time so far counts.
+	def finish(self):
+		self.wallTime = time.time() - self.startTime
+
+	def elapsed(self):
+		return self.wallTime or time.time() - self.startTime
+
+	# (height, width) seconds spent per pixel.
+	def costs(self):
+		costs = np.zeros((self.height, self.width))
+		for (x0, y0, x1, y1), (seconds, rays) in self.tiles.items():
+			costs[y0:y1, x0:x1] += seconds / float((x1 - x0) * (y1 - y0))
+		return costs
+
+	def summary(self):
+		pixels = float(self.width * self.height * self.frames)
+		total = self.total
+		lines = ["Statistics%s, %d tiles in %.2fs:" % (" of the %s" % self.tracer if self.tracer else "", len(self.tiles), self.elapsed())]
+		lines.append("  Rays: %d, %.1f per pixel (%s)" % (total.totalRays(), total.totalRays() / pixels,
+			", ".join("%s %d" % (kind, total.rays[kind]) for kind in RAY_KINDS)))
+		if total.tests:
+			lines.append("  Intersection tests: %d, %.1f per ray (%s)" % (total.totalTests(), total.totalTests() / float(max(total.totalRays(), 1)),
+				", ".join("%s %d" % (p, n) for p, n in sorted(total.tests.items(), key=lambda e: -e[1]))))
+		if total.events:
+			lines.append("  Events: %s" % ", ".join("%s %d" % e for e in sorted(total.events.items())))
+		if self.tiles:
+			times = sorted(((seconds, tile) for tile, (seconds, rays) in self.tiles.items()), reverse=True)
+			lines.append("  Tile time: %.3fs mean, %.3fs max at %s" % (np.mean([t for t, tile in times]), times[0][0], times[0][1]))
+		for workerId in sorted(self.workers):
+			worker = self.workers[workerId]
+			lines.append("  Worker %d: %4d tiles, busy %6.2fs, %d rays, %d tests" % (workerId, self.workerTiles[workerId], self.workerBusy[workerId], worker.totalRays(), worker.totalTests()))
+		return "\n".join(lines)
+
+	def toDict(self):
+		workers = dict((str(i), dict(self.workers[i].toDict(), tiles=self.workerTiles[i], busy=self.workerBusy[i])) for i in self.workers)
+		tiles = [list(tile) + [seconds, rays] for tile, (seconds, rays) in sorted(self.tiles.items())]
+		return dict(self.total.toDict(), tracer=self.tracer, width=self.width, height=self.height, frames=self.frames, wallTime=self.elapsed(), workers=workers, tiles=tiles)
+
+	# writes fileName.json with all counters and the tiles as [x0, y0, x1, y1, seconds, rays],
+	# and fileName_heatmap.png with the cost per pixel, black for the cheapest, white for the
+	# most expensive.
+	def dump(self, fileName):
+		from PIL import Image
+
+		with open(fileName + ".json", "w") as f:
+			json.dump(self.toDict(), f, indent=1, sort_keys=True)
+
+		costs = self.costs()
+		t = costs / max(np.max(costs), 1e-12)
+		heat = np.clip(np.dstack([3 * t, 3 * t - 1, 3 * t - 2]), 0, 1)
+		Image.fromarray((heat * 255).astype(np.uint8), "RGB").save(fileName + "_heatmap.png", format="png")
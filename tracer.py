@@ -5,34 +5,174 @@ import math
 
 import numpy as np
 
-from geometry import Ray, normalize
-from material import Color, WHITE
+from geometry import Ray, normalize, normalize_many, dot_many
+from material import Radiance, WHITE
+from sampling import generator, cosineHemisphere_many, sampleSphere_many, sphereDensity_many, powerHeuristic
 
 EPSILON = 0.0001
 LIGHT_DAMPING = 0.5
 
+# emitted radiance of a light sphere is its color * LIGHT_INTENSITY / radius^2, so a light
+# far away gives the same light as the 1 / (0.5 * distance^2) of lightAttenuation2.
+LIGHT_INTENSITY = 2.0
+
+
+# background radiance, a fresh one every time since callers accumulate into it.
+def background():
+	return Radiance.fromColor(WHITE)
+
+
+# per object material properties as arrays, so they can be gathered with an index array.
+def materialArrays(objects):
+	colors = np.array([obj.getColor().rgb for obj in objects], dtype=float).reshape(len(objects), 3)
+	ambient = np.array([obj.material.ambient for obj in objects], dtype=float)
+	diffuse = np.array([obj.material.diffuse for obj in objects], dtype=float)
+	specular = np.array([obj.material.specular for obj in objects], dtype=float)
+	return colors, ambient, diffuse, specular
+
+
+# normals at the given points, asking every object only for the points that lie on it.
+def normalsAt(objects, index, points):
+	normals = np.empty((len(points), 3))
+	for i in np.unique(index):
+		mask = index == i
+		normals[mask] = objects[i].normalAt_many(points[mask])
+	return normals
+
 class DistanceObject:
 	def __init__(self, distance, obj):
 		self.distance = distance
 		self.object = obj
 
+NO_HIT = DistanceObject(np.inf, None)
+
 class Tracer:
 	__metaclass__ = ABCMeta
 
-	# returns a sorted list of tuples (distance, object)
-	def distances(self, objects, ray):
-		return sorted(list(self.__distancesgen(objects, ray)), key=lambda x: x.distance)
+	# true for tracers whose result is random, only those get better with more samples.
+	stochastic = False
+
+	# number of rays cast by closest_hit, occluded and their packet versions.
+	rays = 0
+
+	# random numbers of stochastic tracers come from self.random, which is seeded again for
+	# every tile and pass from baseSeed, so a render does not depend on which process renders
+	# which tile.
+	baseSeed = 0
+	random = None
+
+	# optional incremental.RayRecord, which collects what the rays of a tile touched.
+	record = None
+
+	# optional stats.RayStatistics, which counts the rays by kind and the intersection tests
+	# of objects that are not in a BVH.
+	stats = None
+
+	def seed(self, *key):
+		self.random = generator((self.baseSeed,) + key)
+
+	# nearest intersection in the interval (t_min, t_max), NO_HIT if there is none.
+	# objects can be a list or a BVH, which is traversed instead of testing every object.
+	# kind is what the ray is counted as by stats, "primary", "reflection" and so on.
+	def closest_hit(self, ray, objects, t_min=0.0, t_max=np.inf, kind="primary"):
+		self.rays += 1
+		if self.stats is not None:
+			self.stats.countRays(kind)
+		if hasattr(objects, "closestHit"):
+			nearest, nearestObject = objects.closestHit(ray, t_min, t_max)
+		else:
+			nearest, nearestObject = t_max, None
+			self.__countTests(objects, 1)
+			for obj in objects:
+				distance = obj.closestDistance(ray, t_min, nearest)
+				if distance < nearest:
+					nearest, nearestObject = distance, obj
+
+		if nearestObject is None:
+			nearest = np.inf
+		if self.record is not None:
+			self.record.hit(ray.origin, ray.direction, nearest, nearestObject)
+		return DistanceObject(nearest, nearestObject) if nearestObject is not None else NO_HIT
+
+	# true if anything is hit in (t_min, max_distance), stops at the first hit found.
+	def occluded(self, ray, objects, max_distance, t_min=EPSILON):
+		self.rays += 1
+		if self.stats is not None:
+			self.stats.countRays("shadow")
+		if self.record is not None:
+			self.record.hit(ray.origin, ray.direction, max_distance)
+		if hasattr(objects, "anyHit"):
+			return objects.anyHit(ray, t_min, max_distance)
 
-	def __distancesgen(self, objects, ray):
 		for obj in objects:
-			intersections = obj.intersect(ray)
-			for intersection in intersections:
-				yield DistanceObject(intersection, obj)
+			self.__countTests([obj], 1)
+			if obj.occludes(ray, t_min, max_distance):
+				return True
+		return False
+
+	# packet version of closest_hit: returns the nearest distance and the index of the
+	# nearest object for every ray, index -1 where nothing is hit. with kind None the caller
+	# counts the rays itself, e.g. when they are of different kinds.
+	def closest_hit_many(self, origins, directions, objects, t_min=0.0, t_max=np.inf, kind="primary"):
+		self.rays += len(origins)
+		if self.stats is not None and kind is not None:
+			self.stats.countRays(kind, len(origins))
+		nearest, index = self.__nearest_many(origins, directions, objects, t_min, t_max)
+		if self.record is not None:
+			self.record.hit_many(origins, directions, nearest, index)
+		return nearest, index
+
+	# packet version of occluded, max_distance can be given per ray.
+	def occluded_many(self, origins, directions, objects, max_distance, t_min=EPSILON):
+		self.rays += len(origins)
+		if self.stats is not None:
+			self.stats.countRays("shadow", len(origins))
+		if self.record is not None:
+			self.record.hit_many(origins, directions, np.broadcast_to(max_distance, len(origins)))
+		if hasattr(objects, "anyHit_many"):
+			return objects.anyHit_many(origins, directions, t_min, max_distance)
+
+		return self.__nearest_many(origins, directions, objects, t_min, max_distance)[1] >= 0
+
+	def __nearest_many(self, origins, directions, objects, t_min, t_max):
+		if hasattr(objects, "intersect_many"):
+			return objects.intersect_many(origins, directions, t_min, t_max)
+
+		nearest = np.full(len(origins), np.inf)
+		nearest[:] = t_max
+		index = np.full(len(origins), -1, dtype=int)
+		self.__countTests(objects, len(origins))
+		for i, obj in enumerate(objects):
+			d = obj.intersect_many(origins, directions, t_min)
+			closer = d < nearest
+			nearest[closer] = d[closer]
+			index[closer] = i
+		nearest[index < 0] = np.inf
+		return nearest, index
+
+	# tests of objects in a BVH are counted by the BVH.
+	def __countTests(self, objects, rays):
+		if self.stats is not None:
+			for obj in objects:
+				self.stats.countTests(obj.__class__.__name__, rays)
 
 	@abstractmethod
 	def trace(self, ray, objects, lights):
 		pass
 
+	# packet version of trace: takes (N,3) origins and normalized directions and returns a (N,3)
+	# array of unclamped rgb values. tracers without a vectorized implementation fall back to trace.
+	def trace_batch(self, origins, directions, objects, lights):
+		colors = np.empty((len(origins), 3))
+		for i in range(len(origins)):
+			colors[i] = self.trace(Ray(origins[i], directions[i]), objects, lights).rgb
+		return colors
+
+	# one sample per ray for progressive rendering, the mean of many samples converges to the
+	# image. for deterministic tracers a single sample already is the final result.
+	def sample_batch(self, origins, directions, objects, lights):
+		return self.trace_batch(origins, directions, objects, lights)
+
 class RayTracer(Tracer):
 	__metaclass__ = ABCMeta
 
@@ -42,21 +182,35 @@ class RayTracer(Tracer):
 		path = p2 - p1
 		return vector_length(path)
 
+	# takes a single distance or an array of distances.
 	def lightAttenuation2(self, distance):
-		if distance < 0.001:
-			return 1
+		if np.ndim(distance) == 0 and distance < 0.001:
+			return 1.0
 
 		# empirisch ermittelte konstanten!
 		a = 0
 		b = 0
 		c = 0.5
 
-		return 1.0 / (a + b*distance + c*distance*distance)
+		if np.ndim(distance) == 0:
+			return 1.0 / (a + b*distance + c*distance*distance)
+
+		with np.errstate(divide="ignore"):
+			attenuation = 1.0 / (a + b*distance + c*distance*distance)
+		return np.where(distance < 0.001, 1.0, attenuation)
+
+	# distance from a point to the surface of a (spherical) light.
+	def lightDistance(self, intersection, light):
+		return self.distanceBetween(intersection, light.center) - light.radius
 
 	def lightAttenuation(self, intersection, light):
 		distance = self.distanceBetween(intersection, light.center)
 		return self.lightAttenuation2(distance)
 
+	def lightAttenuation_many(self, intersections, light):
+		path = light.center - intersections
+		return self.lightAttenuation2(np.sqrt(dot_many(path, path)))
+
 	@abstractmethod
 	def shading(self, intersection, intersector, light):
 		pass
@@ -68,63 +222,100 @@ class RayTracer(Tracer):
 
 class SimpleRayTracer(RayTracer):
 	def shading(self, intersection, intersector, light):
-		return intersector.getColor()
+		return Radiance.fromColor(intersector.getColor())
 
 	def calcShadowFactor(self, intersection, objects, light):
 		return 1
 
 	def trace(self, ray, objects, lights=[]):
-		nearest = self.distances(objects, ray)[0]
+		nearest = self.closest_hit(ray, objects)
 		if nearest.distance < np.inf:
 			return self.shading(None, nearest.object, None)
 		else:
-			return WHITE
+			return background()
+
+	def trace_batch(self, origins, directions, objects, lights=[]):
+		distances, index = self.closest_hit_many(origins, directions, objects)
+		colors = materialArrays(objects)[0]
+
+		# missed rays have index -1 and pick the appended WHITE.
+		return np.vstack([colors, WHITE.rgb])[index]
 
 
 class SimpleShadowRayTracer(RayTracer):
 	def shading(self, intersection, intersector, light):
 		attenuation = self.lightAttenuation(intersection, light)
-		ambient = intersector.getColor() * intersector.material.ambient
-		diffuse = intersector.getColor() * intersector.material.diffuse * attenuation
-		specular = intersector.getColor() * intersector.material.specular * attenuation
+		material = intersector.material
+
+		# ambient + diffuse + specular, all in the color of the object.
+		C = Radiance.fromColor(intersector.getColor())
+		C *= material.ambient + (material.diffuse + material.specular) * attenuation
+		return C
+
+	def shading_many(self, intersections, index, objects, light):
+		colors, ambient, diffuse, specular = [a[index] for a in materialArrays(objects)]
+		attenuation = self.lightAttenuation_many(intersections, light)
 
-		return ambient + diffuse + specular
+		return colors * (ambient + (diffuse + specular) * attenuation)[:, np.newaxis]
 
 	def calcShadowFactor(self, intersection, objects, light):
 		shadowRay = Ray.fromPoints(p1=intersection, p2=light.center)
-		shadowDistances = self.distances(objects, shadowRay)
 
-		# if the distance is too low, it is most likely an intersection with the intersection
-		# thanks to floating point inaccuracy.
-		if abs(shadowDistances[0].distance) < EPSILON:
-			shadowNearest = shadowDistances[1]
+		# nothing may be in between this point and the light. intersections closer than
+		# EPSILON are most likely the intersection itself thanks to floating point inaccuracy.
+		if self.occluded(shadowRay, objects, self.lightDistance(intersection, light), EPSILON):
+			return 0
 		else:
-			shadowNearest = shadowDistances[0]
+			return 1
 
-		lightDistance = self.distances([light], shadowRay)[0].distance
+	def calcShadowFactor_many(self, intersections, objects, light):
+		path = light.center - intersections
+		lightDistance = np.sqrt(dot_many(path, path))
+		shadowDirections = path / lightDistance[:, np.newaxis]
 
-		# if the nearest intersection is in a higher or equal distance to the light, than
-		# the distance from this point to the light, then there is nothing in between.
-		if shadowNearest.distance >= lightDistance:
-			return 1
-		else:
-			return 0
+		occluded = self.occluded_many(intersections, shadowDirections, objects, lightDistance - light.radius, EPSILON)
+		return (~occluded).astype(float)
 
 	def trace(self, ray, objects, lights):
-		distances = self.distances(objects, ray)
-		nearest = distances[0]
+		nearest = self.closest_hit(ray, objects)
 
 		# nothing is hit.
 		if nearest.distance == np.inf:
-			return WHITE
+			return background()
 
 		# ambient color of nearest
-		C = nearest.object.getColor() * nearest.object.material.ambient
+		C = Radiance.fromColor(nearest.object.getColor())
+		C *= nearest.object.material.ambient
 
 		intersection = ray.origin + nearest.distance * ray.direction
 
 		for light in lights:
-			C = C + (self.shading(intersection, nearest.object, light) * self.calcShadowFactor(intersection, objects, light))
+			shadowFactor = self.calcShadowFactor(intersection, objects, light)
+			if shadowFactor > 0:
+				C.addScaled(self.shading(intersection, nearest.object, light), shadowFactor)
+
+		return C
+
+	def trace_batch(self, origins, directions, objects, lights):
+		distances, index = self.closest_hit_many(origins, directions, objects)
+		colors = np.tile(WHITE.rgb.astype(float), (len(origins), 1))
+
+		hit = index >= 0
+		index = index[hit]
+		intersections = origins[hit] + directions[hit] * distances[hit][:, np.newaxis]
+
+		colors[hit] = self.directLight_many(intersections, index, objects, lights)
+		return colors
+
+	# ambient color plus the shading of every light that is not blocked, for intersections on
+	# the objects given by index.
+	def directLight_many(self, intersections, index, objects, lights):
+		materials = materialArrays(objects)
+		C = materials[0][index] * materials[1][index][:, np.newaxis]
+
+		for light in lights:
+			shadowFactor = self.calcShadowFactor_many(intersections, objects, light)[:, np.newaxis]
+			C += self.shading_many(intersections, index, objects, light) * shadowFactor
 
 		return C
 
@@ -135,49 +326,66 @@ class ShadingShadowRayTracer(SimpleShadowRayTracer):
 		self.eye = eye
 
 	def trace(self, ray, objects, lights):
-		distances = self.distances(objects, ray)
-		nearest = distances[0]
+		nearest = self.closest_hit(ray, objects)
 
 		# nothing is hit.
 		if nearest.distance == np.inf:
-			return WHITE
+			return background()
 
 		# ambient color of nearest
-		C = nearest.object.getColor() * nearest.object.material.ambient
+		C = Radiance.fromColor(nearest.object.getColor())
+		C *= nearest.object.material.ambient
 
 		intersection = ray.origin + nearest.distance * ray.direction
 
 		for light in lights:
-			C = C + (self.shading(intersection, nearest.object, light) * self.calcShadowFactor(intersection, objects, light))
+			shadowFactor = self.calcShadowFactor(intersection, objects, light)
+			if shadowFactor > 0:
+				C.addScaled(self.shading(intersection, nearest.object, light), shadowFactor)
 
 		return C
 
 	def shading(self, intersection, intersector, light):
 		attenuation = self.lightAttenuation(intersection=intersection, light=light)
 		shadowRay = Ray.fromPoints(p1=intersection, p2=light.center)
+		material = intersector.material
+		N = intersector.normalAt(intersection)
 		# phong-blinn shading
 
 		# ambient
-		ambient = intersector.getColor() * intersector.material.ambient
+		C = Radiance.fromColor(intersector.getColor())
+		C *= material.ambient
 
 		# diffuse
 		L = shadowRay.direction
-		cos_delta = np.dot(L, intersector.normalAt(intersection))
-		if cos_delta < 0:
-			cos_delta = 0
-		diffuse = light.getColor() * intersector.material.diffuse * cos_delta
-		diffuse = diffuse * attenuation
+		cos_delta = max(np.dot(L, N), 0)
 
 		# specular (blinn)
 		V = Ray.fromPoints(intersection, self.eye).direction
 		H = normalize(V + L)
-		cos_theta = np.dot(intersector.normalAt(intersection), H)
-		if cos_theta < 0:
-			cos_theta = 0
-		specular = light.getColor() * intersector.material.specular * math.pow(cos_theta, 10)
-		specular = specular * attenuation
+		cos_theta = max(np.dot(N, H), 0)
+
+		# diffuse and specular both have the color of the light.
+		lightFactor = (material.diffuse * cos_delta + material.specular * math.pow(cos_theta, 10)) * attenuation
+		return C.addScaled(Radiance.fromColor(light.getColor()), lightFactor)
+
+	def shading_many(self, intersections, index, objects, light):
+		colors, ambient, diffuse, specular = [a[index] for a in materialArrays(objects)]
+		attenuation = self.lightAttenuation_many(intersections, light)
+		lightColor = light.getColor().rgb
+		N = normalsAt(objects, index, intersections)
 
-		return ambient + diffuse + specular
+		# diffuse
+		L = normalize_many(light.center - intersections)
+		cos_delta = np.maximum(dot_many(L, N), 0)
+
+		# specular (blinn)
+		V = normalize_many(self.eye - intersections)
+		H = normalize_many(V + L)
+		cos_theta = np.maximum(dot_many(N, H), 0)
+
+		lightFactor = (diffuse * cos_delta + specular * np.power(cos_theta, 10)) * attenuation
+		return colors * ambient[:, np.newaxis] + lightColor * lightFactor[:, np.newaxis]
 
 
 class RecursiveRayTracer(ShadingShadowRayTracer):
@@ -189,26 +397,30 @@ class RecursiveRayTracer(ShadingShadowRayTracer):
 	def trace(self, ray, objects, lights):
 		return self.recursiveTrace(ray, objects, lights, 0, 0)
 
-	def recursiveTrace(self, ray, objects, lights, depth, distance):
+	# reflection and refraction are not vectorized, every ray goes through the scalar reference.
+	def trace_batch(self, origins, directions, objects, lights):
+		return Tracer.trace_batch(self, origins, directions, objects, lights)
+
+	def recursiveTrace(self, ray, objects, lights, depth, distance, kind="primary"):
 		if depth > self.MAX_DEPTH:
-			return WHITE
+			return background()
 
-		distances = self.distances(objects, ray)
-		if abs(distances[0].distance) < EPSILON:
-			nearest = distances[1]
-		else:
-			nearest = distances[0]
+		# t_min skips the surface the ray starts on.
+		nearest = self.closest_hit(ray, objects, EPSILON, kind=kind)
 
 		if nearest.distance == np.inf:
-			return WHITE
+			return background()
 
 		intersection = ray.origin + nearest.distance * ray.direction
 
 		# default lighting
-		C = nearest.object.getColor() * nearest.object.material.ambient
+		C = Radiance.fromColor(nearest.object.getColor())
+		C *= nearest.object.material.ambient
 
 		for light in lights:
-			C = C + (self.shading(intersection, nearest.object, light) * self.calcShadowFactor(intersection, objects, light))
+			shadowFactor = self.calcShadowFactor(intersection, objects, light)
+			if shadowFactor > 0:
+				C.addScaled(self.shading(intersection, nearest.object, light), shadowFactor)
 
 		# recursive reflection computation.
 		if nearest.object.material.specular > 0:
@@ -216,11 +428,8 @@ class RecursiveRayTracer(ShadingShadowRayTracer):
 			reflectionRayDirection = ray.direction - 2 * (np.dot(ray.direction, N)) * N
 			reflection = Ray(intersection, reflectionRayDirection)
 
-			recursiveValue = self.recursiveTrace(reflection, objects, lights, depth + 1, distance + nearest.distance)
-			recursiveValue = recursiveValue * nearest.object.material.specular
-			recursiveValue = recursiveValue * self.lightAttenuation2(distance=distance)
-
-			C = C + recursiveValue
+			recursiveValue = self.recursiveTrace(reflection, objects, lights, depth + 1, distance + nearest.distance, "reflection")
+			C.addScaled(recursiveValue, nearest.object.material.specular * self.lightAttenuation2(distance=distance))
 
 		# http://www.flipcode.com/archives/reflection_transmission.pdf
 		# http://courses.cs.washington.edu/courses/cse457/08au/lectures/markup/ray-tracing-markup.pdf
@@ -244,112 +453,165 @@ class RecursiveRayTracer(ShadingShadowRayTracer):
 			# catch total internal reflection
 			if not (sinT2 > 1.0):
 				refraction = Ray(intersection, n * ray.direction - (n + np.sqrt(1.0 - sinT2)) * normal)
-				value = self.recursiveTrace(refraction, objects, lights, depth + 1, distance + nearest.distance)
-
-				C = C + value
+				C += self.recursiveTrace(refraction, objects, lights, depth + 1, distance + nearest.distance, "refraction")
 		return C
 
+# Every sample follows a single path: at each hit the light arriving directly from the light
+# spheres is added, weighted by the throughput of the path, and the path continues in one
+# direction: a mirror reflection or a diffuse bounce, picked in proportion to their weights.
+# Diffuse directions are cosine distributed around the normal, so the light from every
+# direction counts as much as it does on a lambertian surface without weighting the samples.
+# The throughput is multiplied by the weight of the chosen bounce divided by its probability,
+# so on average a sample gives the same as following both. After ROULETTE_DEPTH bounces paths
+# are ended at random with a probability that grows as their throughput gets smaller (russian
+# roulette), the survivors are weighted up accordingly.
+# Direct light is sampled explicitly (next event estimation): a direction in the cone of every
+# light, which gives soft shadows. Diffuse bounces can hit the lights as well; both ways of
+# finding a light are weighted with the power heuristic (multiple importance sampling), which
+# keeps the noise low for big, near lights as well as for small, far ones.
+# The paths of all rays are traced together: every bounce is one packet query over the rays
+# whose paths are still alive.
 class PathTracer(ShadingShadowRayTracer):
-	MAX_DEPTH = 1
+	MAX_DEPTH = 8
 	RAY_PER_PIXEL = 8
-	DIFFUSE_REFLECT = 10
-
-	def trace(self, ray, objects, lights):
-		C = Color(0, 0, 0)
-
-		for i in range(self.RAY_PER_PIXEL):
-			C =  C + (self.recursiveTrace(ray, objects, lights, 0, 0) / self.RAY_PER_PIXEL)
-
-		return C
-
-	def recursiveTrace(self, ray, objects, lights, depth, distance):
-		if depth > self.MAX_DEPTH:
-			return Color(0, 0, 0)
+	ROULETTE_DEPTH = 2
 
-		distances = self.distances(objects, ray)
-		if abs(distances[0].distance) < EPSILON:
-			nearest = distances[1]
-		else:
-			nearest = distances[0]
-
-		if nearest.distance == np.inf:
-			return WHITE
-
-		intersection = ray.origin + nearest.distance * ray.direction
+	stochastic = True
 
-		A = nearest.object.getColor() * nearest.object.material.ambient
-		C = nearest.object.getColor() * nearest.object.material.ambient
+	def __init__(self, eye, seed=0):
+		ShadingShadowRayTracer.__init__(self, eye)
+		self.baseSeed = seed
+		self.random = generator(seed)
 
-		# default lighting
+	def trace(self, ray, objects, lights):
+		return Radiance(*self.trace_batch(ray.origin[np.newaxis], ray.direction[np.newaxis], objects, lights)[0])
+
+	# the mean of RAY_PER_PIXEL samples, traced as one packet.
+	def trace_batch(self, origins, directions, objects, lights):
+		samples = self.sample_batch(np.tile(origins, (self.RAY_PER_PIXEL, 1)), np.tile(directions, (self.RAY_PER_PIXEL, 1)), objects, lights)
+		return samples.reshape(self.RAY_PER_PIXEL, len(origins), 3).mean(axis=0)
+
+	# brdf times cosine of the diffuse and blinn lobes of shading, for light arriving from L
+	# at points with normals N, seen from V. lights behind the surface give nothing.
+	def reflectance_many(self, N, V, L, diffuse, specular):
+		cos_delta = dot_many(L, N)
+		with np.errstate(invalid="ignore"):
+			cos_theta = np.nan_to_num(np.maximum(dot_many(N, normalize_many(V + L)), 0))
+		return np.where(cos_delta > 0, diffuse * cos_delta + specular * np.power(cos_theta, 10), 0) / np.pi
+
+	def emission(self, light):
+		return light.getColor().rgb * LIGHT_INTENSITY / (light.radius * light.radius)
+
+	# next event estimation: one direction towards every light, weighted against the chance
+	# that a diffuse bounce with density bouncePdf * cos / pi finds the light as well.
+	def sampleLights_many(self, points, N, V, diffuse, specular, bouncePdf, objects, lights):
+		C = np.zeros((len(points), 3))
 		for light in lights:
-			C = C + (self.shading(intersection, nearest.object, light) * self.calcShadowFactor(intersection, objects, light))
-
-		# recursive reflection computation.
-		if nearest.object.material.specular > 0:
-			N = nearest.object.normalAt(intersection)
-			reflectionRayDirection = ray.direction - 2 * (np.dot(ray.direction, N)) * N
-			reflection = Ray(intersection, reflectionRayDirection)
-
-			recursiveValue = self.recursiveTrace(reflection, objects, lights, depth + 1, distance + nearest.distance)
-			recursiveValue = recursiveValue * (nearest.object.material.specular)
-			recursiveValue = recursiveValue * self.lightAttenuation2(distance)
-
-			C = C + recursiveValue
-
-		if nearest.object.material.diffuse > 0:
-			for c in range(self.DIFFUSE_REFLECT):
-				N = nearest.object.normalAt(intersection)
-				# calculate random new ray direction from hemisphere.
-				# calculate random hemisphere shit in tangent space:
-				# http://www.keithlantz.net/2013/03/a-basic-path-tracer-with-cuda/
-				# http://www.rorydriscoll.com/2009/01/07/better-sampling/
-				#D_tangent_space = self.random_normal_hemisphere()
-
-				## get local coordinate system from at normal.
-				#local_coord = self.local_coordinate_system_from(N)
-
-				## transform tangent-space shit in this normal space.
-				#new_D = np.dot(local_coord, D_tangent_space)
-
-				from random import uniform
-				new_D = np.array([uniform(-1, 1), uniform(-1, 1), uniform(-1, 1)])
-
-				Diffuse = Ray(intersection, new_D)
-				recursiveValue = self.recursiveTrace(Diffuse, objects, lights, depth+1, distance + nearest.distance)
-				recursiveValue = recursiveValue / self.DIFFUSE_REFLECT
-				recursiveValue = recursiveValue * self.lightAttenuation2(distance)
+			L, distance, pdf = sampleSphere_many(points, light.center, light.radius, self.random.uniform(size=len(points)), self.random.uniform(size=len(points)))
+			f = self.reflectance_many(N, V, L, diffuse, specular)
 
-				C = C + recursiveValue
+			lit = np.flatnonzero((pdf > 0) & (f > 0))
+			lit = lit[~self.occluded_many(points[lit], L[lit], objects, distance[lit], EPSILON)]
 
+			weight = powerHeuristic(pdf[lit], bouncePdf[lit] * np.maximum(dot_many(L[lit], N[lit]), 0) / np.pi)
+			C[lit] += self.emission(light) * (f[lit] * weight / pdf[lit])[:, np.newaxis]
 		return C
 
-
-	def random_normal_hemisphere(self):
-		from random import random
-
-		# generate random numbers between 0.0 and 1.0.
-		u1 = random()
-		u2 = random()
-
-		import math
-
-		r = math.sqrt(1 - u1 * u1)
-		phi = 2 * math.pi * u2
-
-		x = r * math.cos(phi)
-		z = r * math.sin(phi)
-
-		return np.array([x, u1, z])
-
-	def local_coordinate_system_from(self, N):
-		x = N[0] +1
-		y = N[1] +1
-		z = N[2] -1
-
-		ortho_N = np.cross(N, np.array([x, y, z]))
-
-		from geometry import normalize
-		axis_1 = normalize(ortho_N)
-		axis_2 = normalize(np.cross(ortho_N, N))
-
-		return np.array([axis_1, N, axis_2])
+	# nearest light hit by every ray before the distances, as (distances, light index or -1).
+	def hitLights_many(self, origins, directions, lights, distances):
+		nearest = np.array(distances, dtype=float)
+		index = np.full(len(origins), -1, dtype=int)
+		for i, light in enumerate(lights):
+			d = light.intersect_many(origins, directions, EPSILON)
+			closer = d < nearest
+			nearest[closer] = d[closer]
+			index[closer] = i
+		return nearest, index
+
+	def sample_batch(self, origins, directions, objects, lights):
+		radiance = np.zeros((len(origins), 3))
+		materials = materialArrays(objects)
+
+		# state of the paths that are still alive, paths maps them to their rays. a light hit by
+		# a path adds its emission times emissionWeight; bouncePdf is the density of the last
+		# diffuse bounce for the multiple importance weight, 0 if the light can't be sampled.
+		paths = np.arange(len(origins))
+		throughput = np.ones(len(origins))
+		travelled = np.zeros(len(origins))
+		emissionWeight = np.ones(len(origins))
+		bouncePdf = np.zeros(len(origins))
+		reflected = np.zeros(len(origins), dtype=bool)
+
+		random = self.random
+		for depth in range(self.MAX_DEPTH + 1):
+			if not len(paths):
+				break
+
+			# t_min skips the surface the ray starts on.
+			if self.stats is not None and depth > 0:
+				self.stats.countRays("reflection", np.sum(reflected))
+				self.stats.countRays("diffuse", np.sum(~reflected))
+			distances, index = self.closest_hit_many(origins, directions, objects, EPSILON, kind="primary" if depth == 0 else None)
+			lightDistances, lightIndex = self.hitLights_many(origins, directions, lights, distances)
+
+			for i, light in enumerate(lights):
+				onLight = lightIndex == i
+				weight = np.where(bouncePdf[onLight] > 0, powerHeuristic(bouncePdf[onLight], sphereDensity_many(origins[onLight], light.center, light.radius)), 1.0)
+				radiance[paths[onLight]] += (emissionWeight[onLight] * weight)[:, np.newaxis] * self.emission(light)
+
+			miss = (index < 0) & (lightIndex < 0)
+			radiance[paths[miss]] += throughput[miss][:, np.newaxis] * WHITE.rgb
+			hit = (index >= 0) & (lightIndex < 0)
+			paths, origins, directions, distances, index = paths[hit], origins[hit], directions[hit], distances[hit], index[hit]
+			throughput, travelled = throughput[hit], travelled[hit]
+
+			intersections = origins + directions * distances[:, np.newaxis]
+			colors, ambient, diffuse, specular = [a[index] for a in materials]
+
+			# normals on the side the ray came from, diffuse bounces and lights are on that side.
+			N = normalsAt(objects, index, intersections)
+			N *= np.where(dot_many(directions, N) > 0, -1.0, 1.0)[:, np.newaxis]
+			V = -directions
+
+			# the bounce weights fall off with the distance the path has travelled so far.
+			diffuseBounce = (diffuse > 0).astype(float)
+			total = specular + diffuseBounce
+			with np.errstate(divide="ignore", invalid="ignore"):
+				diffuseProbability = np.where(total > 0, diffuseBounce / total, 0.0)
+
+			direct = colors * ambient[:, np.newaxis] + self.sampleLights_many(intersections, N, V, diffuse, specular, diffuseProbability, objects, lights)
+			radiance[paths] += throughput[:, np.newaxis] * direct
+
+			if depth == self.MAX_DEPTH:
+				break
+
+			reflect = random.uniform(size=len(paths)) * total < specular
+			bounce = ~reflect
+			newDirections = np.empty_like(directions)
+			newDirections[reflect] = directions[reflect] + 2 * dot_many(V[reflect], N[reflect])[:, np.newaxis] * N[reflect]
+			newDirections[bounce] = cosineHemisphere_many(N[bounce], random.uniform(size=np.sum(bounce)), random.uniform(size=np.sum(bounce)))
+
+			# a light found by a diffuse bounce counts like a light sample in that direction.
+			bouncePdf = np.zeros(len(paths))
+			bouncePdf[bounce] = diffuseProbability[bounce] * np.maximum(dot_many(newDirections[bounce], N[bounce]), 0) / np.pi
+			emissionWeight = np.zeros(len(paths))
+			with np.errstate(divide="ignore", invalid="ignore"):
+				f = self.reflectance_many(N[bounce], V[bounce], newDirections[bounce], diffuse[bounce], specular[bounce])
+				emissionWeight[bounce] = np.where(bouncePdf[bounce] > 0, throughput[bounce] * f / bouncePdf[bounce], 0)
+
+			throughput = throughput * total * self.lightAttenuation2(travelled)
+			travelled = travelled + distances
+			emissionWeight[reflect] = throughput[reflect]
+
+			alive = total > 0
+			if depth + 1 >= self.ROULETTE_DEPTH:
+				survival = np.minimum(throughput, 1.0)
+				alive &= random.uniform(size=len(paths)) < survival
+				throughput = throughput / np.maximum(survival, 1e-12)
+				emissionWeight = emissionWeight / np.maximum(survival, 1e-12)
+
+			paths, throughput, travelled = paths[alive], throughput[alive], travelled[alive]
+			emissionWeight, bouncePdf, reflected = emissionWeight[alive], bouncePdf[alive], reflect[alive]
+			origins, directions = intersections[alive], normalize_many(newDirections[alive])
+
+		return radiance
@@ -1,14 +1,40 @@
+import Queue
+import time
+
 from Tkconstants import TOP, RIGHT, LEFT, END
 from Tkinter import Button, PhotoImage, Canvas, Frame, Listbox
 
+import numpy as np
+
 from geometry import Ray
 from tracer import SimpleRayTracer, SimpleShadowRayTracer, ShadingShadowRayTracer, RecursiveRayTracer, PathTracer
 
+# PIL's Tk support is packaged separately on some systems, without it the image is drawn
+# through Tk's PhotoImage.put, which is a lot slower.
+try:
+	from PIL import Image, ImageTk
+except ImportError:
+	ImageTk = None
+
+# the image is redrawn at most this many times per second, with all tiles finished since.
+REFRESH_RATE = 30
+
+# longest time in seconds an update takes tiles off the queue, so the window stays responsive
+# while the render processes report tiles faster than they can be drawn.
+DRAIN_TIME = 0.02
+
+# steps of the preview of deterministic tracers: every 8th pixel of every 8th row is traced
+# first and shown as an 8 x 8 block, then the image is refined down to every pixel. every
+# pixel is traced once, at the coarsest step whose grid it is on.
+PREVIEW_STEPS = (8, 4, 2, 1)
 
-class Window(Frame):
-	RENDER_PROCESSES = 2
 
-	def __init__(self, width, height, scene, tracer, calculate=None):
+class Window(Frame):
+	# edits is a list of functions that change the scene through an incremental.TileRecords,
+	# the Edit button applies them one after another and traces only the tiles they change.
+	# with preview, deterministic tracers render coarse to fine in the PREVIEW_STEPS. selecting
+	# another tracer or editing the scene while rendering cancels the render and starts anew.
+	def __init__(self, width, height, scene, tracer, calculate=None, processes=None, tileSize=None, maxSamples=None, noise=None, edits=None, preview=True):
 		Frame.__init__(self, master=None)
 
 		if calculate is None:
@@ -20,6 +46,17 @@ class Window(Frame):
 		self.tracer = tracer
 		self.width = width
 		self.height = height
+		self.processes = processes
+		self.tileSize = tileSize
+		self.maxSamples = maxSamples
+		self.noise = noise
+		self.edits = list(edits or [])
+		self.preview = preview
+		self.framebuffer = None
+		self.records = None
+		self.service = None
+		self.rendering = False
+		self.started = False
 
 		self.__init_window(height, width)
 
@@ -29,13 +66,19 @@ class Window(Frame):
 		self.master.title = "Ray Py"
 		canvas = Canvas(self.master, width=width, height=height)
 		canvas.pack(side=TOP)
-		self.img = PhotoImage(width=width, height=height)
+		self.img = ImageTk.PhotoImage("RGB", (width, height)) if ImageTk is not None else PhotoImage(width=width, height=height)
 		canvas.create_image((width / 2, height / 2), image=self.img, state="normal")
 		self.startButton = Button(self.master, text="Render", command=lambda: self.__onStartPressed())
 		self.startButton.pack(side=RIGHT)
 		self.resetButton = Button(self.master, text="Reset", command=lambda: self.__onResetPressed())
 		self.resetButton.config(state="disabled")
 		self.resetButton.pack(side=RIGHT)
+		self.stopButton = Button(self.master, text="Stop", command=lambda: self.__onStopPressed())
+		self.stopButton.config(state="disabled")
+		self.stopButton.pack(side=RIGHT)
+		self.editButton = Button(self.master, text="Edit", command=lambda: self.__onEditPressed())
+		self.editButton.config(state="disabled")
+		self.editButton.pack(side=RIGHT)
 
 		self.listbox = Listbox(self.master, height=5)
 		self.listbox.bind('<<ListboxSelect>>', self.__selectTracer)
@@ -58,51 +101,163 @@ class Window(Frame):
 			self.tracer = RecursiveRayTracer(self.scene.eye)
 		elif value == "PathTracer":
 			self.tracer = PathTracer(self.scene.eye)
+		# the records of the image belong to the tracer that rendered it.
+		self.records = None
+		if self.rendering:
+			self.__cancel()
+		if self.started:
+			self.__draw()
 
 	def __onStartPressed(self):
 		self.startButton.config(state="disabled")
-		self.listbox.config(state="disabled")
+		self.started = True
 		self.__draw()
 
+	def __onEditPressed(self):
+		self.editButton.config(state="disabled")
+		self.resetButton.config(state="disabled")
+		if self.rendering:
+			self.__cancel()
+		self.edits.pop(0)(self.records)
+		self.__draw()
+
+	# stops the render in flight without waiting for it: the workers skip the tiles of the job
+	# that are left and don't write those they are tracing, the next job doesn't see them on the
+	# data queue. tiles without their full resolution pass are traced again by the next render.
+	def __cancel(self):
+		self.master.after_cancel(self.after_id)
+		self.service.cancel(self.pool.job)
+		self.rendering = False
+		if self.records is not None:
+			self.records.invalidate(t for t in self.renderTiles if tuple(t) not in self.finished)
+
+	# stochastic tracers render progressively, one sample per pixel and pass, until the
+	# stop button is pressed, maxSamples passes are done or, with a noise target, every pixel
+	# is converged. a pass only renders the tiles that still have pixels to sample.
+	def __onStopPressed(self):
+		self.stopButton.config(state="disabled")
+		self.service.cancel(self.pool.job)
+		self.__blit([(0, 0, self.width, self.height)])
+		self.__finish()
+
+	# takes the finished tiles off the queue and draws them together, REFRESH_RATE times a
+	# second, in between Tk handles the events of the window.
 	def __update(self):
-		if self.finishedQueue.qsize() >= self.RENDER_PROCESSES:
-			self.finishedThreads = self.RENDER_PROCESSES
-			while not self.finishedQueue.empty():
-				self.finishedQueue.get()
-
-		if not self.dataQueue.empty():
-			item = self.dataQueue.get()
-			self.img.put(item[1], item[0])
-			self.master.update()
-		elif self.finishedThreads == self.RENDER_PROCESSES:
-			for t in self.threads:
-				t.join()
-
-			self.master.after_cancel(self.after_id)
-			self.resetButton.config(state="active")
+		start = time.time()
+		tiles = []
+		while time.time() - start < DRAIN_TIME:
+			try:
+				tile, rays, summary = self.pool.dataQueue.get(False)[:3]
+			except Queue.Empty:
+				break
+			self.records.add(tile, summary)
+			tiles.append(tile)
+		if tiles:
+			self.__blit(tiles)
+			self.tilesDrawn = self.tilesDrawn + len(tiles)
+			if not self.levels:
+				self.finished.update(tuple(t) for t in tiles)
+
+		if self.tilesDrawn == len(self.passTiles) and self.levels:
+			self.__submitLevel()
+		elif self.tilesDrawn == len(self.passTiles):
+			self.samples += 1
+			if self.progressive:
+				active = self.framebuffer.active()
+				self.passTiles = [t for t in self.renderTiles if np.any(active[t[1]:t[3], t[0]:t[2]])]
+			if not self.progressive or not self.passTiles or (self.maxSamples is not None and self.samples >= self.maxSamples):
+				self.pool.close()
+				self.pool.join()
+				self.__finish()
+				return
+
+			self.master.wm_title("Ray Py - %d passes, noise %.4f" % ((self.samples,) + self.framebuffer.noiseLevel()[:1]))
+			self.tilesDrawn = 0
+			self.pool.submit(self.passTiles, self.samples)
+
+		self.after_id = self.master.after(1000 / REFRESH_RATE, self.__update)
+
+	# the next step of the preview, the last one traces the rest of the pixels.
+	def __submitLevel(self):
+		step = self.levels.pop(0)
+		reuse = PREVIEW_STEPS[PREVIEW_STEPS.index(step) - 1] if step != PREVIEW_STEPS[0] else 0
+		self.master.wm_title("Ray Py - tracing %d of %d tiles at 1/%d resolution" % (len(self.renderTiles), len(self.tiles), step))
+		self.tilesDrawn = 0
+		self.pool.submit(self.passTiles, step=step, reuse=reuse)
+
+	def __finish(self):
+		self.master.after_cancel(self.after_id)
+		self.rendering = False
+		if not self.progressive:
+			self.master.wm_title("Ray Py - traced %d of %d tiles" % (len(self.renderTiles), len(self.tiles)))
+		self.stopButton.config(state="disabled")
+		self.resetButton.config(state="active")
+		if self.edits:
+			self.editButton.config(state="active")
+
+	# copies finished tiles from the framebuffer into the image. with PIL the whole framebuffer
+	# is pasted at once, otherwise every tile is put, one string per tile.
+	def __blit(self, tiles):
+		if ImageTk is not None:
+			self.img.paste(Image.fromarray(self.framebuffer.toBytes(), "RGB"))
 			return
 
-		self.after_id = self.master.after(0, self.__update)
+		for x0, y0, x1, y1 in tiles:
+			pixels = self.framebuffer.toBytes(x0, y0, x1, y1)
+			rows = ["{" + " ".join("#%02x%02x%02x" % tuple(p) for p in row) + "}" for row in pixels]
+			self.img.put(" ".join(rows), to=(x0, y0))
 
+	# renders the tiles of the image that have no record yet or were changed by an edit, the
+	# first render of a tracer renders all of them.
 	def __draw(self):
-		from processes import BlockProcess
-		from multiprocessing import Queue
-		self.finishedQueue = Queue()
-		self.dataQueue = Queue()
-		self.finishedThreads = 0
+		from framebuffer import Framebuffer, AccumulationBuffer
+		from incremental import TileRecords
+		from processes import RenderPool, RenderService, makeTiles, TILE_SIZE
+		self.progressive = self.tracer.stochastic
+		if self.records is None:
+			self.framebuffer = AccumulationBuffer(self.width, self.height, self.noise) if self.progressive else Framebuffer(self.width, self.height)
+			self.records = TileRecords(self.scene)
+		self.tiles = makeTiles(self.width, self.height, self.tileSize or TILE_SIZE)
+		self.renderTiles = self.records.dirty(self.tiles)
+		for tile in self.renderTiles:
+			self.framebuffer.clear(*tile)
+		self.passTiles = self.renderTiles
+		self.tilesDrawn = 0
+		self.samples = 0
+		self.finished = set()
+		self.levels = list(PREVIEW_STEPS) if self.preview and not self.progressive else []
 
-		self.threads = BlockProcess.forCount(self.RENDER_PROCESSES, self.width, self.height, self.tracer, self.scene, self.dataQueue, self.finishedQueue)
-
-		for t in self.threads:
-			t.start()
+		self.master.wm_title("Ray Py - tracing %d of %d tiles" % (len(self.renderTiles), len(self.tiles)))
+		if not self.renderTiles:
+			self.__finish()
+			return
 
-		self.__update()
+		# the render processes are started once, with the scene, and render every image after.
+		if self.service is None:
+			self.service = RenderService(self.processes, scene=self.scene)
+		self.pool = RenderPool(self.tracer, self.scene, self.framebuffer, progressive=self.progressive, record=True, service=self.service)
+		self.rendering = True
+		if self.levels:
+			self.pool.start([], close=False)
+			self.__submitLevel()
+		else:
+			self.pool.start(self.renderTiles, close=not self.progressive, samplePass=0 if self.progressive else None)
+		if self.progressive:
+			self.stopButton.config(state="active")
+		if self.edits:
+			self.editButton.config(state="active")
 
+		# a single update loop, a second one would start every pass twice.
 		self.after_id = self.master.after(0, self.__update)
 
 	def __onResetPressed(self):
-		self.img.blank()
+		if ImageTk is not None:
+			self.img.paste(Image.new("RGB", (self.width, self.height)))
+		else:
+			self.img.blank()
 		self.d = [0, 0]
+		self.records = None
+		self.started = False
 		self.resetButton.config(state="disabled")
+		self.editButton.config(state="disabled")
 		self.startButton.config(state="active")
-		self.listbox.config(state="normal")